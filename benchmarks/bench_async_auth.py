@@ -0,0 +1,98 @@
+"""Load test of the sync and async authentication paths under ASGI.
+
+A minimal in-process ASGI app authenticates every request, either by
+pushing `authenticate` to a worker thread with `sync_to_async` or by
+awaiting `aauthenticate`. Requests are issued concurrently and the
+throughput and p99 latency of both paths are reported.
+"""
+import asyncio
+import io
+import os
+import tempfile
+import time
+
+from benchmarks.utils import report, setup_django
+
+REQUESTS = 2000
+CONCURRENCY = 50
+
+
+def make_app(authenticate):
+    from django.core.handlers.asgi import ASGIRequest
+
+    async def app(scope, receive, send):
+        request = ASGIRequest(scope, io.BytesIO())
+        await authenticate(request)
+        await send({'type': 'http.response.start', 'status': 204,
+                    'headers': []})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    return app
+
+
+async def load(app, header):
+    scope = {
+        'type': 'http', 'method': 'GET', 'path': '/verify', 'query_string': b'',
+        'headers': [(b'authorization', header.encode())],
+    }
+    latencies = []
+    queue = asyncio.Queue()
+    for _ in range(REQUESTS):
+        queue.put_nowait(None)
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        pass
+
+    async def worker():
+        while not queue.empty():
+            queue.get_nowait()
+            start = time.perf_counter()
+            await app(scope, receive, send)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(CONCURRENCY)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    return REQUESTS / elapsed, p99 * 1e3
+
+
+def main():
+    fd, database_name = tempfile.mkstemp(suffix='.sqlite3')
+    os.close(fd)
+    try:
+        setup_django(database_name)
+        run()
+    finally:
+        os.unlink(database_name)
+
+
+def run():
+    from asgiref.sync import sync_to_async
+    from django.contrib.auth.models import User
+
+    from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+    from jwt_knox.utils import create_auth_token, jwt_join_header_and_token
+
+    user = User.objects.create_user(username='bench')
+    header = jwt_join_header_and_token(create_auth_token(user, None))
+    authenticator = JSONWebTokenKnoxAuthentication()
+
+    rows = []
+    for name, authenticate in (
+            ('sync_to_async', sync_to_async(authenticator.authenticate)),
+            ('aauthenticate', authenticator.aauthenticate)):
+        rps, p99 = asyncio.run(load(make_app(authenticate), header))
+        rows.append((name, '%.0f' % rps, '%.2f' % p99))
+
+    report('ASGI authentication (%d requests, concurrency %d)'
+           % (REQUESTS, CONCURRENCY), rows, ('path', 'req/s', 'p99 ms'))
+
+
+if __name__ == '__main__':
+    main()
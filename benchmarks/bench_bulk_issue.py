@@ -0,0 +1,54 @@
+"""Issuing N tokens one by one against `create_auth_tokens_bulk`.
+"""
+import os
+import tempfile
+import time
+from unittest import mock
+
+from benchmarks.utils import report, setup_django
+
+COUNT = 2000
+ALGORITHMS = ('HS256', 'RS256')
+
+
+def main():
+    # Inserts are only representative against a file database
+    setup_django(os.path.join(tempfile.mkdtemp(), 'bench.sqlite3'))
+
+    from django.contrib.auth.models import User
+
+    from jwt_knox.settings import api_settings
+    from jwt_knox.utils import create_auth_token, create_auth_tokens_bulk
+    from tests.test_jwt_knox import generate_private_key, private_pem
+
+    users = [User.objects.create_user(username='bench%d' % i)
+             for i in range(COUNT)]
+    workers = os.cpu_count() or 1
+
+    def timed(func):
+        start = time.perf_counter()
+        func()
+        return time.perf_counter() - start
+
+    rows = []
+    for algorithm in ALGORITHMS:
+        private = None
+        if algorithm != 'HS256':
+            private = private_pem(generate_private_key(algorithm))
+        with mock.patch.object(api_settings, 'JWT_ALGORITHM', algorithm), \
+                mock.patch.object(api_settings, 'JWT_PRIVATE_KEY', private):
+            single = timed(lambda: [create_auth_token(user, None)
+                                    for user in users])
+            bulk = timed(lambda: list(create_auth_tokens_bulk(users)))
+            pooled = timed(lambda: list(create_auth_tokens_bulk(
+                users, workers=workers)))
+        rows.append((algorithm, '%.0f' % (COUNT / single),
+                     '%.0f' % (COUNT / bulk), '%.0f' % (COUNT / pooled)))
+
+    report('Tokens issued per second (%d tokens, %d workers)'
+           % (COUNT, workers), rows,
+           ('algorithm', 'create_auth_token', 'bulk', 'bulk + pool'))
+
+
+if __name__ == '__main__':
+    main()
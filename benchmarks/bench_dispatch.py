@@ -0,0 +1,55 @@
+"""Viewset request initialization, with the authenticators created on
+every call against the cached ones.
+"""
+from benchmarks.utils import measure, report, setup_django
+
+
+def main():
+    setup_django()
+
+    from rest_framework.request import ForcedAuthentication
+    from rest_framework.test import APIRequestFactory
+
+    from jwt_knox.viewsets import JWTKnoxAPIViewSet
+
+    class UncachedViewSet(JWTKnoxAPIViewSet):
+        # PerViewAuthenticatorMixin before the authenticators were cached
+        def initialize_request(self, request, *args, **kwargs):
+            request = super(JWTKnoxAPIViewSet, self).initialize_request(
+                request, *args, **kwargs)
+            if not any([isinstance(auth, ForcedAuthentication)
+                        for auth in request.authenticators]):
+                request.authenticators = self.get_authenticators()
+            return request
+
+        def get_authenticators(self):
+            authenticators = self.authentication_classes or ()
+            if hasattr(self, 'action'):
+                per_view = self.get_authenticators_for_view(self.action)
+                if per_view is not None:
+                    authenticators = per_view
+            return [auth() for auth in authenticators]
+
+    request = APIRequestFactory().post('/')
+
+    def initialize(viewset_class, action):
+        view = viewset_class()
+        view.action_map = {'post': action}
+        view.args, view.kwargs = (), {}
+        view.initialize_request(request)
+
+    rows = []
+    for action in ('verify', 'get_token'):
+        before = measure(lambda: initialize(UncachedViewSet, action),
+                         number=5000)
+        after = measure(lambda: initialize(JWTKnoxAPIViewSet, action),
+                        number=5000)
+        rows.append((action, '%.2f' % before, '%.2f' % after,
+                     '%.1fx' % (before / after)))
+
+    report('initialize_request per request', rows,
+           ('action', 'uncached (us)', 'cached (us)', 'speedup'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""`Authorization` header parsing, split-based against
+`parse_authorization_header`.
+"""
+from benchmarks.utils import measure, report, setup_django
+
+HEADERS = (
+    ('Bearer JWT', b'Bearer ' + b'eyJhbGciOiJIUzI1NiJ9.' + b'x' * 300 +
+     b'.' + b'y' * 43),
+    ('other scheme', b'Basic dGVzdF91c2VyOnNlY3JldF9wYXNzd29yZA=='),
+    ('no header', b''),
+)
+
+
+def main():
+    setup_django()
+
+    from django.utils.encoding import smart_str
+
+    from jwt_knox.auth import parse_authorization_header
+
+    prefix = 'Bearer'
+
+    def split_parse(header):
+        # get_jwt_value before the dedicated parser
+        auth = header.split()
+        if not auth or smart_str(auth[0].lower()) != prefix.lower():
+            return None
+        return auth[1]
+
+    rows = []
+    for name, header in HEADERS:
+        before = measure(lambda: split_parse(header), number=100000)
+        after = measure(lambda: parse_authorization_header(
+            header, b'bearer', 8192), number=100000)
+        rows.append((name, '%.3f' % before, '%.3f' % after,
+                     '%.1fx' % (before / after)))
+
+    report('Parsing one Authorization header', rows,
+           ('header', 'split (us)', 'parser (us)', 'speedup'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""Authentication cost with last used tracking, and how many writes the
+throttle coalesces.
+"""
+from unittest import mock
+
+from benchmarks.utils import measure, report, setup_django
+
+SESSIONS = 20
+REQUESTS = 2000
+
+
+def main():
+    setup_django()
+
+    from django.contrib.auth.models import User
+    from rest_framework.test import APIRequestFactory
+
+    from jwt_knox.activity import activity_tracker
+    from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+    from jwt_knox.settings import api_settings
+    from jwt_knox.utils import create_auth_token, jwt_join_header_and_token
+
+    user = User.objects.create_user(username='bench')
+    factory = APIRequestFactory()
+    requests = [
+        factory.get('/', HTTP_AUTHORIZATION=jwt_join_header_and_token(
+            create_auth_token(user, None)))
+        for _ in range(SESSIONS)]
+    authenticator = JSONWebTokenKnoxAuthentication()
+
+    def authenticate_all():
+        for request in requests:
+            authenticator.authenticate(request)
+
+    rows = []
+    for tracking in (False, True):
+        with mock.patch.object(api_settings, 'JWT_TRACK_LAST_USED', tracking):
+            activity_tracker.reset()
+            elapsed = measure(authenticate_all, number=REQUESTS // SESSIONS,
+                              repeat=1) / SESSIONS
+            activity_tracker.flush()
+            stats = activity_tracker.stats()
+        rows.append(('on' if tracking else 'off', '%.1f' % elapsed,
+                     stats['touches'], stats['coalesced'], stats['writes'],
+                     stats['flushes']))
+
+    report('Authenticating %d requests over %d sessions'
+           % (REQUESTS, SESSIONS), rows,
+           ('tracking', 'per request (us)', 'touches', 'coalesced', 'writes',
+            'flushes'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""`logout_all` latency with and without `JWT_LOGOUT_WATERMARK`.
+"""
+import time
+from datetime import timedelta
+from unittest import mock
+
+from benchmarks.utils import report, setup_django
+
+SESSION_COUNTS = (10, 1000, 100000)
+REPEAT = 3
+
+
+def main():
+    setup_django()
+
+    from django.contrib.auth.models import User
+    from django.urls import reverse
+    from django.utils import timezone
+    from knox.models import AuthToken
+    from rest_framework.test import APIClient
+
+    from jwt_knox.settings import api_settings
+    from jwt_knox.utils import create_auth_token, jwt_join_header_and_token
+
+    logout_all_url = reverse('jwt_knox-logout-all')
+    user = User.objects.create_user(username='bench')
+    client = APIClient()
+
+    def populate(count):
+        AuthToken.objects.all().delete()
+        expiry = timezone.now() + timedelta(hours=1)
+        AuthToken.objects.bulk_create(
+            [AuthToken(digest='%0128x' % i, token_key='%015x' % i,
+                       user=user, expiry=expiry)
+             for i in range(count - 1)], batch_size=5000)
+        client.credentials(HTTP_AUTHORIZATION=jwt_join_header_and_token(
+            create_auth_token(user, None)))
+
+    def logout_all(count, watermark):
+        timings = []
+        with mock.patch.object(api_settings, 'JWT_LOGOUT_WATERMARK',
+                               watermark):
+            for _ in range(REPEAT):
+                populate(count)
+                start = time.perf_counter()
+                client.post(logout_all_url)
+                timings.append(time.perf_counter() - start)
+        return min(timings) * 1e3
+
+    rows = []
+    for count in SESSION_COUNTS:
+        delete_time = logout_all(count, False)
+        watermark_time = logout_all(count, True)
+        rows.append((count, '%.2f' % delete_time, '%.2f' % watermark_time,
+                     '%.1fx' % (delete_time / watermark_time)))
+
+    report('logout_all with N live sessions', rows,
+           ('sessions', 'delete (ms)', 'watermark (ms)', 'speedup'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""Authentication overhead of each metrics sink.
+
+`authenticate()` is dominated by the ORM, so the cost of one timed block
+plus one counter increment is also measured on its own.
+"""
+import socket
+from unittest import mock
+
+from benchmarks.utils import measure, report, setup_django
+
+
+def main():
+    setup_django()
+
+    from django.contrib.auth.models import User
+    from rest_framework.test import APIRequestFactory
+
+    from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+    from jwt_knox.metrics import (NullSink, PrometheusSink, StatsdSink,
+                                  metrics)
+    from jwt_knox.settings import api_settings
+    from jwt_knox.utils import create_auth_token, jwt_join_header_and_token
+
+    user = User.objects.create_user(username='bench')
+    request = APIRequestFactory().get(
+        '/', HTTP_AUTHORIZATION=jwt_join_header_and_token(
+            create_auth_token(user, None)))
+    authenticator = JSONWebTokenKnoxAuthentication()
+    # Somewhere for the StatsD packets to go
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+
+    def instrument():
+        with metrics.timer('decode_seconds'):
+            pass
+        metrics.incr('authentications_total')
+
+    rows = []
+    for name, sink_class in (('disabled', None), ('NullSink', NullSink),
+                             ('PrometheusSink', PrometheusSink),
+                             ('StatsdSink', StatsdSink)):
+        with mock.patch.object(api_settings, 'JWT_METRICS_SINK', sink_class), \
+                mock.patch.object(api_settings, 'JWT_METRICS_STATSD_PORT',
+                                  server.getsockname()[1]):
+            metrics.reset()
+            elapsed = measure(lambda: authenticator.authenticate(request),
+                              number=500)
+            overhead = measure(instrument, number=20000)
+        rows.append((name, '%.1f' % elapsed, '%.2f' % overhead))
+    server.close()
+
+    report('authenticate() with each sink', rows,
+           ('sink', 'authenticate (us)', 'timer + incr (us)'))
+
+
+if __name__ == '__main__':
+    main()
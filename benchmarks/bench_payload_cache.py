@@ -0,0 +1,41 @@
+"""Decode throughput of `get_jwt_value` with and without the payload cache.
+"""
+from datetime import timedelta
+from unittest import mock
+
+from benchmarks.utils import measure, report, setup_django
+
+
+def main():
+    setup_django()
+
+    from django.contrib.auth.models import User
+    from rest_framework.test import APIRequestFactory
+
+    from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+    from jwt_knox.cache import payload_cache
+    from jwt_knox.settings import api_settings
+    from jwt_knox.utils import (jwt_encode_handler, jwt_join_header_and_token,
+                                jwt_payload_handler)
+
+    user = User.objects.create_user(username='bench')
+    token = jwt_encode_handler(
+        jwt_payload_handler(user, 'knox-token', timedelta(hours=1)))
+    request = APIRequestFactory().get(
+        '/', HTTP_AUTHORIZATION=jwt_join_header_and_token(token))
+    authenticator = JSONWebTokenKnoxAuthentication()
+
+    rows = []
+    for size in (0, 1024):
+        with mock.patch.object(api_settings, 'JWT_PAYLOAD_CACHE_SIZE', size):
+            payload_cache.clear()
+            elapsed = measure(lambda: authenticator.get_jwt_value(request),
+                              number=2000)
+        rows.append(('cached' if size else 'uncached', '%.2f' % elapsed,
+                     '%.0f' % (1e6 / elapsed)))
+
+    report('get_jwt_value', rows, ('mode', 'us/call', 'calls/s'))
+
+
+if __name__ == '__main__':
+    main()
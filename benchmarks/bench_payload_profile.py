@@ -0,0 +1,42 @@
+"""Header size and decode time of the default and compact payloads.
+"""
+from datetime import timedelta
+
+from benchmarks.utils import measure, report, setup_django
+
+
+def main():
+    setup_django()
+
+    from django.contrib.auth.models import User
+    from knox.crypto import create_token_string
+
+    from jwt_knox.settings import api_settings
+    from jwt_knox.utils import (jwt_compact_payload_handler,
+                                jwt_decode_handler, jwt_encode_handler,
+                                jwt_join_header_and_token,
+                                jwt_payload_handler)
+
+    user = User.objects.create_user(username='bench.user@example.com')
+    knox_token = create_token_string()
+
+    def decode(token):
+        payload = jwt_decode_handler(token)
+        return (api_settings.JWT_PAYLOAD_GET_USERNAME_HANDLER(payload),
+                api_settings.JWT_PAYLOAD_GET_TOKEN_HANDLER(payload))
+
+    rows = []
+    for name, handler in (('default', jwt_payload_handler),
+                          ('compact', jwt_compact_payload_handler)):
+        token = jwt_encode_handler(
+            handler(user, knox_token, timedelta(hours=1)))
+        assert decode(token) == (user.username, knox_token)
+        elapsed = measure(lambda: decode(token), number=5000)
+        rows.append((name, len(jwt_join_header_and_token(token)),
+                     '%.2f' % elapsed))
+
+    report('payload profiles', rows, ('profile', 'header bytes', 'us/decode'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""Every stage of the authentication pipeline, with query counts.
+
+    python -m benchmarks.bench_pipeline --save baseline.json
+    # ... change something ...
+    python -m benchmarks.bench_pipeline --compare baseline.json
+
+Comparing exits with a non-zero status if a case got slower by more than
+`--threshold` percent, or runs more queries, than in the saved results.
+Timings are only comparable on the same machine.
+"""
+from datetime import timedelta
+from unittest import mock
+
+from benchmarks.utils import (count_queries, finish, measure, measure_each,
+                              parse_args, report, setup_django)
+
+ALGORITHMS = ('HS256', 'RS256', 'ES256', 'EdDSA')
+TOKENS_PER_USER = (1, 100, 1000, 10000)
+
+
+def main():
+    args = parse_args(__doc__.splitlines()[0])
+    setup_django()
+
+    from django.contrib.auth.models import User
+    from django.urls import reverse
+    from django.utils import timezone
+    from knox.models import AuthToken
+    from rest_framework.test import APIClient, APIRequestFactory
+
+    from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+    from jwt_knox.keys import clear_loaded_keys
+    from jwt_knox.settings import api_settings
+    from jwt_knox.utils import (create_auth_token, jwt_decode_handler,
+                                jwt_encode_handler, jwt_join_header_and_token,
+                                jwt_payload_handler)
+    from tests.test_jwt_knox import generate_private_key, private_pem
+
+    results = {}
+
+    def record(name, us, queries=0):
+        results[name] = {'us': us, 'queries': queries}
+
+    user = User.objects.create_user(username='bench', password='secret')
+    authenticator = JSONWebTokenKnoxAuthentication()
+
+    # Issuing
+    record('encode', measure(lambda: jwt_encode_handler(
+        jwt_payload_handler(user, 'x' * 64, timedelta(hours=1)))))
+
+    # Decoding, per algorithm
+    for algorithm in ALGORITHMS:
+        private = None
+        if algorithm != 'HS256':
+            private = private_pem(generate_private_key(algorithm))
+        with mock.patch.object(api_settings, 'JWT_ALGORITHM', algorithm), \
+                mock.patch.object(api_settings, 'JWT_PRIVATE_KEY', private):
+            clear_loaded_keys()
+            token = jwt_encode_handler(
+                jwt_payload_handler(user, 'x' * 64, None))
+            record('decode %s' % algorithm,
+                   measure(lambda: jwt_decode_handler(token)))
+    clear_loaded_keys()
+
+    # Header parsing alone
+    header = jwt_join_header_and_token(create_auth_token(user, None))
+    request = APIRequestFactory().get('/', HTTP_AUTHORIZATION=header)
+    with mock.patch.object(authenticator, 'decode_jwt_value',
+                           lambda jwt_value: jwt_value):
+        record('get_jwt_value (parsing)',
+               measure(lambda: authenticator.get_jwt_value(request),
+                       number=2000))
+
+    # Credentials, against a growing number of sessions
+    AuthToken.objects.all().delete()
+    expiry = timezone.now() + timedelta(hours=1)
+    created = 0
+    for count in TOKENS_PER_USER:
+        AuthToken.objects.bulk_create(
+            [AuthToken(digest='%0128x' % i, token_key='%015x' % i,
+                       user=user, expiry=expiry)
+             for i in range(created, count - 1)], batch_size=5000)
+        created = max(count - 1, created)
+        payload = authenticator.decode_jwt_value(
+            create_auth_token(user, None))
+        record('authenticate_credentials (%d tokens)' % count,
+               measure(lambda: authenticator.authenticate_credentials(
+                   payload)),
+               count_queries(lambda: authenticator.authenticate_credentials(
+                   payload)))
+    AuthToken.objects.all().delete()
+
+    # Endpoints through the test client
+    client = APIClient()
+    login_url = reverse('jwt_knox-get-token')
+    verify_url = reverse('jwt_knox-verify')
+    logout_all_url = reverse('jwt_knox-logout-all')
+
+    def get_token():
+        client.force_authenticate(user=user)
+        client.post(login_url)
+        client.force_authenticate()
+
+    record('get_token endpoint', measure(get_token, number=50),
+           count_queries(get_token))
+
+    client.credentials(HTTP_AUTHORIZATION=jwt_join_header_and_token(
+        create_auth_token(user, None)))
+    record('verify endpoint', measure(lambda: client.post(verify_url),
+                                      number=50),
+           count_queries(lambda: client.post(verify_url)))
+
+    def login():
+        client.credentials(HTTP_AUTHORIZATION=jwt_join_header_and_token(
+            create_auth_token(user, None)))
+
+    login()
+    queries = count_queries(lambda: client.post(logout_all_url))
+    record('logout_all endpoint',
+           measure_each(login, lambda _: client.post(logout_all_url)),
+           queries)
+
+    report('Authentication pipeline',
+           [(name, '%.1f' % result['us'], result['queries'])
+            for name, result in results.items()],
+           ('case', 'per call (us)', 'queries'))
+    finish(args, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Sign and verify throughput per algorithm.
+
+Compares passing PEM material to PyJWT on every call, which parses it
+each time, with the preloaded key objects returned by `jwt_knox.keys`.
+"""
+from unittest import mock
+
+from benchmarks.utils import measure, report, setup_django
+
+ALGORITHMS = ('HS256', 'RS256', 'PS256', 'ES256', 'EdDSA')
+
+
+def main():
+    setup_django()
+
+    import jwt
+
+    from jwt_knox.settings import api_settings
+    from jwt_knox.utils import jwt_decode_handler, jwt_encode_handler
+    from tests.test_jwt_knox import (generate_private_key, private_pem,
+                                     public_pem)
+
+    payload = {'username': 'bench', 'jti': 'x' * 64, 'iat': 0}
+    rows = []
+    for algorithm in ALGORITHMS:
+        if algorithm.startswith('HS'):
+            private, public = api_settings.JWT_SECRET_KEY, None
+            verify_material = private
+        else:
+            key = generate_private_key(algorithm)
+            private, public = private_pem(key), public_pem(key)
+            verify_material = public
+
+        with mock.patch.object(api_settings, 'JWT_ALGORITHM', algorithm), \
+                mock.patch.object(api_settings, 'JWT_PRIVATE_KEY', private), \
+                mock.patch.object(api_settings, 'JWT_PUBLIC_KEY', public):
+            token = jwt_encode_handler(payload)
+            sign_pem = measure(
+                lambda: jwt.encode(payload, private, algorithm), number=50)
+            sign = measure(lambda: jwt_encode_handler(payload), number=50)
+            verify_pem = measure(
+                lambda: jwt.decode(token, verify_material,
+                                   algorithms=[algorithm]), number=50)
+            verify = measure(lambda: jwt_decode_handler(token), number=50)
+
+        rows.append((algorithm,
+                     '%.0f' % (1e6 / sign_pem), '%.0f' % (1e6 / sign),
+                     '%.0f' % (1e6 / verify_pem), '%.0f' % (1e6 / verify)))
+
+    report('Operations per second', rows,
+           ('algorithm', 'sign (pem)', 'sign (loaded)',
+            'verify (pem)', 'verify (loaded)'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""Token lookup latency as the number of sessions per user grows.
+
+`ensure_valid_auth_token` should stay flat regardless of how many knox
+rows the user owns.
+"""
+from benchmarks.utils import measure, report, setup_django
+
+SESSION_COUNTS = (1, 10, 100, 1000, 10000)
+
+
+def add_sessions(user, count):
+    from knox.crypto import create_token_string, hash_token
+    from knox.models import AuthToken
+    from knox.settings import CONSTANTS
+
+    tokens = []
+    for _ in range(count):
+        token = create_token_string()
+        tokens.append(AuthToken(
+            user=user, digest=hash_token(token),
+            token_key=token[:CONSTANTS.TOKEN_KEY_LENGTH]))
+    AuthToken.objects.bulk_create(tokens, batch_size=500)
+
+
+def main():
+    setup_django()
+
+    from django.contrib.auth.models import User
+    from knox.models import AuthToken
+
+    from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+
+    authenticator = JSONWebTokenKnoxAuthentication()
+    user = User.objects.create_user(username='bench')
+    _, token = AuthToken.objects.create(user=user, expiry=None)
+
+    rows = []
+    sessions = 1
+    for count in SESSION_COUNTS:
+        add_sessions(user, count - sessions)
+        sessions = count
+        elapsed = measure(
+            lambda: authenticator.ensure_valid_auth_token(user, token))
+        rows.append((count, '%.1f' % elapsed))
+
+    report('ensure_valid_auth_token', rows, ('sessions', 'us/call'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""One `verify_batch` call against N sequential `verify` calls.
+"""
+from benchmarks.utils import measure, report, setup_django
+
+BATCH_SIZES = (1, 10, 50, 100)
+
+
+def main():
+    setup_django()
+
+    from django.contrib.auth.models import User
+    from django.urls import reverse
+    from rest_framework.test import APIClient
+
+    from jwt_knox.utils import create_auth_token, jwt_join_header_and_token
+
+    verify_url = reverse('jwt_knox-verify')
+    verify_batch_url = reverse('jwt_knox-verify-batch')
+    users = [User.objects.create_user(username='bench%d' % i)
+             for i in range(max(BATCH_SIZES))]
+    tokens = [jwt_join_header_and_token(create_auth_token(user, None))
+              for user in users]
+    gateway = APIClient()
+    gateway.credentials(HTTP_AUTHORIZATION=tokens[0])
+    client = APIClient()
+
+    def sequential(batch):
+        for token in batch:
+            client.credentials(HTTP_AUTHORIZATION=token)
+            client.post(verify_url)
+
+    def batched(batch):
+        gateway.post(verify_batch_url, {'tokens': batch}, format='json')
+
+    rows = []
+    for size in BATCH_SIZES:
+        batch = tokens[:size]
+        sequential_time = measure(lambda: sequential(batch), number=5)
+        batch_time = measure(lambda: batched(batch), number=5)
+        rows.append((size, '%.0f' % sequential_time, '%.0f' % batch_time,
+                     '%.1fx' % (sequential_time / batch_time)))
+
+    report('Verifying N tokens', rows,
+           ('tokens', 'verify x N (us)', 'verify_batch (us)', 'speedup'))
+
+
+if __name__ == '__main__':
+    main()
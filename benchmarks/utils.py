@@ -0,0 +1,157 @@
+"""Shared helpers for the benchmark scripts.
+
+The benchmarks reuse the Django configuration of the test-suite, so they
+can be run from the repository root without any extra settings module:
+
+    python -m benchmarks.bench_token_lookup
+"""
+import argparse
+import json
+import sys
+import time
+import timeit
+import warnings
+
+
+def setup_django(database_name=None):
+    """
+    Configures Django with the test settings and creates the tables.
+
+    Benchmarks that hit the database from several threads should pass a
+    file `database_name`, as every thread gets its own in-memory SQLite
+    database otherwise.
+    """
+    from tests.conftest import pytest_configure
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.test.utils import setup_test_environment
+
+    # The test settings use a short HMAC secret on purpose
+    warnings.filterwarnings('ignore', message='The HMAC key')
+    pytest_configure()
+    if database_name is not None:
+        settings.DATABASES['default']['NAME'] = database_name
+    # Lets the DRF test client reach the views
+    setup_test_environment()
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+
+def measure(func, number=200, repeat=5):
+    """
+    Returns the best per-call time of `func`, in microseconds.
+    """
+    timings = timeit.repeat(func, number=number, repeat=repeat)
+    return min(timings) / number * 1e6
+
+
+def measure_each(setup, func, number=50):
+    """
+    Returns the best time of `func(setup())`, in microseconds, leaving
+    `setup` out of the timing. For calls that consume what they act on.
+    """
+    best = None
+    for _ in range(number):
+        argument = setup()
+        start = time.perf_counter()
+        func(argument)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1e6
+
+
+def count_queries(func):
+    """
+    Returns how many database queries a single call of `func` runs.
+    """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    with CaptureQueriesContext(connection) as queries:
+        func()
+    return len(queries.captured_queries)
+
+
+def parse_args(description):
+    """
+    Parses the options of the benchmarks that support the regression
+    comparison mode.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        '--save', metavar='PATH',
+        help='Write the results to PATH as JSON, to compare against later.')
+    parser.add_argument(
+        '--compare', metavar='PATH',
+        help='Compare the results with the ones saved in PATH.')
+    parser.add_argument(
+        '--threshold', type=float, default=10.0,
+        help='Slowdown, in percent, reported as a regression '
+             '(default: %(default)s).')
+    return parser.parse_args()
+
+
+def save_results(path, results):
+    with open(path, 'w') as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
+
+
+def compare_results(path, results, threshold):
+    """
+    Prints how `results` moved against the ones saved in `path` and
+    returns whether any case got slower by more than `threshold` percent
+    or runs more queries.
+    """
+    with open(path) as baseline_file:
+        baseline = json.load(baseline_file)
+
+    rows = []
+    regressed = False
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            rows.append((name, '-', '%.1f' % result['us'], 'new',
+                         '-', result['queries'], ''))
+            continue
+
+        change = (result['us'] - before['us']) / before['us'] * 100
+        flag = ''
+        if change > threshold:
+            flag = 'SLOWER'
+        elif change < -threshold:
+            flag = 'faster'
+        if result['queries'] > before['queries']:
+            flag = (flag + ' MORE QUERIES').strip()
+        if flag.startswith('SLOWER') or 'MORE QUERIES' in flag:
+            regressed = True
+        rows.append((name, '%.1f' % before['us'], '%.1f' % result['us'],
+                     '%+.1f%%' % change, before['queries'], result['queries'],
+                     flag))
+
+    report('Compared with {0} (threshold {1:g}%)'.format(path, threshold),
+           rows, ('case', 'before (us)', 'after (us)', 'change',
+                  'queries before', 'queries after', ''))
+    return regressed
+
+
+def finish(args, results):
+    """
+    Saves and compares `results` as requested by `args`, and exits with a
+    non-zero status when comparing shows a regression.
+    """
+    if args.save:
+        save_results(args.save, results)
+    if args.compare and compare_results(args.compare, results,
+                                        args.threshold):
+        sys.exit(1)
+
+
+def report(title, rows, headers):
+    print(title)
+    widths = [max(len(str(cell)) for cell in column)
+              for column in zip(headers, *rows)]
+    line = '  '.join('{:>%d}' % width for width in widths)
+    print(line.format(*headers))
+    for row in rows:
+        print(line.format(*row))
+    print()
@@ -0,0 +1,142 @@
+"""Throttled "last used" tracking for knox tokens.
+
+When `JWT_TRACK_LAST_USED` is enabled, every successful authentication
+touches its token, but touches are only buffered in memory: a token is
+scheduled for a write at most once every `JWT_LAST_USED_INTERVAL`
+seconds, and the buffer is flushed to `TokenActivity` in a single bulk
+upsert at most once every `JWT_LAST_USED_FLUSH_INTERVAL` seconds, by
+whichever request comes next.
+
+The buffer is per process, so a token used through several workers may
+be written once per worker and interval, and touches still buffered when
+the process exits are lost. Call `activity_tracker.flush()` on shutdown
+if that matters.
+"""
+import threading
+import time
+
+import django
+from asgiref.sync import sync_to_async
+from django.utils import timezone
+
+from jwt_knox.models import TokenActivity
+from jwt_knox.settings import api_settings
+
+
+class ActivityTracker(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.pending = {}
+        self.written = {}
+        self.flushed_at = 0
+        self.touches = 0
+        self.coalesced = 0
+        self.writes = 0
+        self.flushes = 0
+
+    @property
+    def enabled(self):
+        return api_settings.JWT_TRACK_LAST_USED
+
+    def touch(self, digest):
+        """
+        Records that the token with `digest` was just used, and returns
+        whether the buffer is due to be flushed.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self.touches += 1
+            written = self.written.get(digest)
+            if written is not None and (
+                    now - written < api_settings.JWT_LAST_USED_INTERVAL):
+                self.coalesced += 1
+            else:
+                self.written[digest] = now
+                self.pending[digest] = timezone.now()
+            return bool(self.pending) and (
+                now - self.flushed_at
+                >= api_settings.JWT_LAST_USED_FLUSH_INTERVAL)
+
+    def take_pending(self):
+        """
+        Empties the buffer and returns the `TokenActivity` rows to write.
+        """
+        now = time.monotonic()
+        interval = api_settings.JWT_LAST_USED_INTERVAL
+        with self._lock:
+            pending, self.pending = self.pending, {}
+            self.written = {
+                digest: written for digest, written in self.written.items()
+                if now - written < interval}
+            self.flushed_at = now
+            if pending:
+                self.writes += len(pending)
+                self.flushes += 1
+        return [TokenActivity(digest=digest, last_used=last_used)
+                for digest, last_used in pending.items()]
+
+    def flush(self):
+        """
+        Writes the buffered touches with a single bulk upsert, or an update
+        and an insert before Django 4.1.
+        """
+        activities = self.take_pending()
+        if activities:
+            self.write(activities)
+
+    async def aflush(self):
+        """
+        Asynchronous counterpart of `flush`.
+        """
+        activities = self.take_pending()
+        if not activities:
+            return
+        if django.VERSION < (4, 1):
+            await sync_to_async(self.write)(activities)
+        else:
+            await TokenActivity.objects.abulk_create(
+                activities, update_conflicts=True,
+                update_fields=('last_used', ), unique_fields=('digest', ))
+
+    def write(self, activities):
+        if django.VERSION < (4, 1):
+            # No upsert before Django 4.1: update the rows that exist and
+            # insert the others
+            existing = set(TokenActivity.objects.filter(
+                digest__in=[activity.digest for activity in activities],
+            ).values_list('digest', flat=True))
+            TokenActivity.objects.bulk_update(
+                [activity for activity in activities
+                 if activity.digest in existing], ('last_used', ))
+            TokenActivity.objects.bulk_create(
+                [activity for activity in activities
+                 if activity.digest not in existing], ignore_conflicts=True)
+            return
+
+        TokenActivity.objects.bulk_create(
+            activities, update_conflicts=True,
+            update_fields=('last_used', ), unique_fields=('digest', ))
+
+    def stats(self):
+        """
+        Returns how many touches were recorded, how many of them were
+        coalesced into an earlier write, and how many rows were written in
+        how many flushes.
+        """
+        with self._lock:
+            return {'touches': self.touches, 'coalesced': self.coalesced,
+                    'writes': self.writes, 'flushes': self.flushes}
+
+    def reset(self):
+        with self._lock:
+            self.pending = {}
+            self.written = {}
+            self.flushed_at = 0
+            self.touches = 0
+            self.coalesced = 0
+            self.writes = 0
+            self.flushes = 0
+
+
+activity_tracker = ActivityTracker()
@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class JwtKnoxConfig(AppConfig):
     name = 'jwt_knox'
+
+    def ready(self):
+        from jwt_knox.keys import preload_keys
+
+        preload_keys()
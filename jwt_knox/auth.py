@@ -1,19 +1,59 @@
+import asyncio
+from hmac import compare_digest
+
+import django
 import jwt
+from asgiref.sync import sync_to_async
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import router
 from django.utils import timezone
-from django.utils.encoding import smart_str
 from django.utils.translation import gettext as _
-from knox.crypto import hash_token
 from knox.models import AuthToken
+from knox.settings import CONSTANTS
 from rest_framework import exceptions
 from rest_framework.authentication import (BaseAuthentication,
                                            get_authorization_header)
 
+from jwt_knox.activity import activity_tracker
+from jwt_knox.cache import payload_cache, token_cache
+from jwt_knox.metrics import metrics
+from jwt_knox.models import RevocationWatermark, is_issued_before
 from jwt_knox.settings import api_settings
+from jwt_knox.utils import get_token_digest, get_username
+
+
+def parse_authorization_header(header, prefix, max_length=None):
+    """
+    Returns the credentials of the raw `Authorization` `header` if its
+    scheme is the lowercased `prefix` (bytes), or None if it is another
+    scheme. Credentials longer than `max_length` are rejected before they
+    get decoded.
+
+    Splitting stops after the third part, and only a first part of the
+    prefix's length gets lowercased, so a large header of another scheme
+    costs a single scan.
+    """
+    parts = header.split(None, 2)
+    if not parts or len(parts[0]) != len(prefix) or (
+            parts[0].lower() != prefix):
+        return None
 
-jwt_decode_handler = api_settings.JWT_DECODE_HANDLER
-jwt_get_username_from_payload = api_settings.JWT_PAYLOAD_GET_USERNAME_HANDLER
-jwt_get_knox_token_from_payload = api_settings.JWT_PAYLOAD_GET_TOKEN_HANDLER
+    if len(parts) == 1:
+        msg = _('Invalid Authorization header. No credentials provided.')
+        raise exceptions.AuthenticationFailed(msg, code='invalid_header')
+    elif len(parts) > 2:
+        msg = _('Invalid Authorization header. Credentials string '
+                'should contain no spaces.')
+        raise exceptions.AuthenticationFailed(msg, code='invalid_header')
+
+    credentials = parts[1]
+    if max_length is not None and len(credentials) > max_length:
+        msg = _('Invalid Authorization header. Credentials string '
+                'is too long.')
+        raise exceptions.AuthenticationFailed(msg, code='invalid_header')
+
+    return credentials
 
 
 class BaseJWTTAuthentication(BaseAuthentication):
@@ -27,11 +67,51 @@ class BaseJWTTAuthentication(BaseAuthentication):
         supplied and the underlying token exists on the database. Otherwise
         returns None.
         """
-        decoded_token = self.get_jwt_value(request)
-        if decoded_token is None:
-            return None
+        try:
+            decoded_token = self.get_jwt_value(request)
+            if decoded_token is None:
+                return None
+
+            (user, auth_token) = self.authenticate_credentials(decoded_token)
+        except exceptions.AuthenticationFailed as exc:
+            self.count_failure(exc)
+            raise
 
-        (user, auth_token) = self.authenticate_credentials(decoded_token)
+        metrics.incr('authentications_total')
+        if auth_token is not None and activity_tracker.enabled:
+            if activity_tracker.touch(auth_token.digest):
+                activity_tracker.flush()
+
+        return (user, (decoded_token, auth_token))
+
+    def count_failure(self, exc):
+        """
+        Counts the failed authentication `exc` by its code.
+        """
+        metrics.incr('auth_failures_total', reason=exc.get_codes())
+
+    async def aauthenticate(self, request):
+        """
+        Asynchronous counterpart of `authenticate`, for ASGI deployments.
+        The user and token lookups go through Django's async ORM instead of
+        being pushed to a worker thread, which Django 4.1 or later is needed
+        for. Older versions run `authenticate_credentials` in a thread.
+        """
+        try:
+            decoded_token = self.get_jwt_value(request)
+            if decoded_token is None:
+                return None
+
+            (user, auth_token) = await self.aauthenticate_credentials(
+                decoded_token)
+        except exceptions.AuthenticationFailed as exc:
+            self.count_failure(exc)
+            raise
+
+        metrics.incr('authentications_total')
+        if auth_token is not None and activity_tracker.enabled:
+            if activity_tracker.touch(auth_token.digest):
+                await activity_tracker.aflush()
 
         return (user, (decoded_token, auth_token))
 
@@ -40,36 +120,365 @@ class BaseJWTTAuthentication(BaseAuthentication):
         Returns an active user that matches the payload's user id and token.
         """
         User = get_user_model()
-        username = jwt_get_username_from_payload(payload)
-        token = jwt_get_knox_token_from_payload(payload)
+        username = api_settings.JWT_PAYLOAD_GET_USERNAME_HANDLER(payload)
+        token = api_settings.JWT_PAYLOAD_GET_TOKEN_HANDLER(payload)
+
+        if not username or not token:
+            msg = _('Invalid payload.')
+            raise exceptions.AuthenticationFailed(msg, code='invalid_payload')
+
+        if api_settings.JWT_SELECT_RELATED_USER:
+            with metrics.timer('token_lookup_seconds'):
+                (user, auth_token) = self.authenticate_token_with_user(
+                    username, token)
+        else:
+            try:
+                with metrics.timer('user_lookup_seconds'):
+                    user = self.get_user(username)
+            except User.DoesNotExist:
+                msg = _('Invalid signature.')
+                raise exceptions.AuthenticationFailed(msg, code='unknown_user')
+
+            if not user.is_active:
+                msg = _('User inactive or deleted.')
+                raise exceptions.AuthenticationFailed(msg, code='inactive_user')
+
+            with metrics.timer('token_lookup_seconds'):
+                auth_token = self.ensure_valid_auth_token(user, token)
+
+        if api_settings.JWT_LOGOUT_WATERMARK:
+            self.check_watermark(
+                self.get_watermark(user), auth_token, payload.get('iat'))
+
+        if api_settings.JWT_READ_DATABASE is not None:
+            self.pin_to_primary(user, auth_token)
+        return (user, auth_token)
+
+    async def aauthenticate_credentials(self, payload):
+        """
+        Asynchronous counterpart of `authenticate_credentials`.
+        """
+        if django.VERSION < (4, 1):
+            return await sync_to_async(self.authenticate_credentials)(payload)
+
+        User = get_user_model()
+        username = api_settings.JWT_PAYLOAD_GET_USERNAME_HANDLER(payload)
+        token = api_settings.JWT_PAYLOAD_GET_TOKEN_HANDLER(payload)
 
         if not username or not token:
             msg = _('Invalid payload.')
-            raise exceptions.AuthenticationFailed(msg)
+            raise exceptions.AuthenticationFailed(msg, code='invalid_payload')
+
+        if api_settings.JWT_SELECT_RELATED_USER:
+            with metrics.timer('token_lookup_seconds'):
+                (user, auth_token) = await self.aauthenticate_token_with_user(
+                    username, token)
+        else:
+            try:
+                with metrics.timer('user_lookup_seconds'):
+                    user = await self.aget_user(username)
+            except User.DoesNotExist:
+                msg = _('Invalid signature.')
+                raise exceptions.AuthenticationFailed(msg, code='unknown_user')
+
+            if not user.is_active:
+                msg = _('User inactive or deleted.')
+                raise exceptions.AuthenticationFailed(msg, code='inactive_user')
+
+            with metrics.timer('token_lookup_seconds'):
+                auth_token = await self.aensure_valid_auth_token(user, token)
+
+        if api_settings.JWT_LOGOUT_WATERMARK:
+            self.check_watermark(
+                await self.aget_watermark(user), auth_token,
+                payload.get('iat'))
+
+        if api_settings.JWT_READ_DATABASE is not None:
+            self.pin_to_primary(user, auth_token)
+        return (user, auth_token)
+
+    def get_user(self, username):
+        """
+        Returns the user called `username`, read from `JWT_READ_DATABASE` if
+        set. Users not replicated there yet are looked up on the primary.
+        """
+        User = get_user_model()
+        alias = api_settings.JWT_READ_DATABASE
+        if alias is None:
+            return User.objects.get_by_natural_key(username)
+
+        try:
+            return User.objects.db_manager(alias).get_by_natural_key(username)
+        except User.DoesNotExist:
+            return User.objects.db_manager(
+                router.db_for_write(User)).get_by_natural_key(username)
+
+    async def aget_user(self, username):
+        """
+        Asynchronous counterpart of `get_user`.
+        """
+        User = get_user_model()
+        alias = api_settings.JWT_READ_DATABASE
+        if alias is None:
+            return await self.aget_by_natural_key(User.objects, username)
 
         try:
-            user = User.objects.get_by_natural_key(username)
+            return await self.aget_by_natural_key(
+                User.objects.db_manager(alias), username)
         except User.DoesNotExist:
+            return await self.aget_by_natural_key(
+                User.objects.db_manager(router.db_for_write(User)), username)
+
+    async def aget_by_natural_key(self, manager, username):
+        """
+        Looks `username` up with `manager.get_by_natural_key`, or its async
+        counterpart on Django versions providing one.
+        """
+        if hasattr(manager, 'aget_by_natural_key'):
+            return await manager.aget_by_natural_key(username)
+        return await sync_to_async(manager.get_by_natural_key)(username)
+
+    def pin_to_primary(self, *instances):
+        """
+        Makes the writes to `instances`, which may have been read from the
+        replica, go to the primary. Django would otherwise send them to the
+        database they were read from.
+        """
+        for instance in instances:
+            instance._state.db = router.db_for_write(type(instance))
+
+    def authenticate_token_with_user(self, username, token: str):
+        """
+        Returns the user and `AuthToken` matching the raw knox `token`,
+        fetched together in a single query, after checking that the token
+        belongs to `username`.
+        """
+        digest = self.get_token_digest(token)
+        auth_token = self.lookup_auth_token(
+            self.get_related_queryset(), token, digest)
+        return self.check_token_owner(username, auth_token)
+
+    async def aauthenticate_token_with_user(self, username, token: str):
+        """
+        Asynchronous counterpart of `authenticate_token_with_user`.
+        """
+        digest = self.get_token_digest(token)
+        auth_token = await self.alookup_auth_token(
+            self.get_related_queryset(), token, digest)
+        return self.check_token_owner(username, auth_token)
+
+    def get_related_queryset(self):
+        """
+        Returns the `AuthToken` queryset that also fetches the token's user
+        and, in watermark mode, the user's watermark.
+        """
+        if api_settings.JWT_LOGOUT_WATERMARK:
+            return AuthToken.objects.select_related(
+                'user', 'user__jwt_knox_watermark')
+        return AuthToken.objects.select_related('user')
+
+    def get_watermark(self, user):
+        try:
+            return user.jwt_knox_watermark
+        except ObjectDoesNotExist:
+            return None
+
+    async def aget_watermark(self, user):
+        if RevocationWatermark.user.field.remote_field.is_cached(user):
+            return self.get_watermark(user)
+        return await RevocationWatermark.objects.filter(user=user).afirst()
+
+    def check_watermark(self, watermark, auth_token, issued_at):
+        """
+        Rejects `auth_token` if it was issued before the user's logout
+        watermark, unless it is the token the watermark keeps.
+        """
+        if watermark is None or watermark.keep_digest == auth_token.digest:
+            return
+
+        if is_issued_before(watermark.revoked_before, issued_at,
+                            lambda: auth_token.created):
+            msg = _('Invalid token.')
+            raise exceptions.AuthenticationFailed(msg, code='revoked_token')
+
+    def check_token_owner(self, username, auth_token):
+        """
+        Returns the user and `AuthToken` once `auth_token` has been checked
+        to exist and belong to the active user called `username`.
+        """
+        if auth_token is None:
+            msg = _('Invalid token.')
+            raise exceptions.AuthenticationFailed(msg, code='unknown_token')
+
+        user = auth_token.user
+        if get_username(user) != username:
             msg = _('Invalid signature.')
-            raise exceptions.AuthenticationFailed(msg)
+            raise exceptions.AuthenticationFailed(msg, code='unknown_user')
 
         if not user.is_active:
             msg = _('User inactive or deleted.')
-            raise exceptions.AuthenticationFailed(msg)
+            raise exceptions.AuthenticationFailed(msg, code='inactive_user')
+
+        return (user, auth_token)
 
-        return (user, self.ensure_valid_auth_token(user, token))
+    def ensure_valid_auth_token(self, user, token: str):
+        """
+        Returns the `AuthToken` of `user` matching the raw knox `token`.
+        """
+        digest = self.get_token_digest(token)
 
-    def ensure_valid_auth_token(self, user, token: AuthToken):
-        for auth_token in AuthToken.objects.filter(user=user):
-            if auth_token.expiry is not None and auth_token.expiry < timezone.now():
-                auth_token.delete()
-                continue
-            digest = hash_token(token)
-            if digest == auth_token.digest:
+        if token_cache.enabled:
+            auth_token = self.get_cached_auth_token(user, digest)
+            if auth_token is not None:
                 return auth_token
 
-        msg = _('Invalid token.')
-        raise exceptions.AuthenticationFailed(msg)
+        auth_token = self.lookup_auth_token(AuthToken.objects, token, digest)
+        if auth_token is None or auth_token.user_id != user.pk:
+            msg = _('Invalid token.')
+            raise exceptions.AuthenticationFailed(msg, code='unknown_token')
+
+        if token_cache.enabled:
+            token_cache.set(auth_token)
+        return auth_token
+
+    async def aensure_valid_auth_token(self, user, token: str):
+        """
+        Asynchronous counterpart of `ensure_valid_auth_token`.
+        """
+        digest = self.get_token_digest(token)
+
+        if token_cache.enabled:
+            auth_token = self.build_cached_auth_token(
+                user, await token_cache.aget(digest))
+            if auth_token is not None:
+                return auth_token
+
+        auth_token = await self.alookup_auth_token(
+            AuthToken.objects, token, digest)
+        if auth_token is None or auth_token.user_id != user.pk:
+            msg = _('Invalid token.')
+            raise exceptions.AuthenticationFailed(msg, code='unknown_token')
+
+        if token_cache.enabled:
+            await token_cache.aset(auth_token)
+        return auth_token
+
+    def get_token_digest(self, token: str):
+        """
+        Returns the knox digest of the raw `token`.
+        """
+        digest = get_token_digest(token)
+        if digest is None:
+            msg = _('Invalid token.')
+            raise exceptions.AuthenticationFailed(
+                msg, code='invalid_payload')
+        return digest
+
+    def lookup_auth_token(self, queryset, token: str, digest: str):
+        """
+        Runs `find_auth_token` on `JWT_READ_DATABASE` if set, and again on
+        the primary if the token is not there, as it may not have been
+        replicated yet.
+        """
+        alias = api_settings.JWT_READ_DATABASE
+        if alias is None:
+            return self.find_auth_token(queryset, token, digest)
+
+        auth_token = self.find_auth_token(queryset.using(alias), token, digest)
+        if auth_token is None:
+            auth_token = self.find_auth_token(
+                queryset.using(router.db_for_write(queryset.model)),
+                token, digest)
+        return auth_token
+
+    async def alookup_auth_token(self, queryset, token: str, digest: str):
+        """
+        Asynchronous counterpart of `lookup_auth_token`.
+        """
+        alias = api_settings.JWT_READ_DATABASE
+        if alias is None:
+            return await self.afind_auth_token(queryset, token, digest)
+
+        auth_token = await self.afind_auth_token(
+            queryset.using(alias), token, digest)
+        if auth_token is None:
+            auth_token = await self.afind_auth_token(
+                queryset.using(router.db_for_write(queryset.model)),
+                token, digest)
+        return auth_token
+
+    def find_auth_token(self, queryset, token: str, digest: str):
+        """
+        Returns the unexpired `AuthToken` in `queryset` matching `token`, or
+        None.
+
+        Only the row matching the indexed `token_key` prefix and digest is
+        fetched, so the cost does not grow with the number of sessions the
+        user has open.
+        """
+        candidates = queryset.filter(
+            token_key=token[:CONSTANTS.TOKEN_KEY_LENGTH], digest=digest)
+        scanned = 0
+        for auth_token in candidates:
+            scanned += 1
+            if self.is_matching_auth_token(auth_token, digest):
+                metrics.observe('tokens_scanned', scanned)
+                return auth_token
+
+        metrics.observe('tokens_scanned', scanned)
+        return None
+
+    async def afind_auth_token(self, queryset, token: str, digest: str):
+        """
+        Asynchronous counterpart of `find_auth_token`.
+        """
+        candidates = queryset.filter(
+            token_key=token[:CONSTANTS.TOKEN_KEY_LENGTH], digest=digest)
+        scanned = 0
+        async for auth_token in candidates:
+            scanned += 1
+            if self.is_matching_auth_token(auth_token, digest):
+                metrics.observe('tokens_scanned', scanned)
+                return auth_token
+
+        metrics.observe('tokens_scanned', scanned)
+        return None
+
+    def is_matching_auth_token(self, auth_token, digest: str):
+        if auth_token.expiry is not None and auth_token.expiry < timezone.now():
+            # Expired rows are left for `purge_expired_tokens`
+            return False
+        return compare_digest(digest, auth_token.digest)
+
+    def get_cached_auth_token(self, user, digest):
+        """
+        Returns an `AuthToken` rebuilt from the token cache without touching
+        the database, or None if there is no usable entry for `digest`.
+        """
+        return self.build_cached_auth_token(user, token_cache.get(digest))
+
+    def build_cached_auth_token(self, user, entry):
+        if entry is None:
+            return None
+
+        user_id, pk, expiry, created = entry
+        if user_id != user.pk:
+            return None
+        if expiry is not None and expiry < timezone.now():
+            return None
+
+        # `created` is needed by the watermark check, and loading a deferred
+        # field would query the database, which async code cannot do.
+        # `from_db` takes the values in the order of the model's fields
+        values = {'digest': pk, 'user_id': user_id, 'created': created,
+                  'expiry': expiry}
+        field_names = [field.attname
+                       for field in AuthToken._meta.concrete_fields
+                       if field.attname in values]
+        auth_token = AuthToken.from_db(
+            None, field_names, [values[name] for name in field_names])
+        auth_token.user = user
+        return auth_token
 
 
 class JSONWebTokenKnoxAuthentication(BaseJWTTAuthentication):
@@ -80,37 +489,92 @@ class JSONWebTokenKnoxAuthentication(BaseJWTTAuthentication):
       Authorization: Bearer abc.def.ghi
     """
     www_authenticate_realm = 'api'
+    # Holds no per-request state, so one instance can serve every request.
+    # Not inherited: subclasses must set it themselves
+    reusable = True
 
     def get_jwt_value(self, request):
-        auth = get_authorization_header(request).split()
-        auth_header_prefix = api_settings.JWT_AUTH_HEADER_PREFIX.lower()
-
-        if not auth or smart_str(auth[0].lower()) != auth_header_prefix:
+        jwt_value = parse_authorization_header(
+            get_authorization_header(request), api_settings.auth_header_prefix,
+            api_settings.JWT_AUTH_HEADER_MAX_LENGTH)
+        if jwt_value is None:
             return None
 
-        if len(auth) == 1:
-            msg = _('Invalid Authorization header. No credentials provided.')
-            raise exceptions.AuthenticationFailed(msg)
-        elif len(auth) > 2:
-            msg = _('Invalid Authorization header. Credentials string '
-                    'should contain no spaces.')
-            raise exceptions.AuthenticationFailed(msg)
+        return self.decode_jwt_value(jwt_value)
 
-        jwt_value = auth[1]
+    def decode_jwt_value(self, jwt_value):
+        """
+        Returns the verified payload of the raw `jwt_value`.
+        """
+        if payload_cache.enabled:
+            payload = payload_cache.get(jwt_value)
+            if payload is not None:
+                return payload
 
         try:
-            payload = jwt_decode_handler(jwt_value)
+            with metrics.timer('decode_seconds'):
+                payload = api_settings.JWT_DECODE_HANDLER(jwt_value)
         except jwt.ExpiredSignatureError:
             msg = _('Signature has expired.')
-            raise exceptions.AuthenticationFailed(msg)
+            raise exceptions.AuthenticationFailed(msg, code='expired')
         except jwt.DecodeError:
             msg = _('Error decoding signature.')
-            raise exceptions.AuthenticationFailed(msg)
+            raise exceptions.AuthenticationFailed(msg, code='decode_error')
         except jwt.InvalidTokenError:
-            raise exceptions.AuthenticationFailed()
+            raise exceptions.AuthenticationFailed(code='invalid_claims')
+
+        if payload_cache.enabled:
+            payload_cache.set(jwt_value, payload)
 
         return payload
 
+    def authenticate_batch(self, jwt_values):
+        """
+        Returns a list with a `(user, auth_token)` pair for each valid token
+        of `jwt_values` and None for each invalid one.
+
+        All the tokens are decoded first, and their knox rows are then
+        fetched along with their users in a single query.
+        """
+        digests = []
+        for jwt_value in jwt_values:
+            try:
+                payload = self.decode_jwt_value(jwt_value)
+                username = api_settings.JWT_PAYLOAD_GET_USERNAME_HANDLER(
+                    payload)
+                token = api_settings.JWT_PAYLOAD_GET_TOKEN_HANDLER(payload)
+                if not username or not token:
+                    raise exceptions.AuthenticationFailed(
+                        code='invalid_payload')
+                digests.append(
+                    (payload, username, self.get_token_digest(token)))
+            except exceptions.AuthenticationFailed:
+                digests.append(None)
+
+        auth_tokens = self.get_related_queryset().in_bulk(
+            [entry[2] for entry in digests if entry is not None])
+
+        results = []
+        for entry in digests:
+            result = None
+            if entry is not None:
+                payload, username, digest = entry
+                auth_token = auth_tokens.get(digest)
+                if auth_token is not None and not self.is_matching_auth_token(
+                        auth_token, digest):
+                    auth_token = None
+                try:
+                    result = self.check_token_owner(username, auth_token)
+                    if api_settings.JWT_LOGOUT_WATERMARK:
+                        self.check_watermark(
+                            self.get_watermark(result[0]), result[1],
+                            payload.get('iat'))
+                except exceptions.AuthenticationFailed:
+                    result = None
+            results.append(result)
+
+        return results
+
     def authenticate_header(self, request):
         """
         Return a string to be used as the value of WWW-Authenticate
@@ -120,3 +584,79 @@ class JSONWebTokenKnoxAuthentication(BaseJWTTAuthentication):
 
         return '{0} realm="{1}"'.format(api_settings.JWT_AUTH_HEADER_PREFIX,
                                         self.www_authenticate_realm)
+
+
+class TokenUser(object):
+    """
+    A user built from the JWT claims alone, without querying the database.
+    """
+    is_active = True
+    is_authenticated = True
+    is_anonymous = False
+    is_staff = False
+    is_superuser = False
+
+    def __init__(self, username, payload):
+        self.username = username
+        self.payload = payload
+        self.pk = self.id = payload.get('user_id')
+
+    def __str__(self):
+        return self.username
+
+    def get_username(self):
+        return self.username
+
+
+class StatelessJSONWebTokenAuthentication(JSONWebTokenKnoxAuthentication):
+    """
+    Verifies the JWT signature and claims without looking up the user or
+    the knox token, for downstream services that verify tokens locally
+    with the keys published by the `jwks` endpoint.
+
+    Revoked tokens are only rejected if `JWT_REVOCATION_CHECK_HANDLER` is
+    set: it is called with the payload and returns whether the token has
+    been revoked. `request.user` is a `TokenUser` and `request.auth` is
+    `(payload, None)`.
+    """
+    reusable = True
+
+    def authenticate_credentials(self, payload):
+        user = self.get_token_user(payload)
+
+        is_revoked = api_settings.JWT_REVOCATION_CHECK_HANDLER
+        if is_revoked is not None and is_revoked(payload):
+            self.reject_revoked()
+
+        return (user, None)
+
+    async def aauthenticate_credentials(self, payload):
+        """
+        Asynchronous counterpart of `authenticate_credentials`. The
+        `JWT_REVOCATION_CHECK_HANDLER` may be a coroutine function, and is
+        otherwise run in a thread, since it may query the database.
+        """
+        user = self.get_token_user(payload)
+
+        is_revoked = api_settings.JWT_REVOCATION_CHECK_HANDLER
+        if is_revoked is not None:
+            if not asyncio.iscoroutinefunction(is_revoked):
+                is_revoked = sync_to_async(is_revoked)
+            if await is_revoked(payload):
+                self.reject_revoked()
+
+        return (user, None)
+
+    def get_token_user(self, payload):
+        username = api_settings.JWT_PAYLOAD_GET_USERNAME_HANDLER(payload)
+        token = api_settings.JWT_PAYLOAD_GET_TOKEN_HANDLER(payload)
+
+        if not username or not token:
+            msg = _('Invalid payload.')
+            raise exceptions.AuthenticationFailed(msg, code='invalid_payload')
+
+        return TokenUser(username, payload)
+
+    def reject_revoked(self):
+        msg = _('Invalid token.')
+        raise exceptions.AuthenticationFailed(msg, code='revoked_token')
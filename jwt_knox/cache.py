@@ -0,0 +1,198 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.utils import timezone
+
+from jwt_knox.keys import get_retire_at
+from jwt_knox.settings import api_settings
+from jwt_knox.utils import jwt_get_kid
+
+
+class TokenCache(object):
+    """
+    Caches the resolution of knox tokens, keyed by their digest.
+
+    Each entry holds the `(user id, token pk, expiry, created)` of a valid
+    token, so that authenticating with it again does not need to query the
+    `AuthToken` table. The cache is only used when `JWT_KNOX_CACHE` names
+    one of Django's `CACHES`; entries live at most `JWT_KNOX_CACHE_TTL`
+    seconds and never past the token's expiry.
+    """
+    key_prefix = 'jwt_knox:token:'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return api_settings.JWT_KNOX_CACHE is not None
+
+    @property
+    def backend(self):
+        return caches[api_settings.JWT_KNOX_CACHE]
+
+    def make_key(self, digest):
+        return self.key_prefix + digest
+
+    def get(self, digest):
+        return self.count(self.backend.get(self.make_key(digest)))
+
+    async def aget(self, digest):
+        return self.count(await self.backend.aget(self.make_key(digest)))
+
+    def count(self, entry):
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    def set(self, auth_token):
+        timeout = self.get_timeout(auth_token)
+        if timeout > 0:
+            self.backend.set(self.make_key(auth_token.digest),
+                             self.make_entry(auth_token), timeout)
+
+    async def aset(self, auth_token):
+        timeout = self.get_timeout(auth_token)
+        if timeout > 0:
+            await self.backend.aset(self.make_key(auth_token.digest),
+                                    self.make_entry(auth_token), timeout)
+
+    def get_timeout(self, auth_token):
+        timeout = api_settings.JWT_KNOX_CACHE_TTL
+        if auth_token.expiry is not None:
+            remaining = (auth_token.expiry - timezone.now()).total_seconds()
+            timeout = min(timeout, int(remaining))
+        return timeout
+
+    def make_entry(self, auth_token):
+        return (auth_token.user_id, auth_token.pk, auth_token.expiry,
+                auth_token.created)
+
+    def delete_many(self, digests):
+        keys = [self.make_key(digest) for digest in digests]
+        if keys:
+            self.backend.delete_many(keys)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+
+token_cache = TokenCache()
+
+
+class PayloadCache(object):
+    """
+    Bounded, thread-safe LRU of verified JWT payloads.
+
+    Entries are keyed by a hash of the raw token, so repeated requests with
+    the same token skip the signature check and JSON parsing. An entry is
+    dropped once the token gets within `JWT_LEEWAY` seconds of its `exp`,
+    when the key it was signed with is retired, or when any of the settings
+    its verification depended on changes. The
+    cache holds at most `JWT_PAYLOAD_CACHE_SIZE` entries and is disabled
+    when that setting is 0.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return api_settings.JWT_PAYLOAD_CACHE_SIZE > 0
+
+    def make_key(self, jwt_value):
+        if isinstance(jwt_value, str):
+            jwt_value = jwt_value.encode('utf-8')
+        return hashlib.sha256(jwt_value).digest()
+
+    def get_context(self):
+        """
+        Returns the settings a cached payload was verified against.
+        """
+        return (
+            api_settings.JWT_DECODE_HANDLER,
+            api_settings.JWT_SECRET_KEY,
+            api_settings.JWT_PUBLIC_KEY,
+            api_settings.JWT_PRIVATE_KEY,
+            api_settings.JWT_ALGORITHM,
+            api_settings.JWT_KEYRING,
+            api_settings.JWT_AUDIENCE,
+            api_settings.JWT_ISSUER,
+        )
+
+    def get(self, jwt_value):
+        key = self.make_key(jwt_value)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                payload, exp, retire_at, context = entry
+                if (self.is_stale(exp)
+                        or (retire_at is not None and retire_at <= timezone.now())
+                        or context != self.get_context()):
+                    del self._entries[key]
+                    entry = None
+                else:
+                    self._entries.move_to_end(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return dict(payload)
+
+    def is_stale(self, exp):
+        if exp is None:
+            return False
+        return exp - api_settings.JWT_LEEWAY <= time.time()
+
+    def set(self, jwt_value, payload):
+        exp = None
+        if 'exp' in payload:
+            try:
+                exp = int(payload['exp'])
+            except (TypeError, ValueError):
+                return
+            if self.is_stale(exp):
+                return
+
+        retire_at = get_retire_at(jwt_get_kid(jwt_value))
+        key = self.make_key(jwt_value)
+        entry = (dict(payload), exp, retire_at, self.get_context())
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > api_settings.JWT_PAYLOAD_CACHE_SIZE:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._entries)}
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+
+payload_cache = PayloadCache()
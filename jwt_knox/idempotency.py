@@ -0,0 +1,155 @@
+"""Idempotent logins.
+
+When `JWT_IDEMPOTENCY_CACHE` names one of Django's `CACHES`, `get_token`
+requests carrying an `Idempotency-Key` header are coalesced before the
+login authentication classes run: the first request with a given key and
+`Authorization` header logs in and issues the token, and the duplicates
+received within `JWT_IDEMPOTENCY_TTL` seconds get the same knox token back
+in a new web token, without checking the password again nor inserting
+another row. Duplicates arriving in the same process while the first
+request is still in flight wait up to `JWT_IDEMPOTENCY_WAIT` seconds for
+it. Those arriving in other processes meanwhile log in on their own.
+
+Only logins decided by the `Authorization` header alone are coalesced:
+the first login authentication class must be one of
+`header_authenticators`, and the header must use its scheme.
+
+The knox token is derived from an HMAC of both headers and a random
+nonce, so the cache only holds the username and the nonce, which are of
+no use without the credentials. Before a duplicate gets the token back,
+it is checked like the token of any request: it must still exist and
+belong to an active user, and must not be behind the user's logout
+watermark. A password change within the TTL does not reject the
+duplicates, though.
+"""
+import secrets
+import threading
+
+from django.core.cache import caches
+from django.core.exceptions import ObjectDoesNotExist
+from django.utils.crypto import salted_hmac
+from knox.settings import knox_settings
+from rest_framework import exceptions
+from rest_framework.authentication import BasicAuthentication
+
+from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+from jwt_knox.settings import api_settings
+from jwt_knox.utils import (encode_auth_token, get_token_prefix,
+                            get_username)
+
+
+class LoginCoalescer(object):
+    key_prefix = 'jwt_knox:login:'
+    header = 'Idempotency-Key'
+    # Login authentication classes that authenticate a request carrying
+    # their scheme in the `Authorization` header or reject it
+    header_authenticators = (BasicAuthentication, )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Cache key -> event set once the login in flight here is done
+        self._in_flight = {}
+        self.coalesced = 0
+
+    @property
+    def enabled(self):
+        return api_settings.JWT_IDEMPOTENCY_CACHE is not None
+
+    @property
+    def backend(self):
+        return caches[api_settings.JWT_IDEMPOTENCY_CACHE]
+
+    def get_credentials(self, request, authenticators):
+        """
+        Returns the idempotency key and `Authorization` header of the login
+        `request`, or None if it lacks either or `authenticators` may not
+        decide the login on that header alone.
+        """
+        idempotency_key = request.headers.get(self.header)
+        authorization = request.META.get('HTTP_AUTHORIZATION')
+        if not idempotency_key or not authorization or not authenticators:
+            return None
+        if not isinstance(authenticators[0], self.header_authenticators):
+            return None
+        scheme = authenticators[0].authenticate_header(request).split()[0]
+        if authorization.split()[0].lower() != scheme.lower():
+            return None
+        return '\0'.join((idempotency_key, authorization))
+
+    def make_key(self, credentials):
+        return self.key_prefix + salted_hmac(
+            self.key_prefix + 'key', credentials,
+            algorithm='sha256').hexdigest()
+
+    def make_token(self, credentials, nonce):
+        """
+        Returns the raw knox token issued for `credentials` with `nonce`.
+        """
+        secret = salted_hmac(
+            self.key_prefix + 'token', '\0'.join((credentials, nonce)),
+            algorithm='sha512').hexdigest()
+        return (get_token_prefix() +
+                secret[:knox_settings.AUTH_TOKEN_CHARACTER_LENGTH])
+
+    def make_nonce(self):
+        return secrets.token_hex(16)
+
+    def claim(self, key):
+        """
+        Returns `(entry, leader)`. `entry` is the `(username, nonce)` the
+        token was issued with for `key`, once any login for it in flight in
+        this process is done, or None. `leader` tells whether the caller
+        is the one in flight, and must `release` `key` once done.
+        """
+        with self._lock:
+            event = self._in_flight.get(key)
+            if event is None:
+                self._in_flight[key] = threading.Event()
+        if event is not None:
+            event.wait(api_settings.JWT_IDEMPOTENCY_WAIT)
+        return (self.backend.get(key), event is None)
+
+    def complete(self, key, user, nonce):
+        self.backend.set(key, (get_username(user), nonce),
+                         api_settings.JWT_IDEMPOTENCY_TTL)
+
+    def release(self, key):
+        with self._lock:
+            event = self._in_flight.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def replay(self, credentials, entry):
+        """
+        Returns the user and a new web token for the knox token issued for
+        `credentials` with the `(username, nonce)` `entry`, or None if that
+        token is no longer valid.
+        """
+        username, nonce = entry
+        token = self.make_token(credentials, nonce)
+        authenticator = JSONWebTokenKnoxAuthentication()
+        try:
+            user = authenticator.get_user(username)
+            if not user.is_active:
+                return None
+            auth_token = authenticator.ensure_valid_auth_token(user, token)
+            if api_settings.JWT_LOGOUT_WATERMARK:
+                authenticator.check_watermark(
+                    authenticator.get_watermark(user), auth_token, None)
+        except (ObjectDoesNotExist, exceptions.AuthenticationFailed):
+            return None
+
+        with self._lock:
+            self.coalesced += 1
+        return (user, encode_auth_token(user, auth_token, token))
+
+    def stats(self):
+        with self._lock:
+            return {'coalesced': self.coalesced}
+
+    def reset_stats(self):
+        with self._lock:
+            self.coalesced = 0
+
+
+login_coalescer = LoginCoalescer()
@@ -0,0 +1,256 @@
+"""Signing and verification keys for the configured `JWT_ALGORITHM`.
+
+HMAC algorithms use `JWT_SECRET_KEY` as is. The asymmetric ones (RSA,
+RSA-PSS, ECDSA and EdDSA) read PEM material from `JWT_PRIVATE_KEY` and
+`JWT_PUBLIC_KEY`, either as `str`/`bytes` or as a path to a PEM file. The
+PEM material is parsed once into a `cryptography` key object and reused,
+since parsing it on each call is a measurable part of the signing and
+verification cost.
+
+Keys can be rotated through `JWT_KEYRING`, which maps key ids (`kid`) to
+keys. Tokens are signed with `JWT_ACTIVE_KID` and carry it in their
+header, so verification picks the right key with a single lookup.
+Tokens without a `kid` keep being verified with the top-level settings,
+until `JWT_KIDLESS_RETIRE_AT` passes once a keyring is configured.
+"""
+import hashlib
+import json
+import os
+import threading
+
+import jwt
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+
+from jwt_knox.settings import api_settings
+
+PEM_MARKER = b'-----BEGIN'
+
+_lock = threading.Lock()
+_loaded_keys = {}
+_jwks = {}
+
+
+def is_asymmetric(algorithm):
+    return not algorithm.upper().startswith('HS')
+
+
+def read_key_material(material):
+    """
+    Returns the PEM bytes of `material`, reading it from disk when it is a
+    path rather than the PEM text itself.
+    """
+    if isinstance(material, os.PathLike):
+        material = os.fspath(material)
+    if isinstance(material, str):
+        material = material.encode('utf-8')
+    if not material.lstrip().startswith(PEM_MARKER):
+        with open(material, 'rb') as key_file:
+            material = key_file.read()
+    return material
+
+
+def get_or_load(cache_key, loader):
+    key = _loaded_keys.get(cache_key)
+    if key is None:
+        key = loader()
+        with _lock:
+            _loaded_keys[cache_key] = key
+    return key
+
+
+def load_key(material, private):
+    """
+    Returns the `cryptography` key object for `material`, parsing it only
+    the first time it is seen.
+    """
+    if not isinstance(material, (str, bytes, os.PathLike)):
+        # Already a key object
+        return material
+
+    return get_or_load((material, private),
+                       lambda: parse_key(material, private))
+
+
+def parse_key(material, private):
+    try:
+        from cryptography.hazmat.primitives import serialization
+    except ImportError:
+        raise ImproperlyConfigured(
+            'The cryptography package is required for asymmetric JWT '
+            'algorithms. Install it with `pip install pyjwt[crypto]`.')
+
+    pem = read_key_material(material)
+    if private:
+        return serialization.load_pem_private_key(pem, password=None)
+    return serialization.load_pem_public_key(pem)
+
+
+def get_key_config(kid=None):
+    """
+    Returns the `(algorithm, key, public key, retire_at)` configured for
+    `kid`, or for the top-level settings when `kid` is None.
+
+    `JWT_KEYRING` entries are either the key itself (the secret for HMAC
+    algorithms, the private key otherwise) or a dict with any of `key`,
+    `public_key`, `algorithm` and `retire_at`.
+    """
+    if kid is None:
+        algorithm = api_settings.JWT_ALGORITHM
+        if not is_asymmetric(algorithm):
+            return (algorithm, api_settings.JWT_SECRET_KEY, None, None)
+        return (algorithm, api_settings.JWT_PRIVATE_KEY,
+                api_settings.JWT_PUBLIC_KEY, None)
+
+    entry = api_settings.JWT_KEYRING[kid]
+    if not isinstance(entry, dict):
+        entry = {'key': entry}
+    return (entry.get('algorithm', api_settings.JWT_ALGORITHM),
+            entry.get('key'), entry.get('public_key'), entry.get('retire_at'))
+
+
+def get_signing_kid():
+    """
+    Returns the key id `jwt_encode_handler` stamps into the token header,
+    or None when no `JWT_KEYRING` is configured.
+    """
+    if not api_settings.JWT_KEYRING:
+        return None
+
+    kid = api_settings.JWT_ACTIVE_KID
+    if kid not in api_settings.JWT_KEYRING:
+        raise ImproperlyConfigured(
+            'JWT_ACTIVE_KID must name one of the JWT_KEYRING keys.')
+    return kid
+
+
+def get_algorithm(kid=None):
+    return get_key_config(kid)[0]
+
+
+def get_signing_key(kid=None):
+    """
+    Returns the key `jwt_encode_handler` signs with.
+    """
+    algorithm, key, _, _ = get_key_config(kid)
+    if not is_asymmetric(algorithm):
+        return key
+
+    if key is None:
+        raise ImproperlyConfigured(
+            'A private key is required to sign with {0}.'.format(algorithm))
+    return load_key(key, private=True)
+
+
+def export_signing_key(kid=None):
+    """
+    Returns the private key `jwt_encode_handler` signs with as unencrypted
+    PKCS8 PEM bytes, so that it can be handed to other processes.
+    """
+    from cryptography.hazmat.primitives import serialization
+
+    return get_signing_key(kid).private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption())
+
+
+def get_verifying_key(kid=None):
+    """
+    Returns the key `jwt_decode_handler` verifies with. Without a public
+    key, the public half of the private key is used.
+
+    Raises `jwt.InvalidSignatureError` if `kid` is not in `JWT_KEYRING` or
+    its `retire_at` has passed, or if `kid` is None and
+    `JWT_KIDLESS_RETIRE_AT` has passed.
+    """
+    if kid is not None:
+        if not isinstance(kid, str) or kid not in (api_settings.JWT_KEYRING or {}):
+            raise jwt.InvalidSignatureError('Unknown key id.')
+        if is_retired(kid):
+            raise jwt.InvalidSignatureError('Retired key id.')
+    elif is_retired(kid):
+        raise jwt.InvalidSignatureError('Retired key.')
+
+    algorithm, key, public_key, _ = get_key_config(kid)
+    if not is_asymmetric(algorithm):
+        return key
+
+    if public_key is not None:
+        return load_key(public_key, private=False)
+    if key is not None:
+        return get_or_load((key, 'public'),
+                           lambda: get_signing_key(kid).public_key())
+    raise ImproperlyConfigured(
+        'A public or private key is required to verify {0}.'.format(
+            algorithm))
+
+
+def get_retire_at(kid):
+    if kid is None:
+        # The top-level key only retires once a keyring replaces it
+        if not api_settings.JWT_KEYRING:
+            return None
+        return api_settings.JWT_KIDLESS_RETIRE_AT
+    return get_key_config(kid)[3]
+
+
+def is_retired(kid):
+    retire_at = get_retire_at(kid)
+    return retire_at is not None and retire_at <= timezone.now()
+
+
+def preload_keys():
+    """
+    Parses the configured keys, so that misconfigurations surface at
+    startup and the first requests do not pay for the parsing.
+    """
+    for kid in [None] + list(api_settings.JWT_KEYRING or ()):
+        algorithm, key, _, _ = get_key_config(kid)
+        if not is_asymmetric(algorithm):
+            continue
+        if key is not None:
+            get_signing_key(kid)
+        get_verifying_key(kid)
+
+
+def get_jwks():
+    """
+    Returns a `(jwks, etag)` pair with the JSON Web Key Set of the public
+    keys that verify tokens: the top-level key, if asymmetric, and every
+    unretired asymmetric key of `JWT_KEYRING`. HMAC secrets are never
+    published.
+    """
+    context = (api_settings.JWT_ALGORITHM, api_settings.JWT_PRIVATE_KEY,
+               api_settings.JWT_PUBLIC_KEY, api_settings.JWT_KEYRING,
+               api_settings.JWT_KIDLESS_RETIRE_AT)
+    cached = _jwks.get('current')
+    if cached is not None and cached[0] == context:
+        if not any(is_retired(jwk.get('kid')) for jwk in cached[1]['keys']):
+            return cached[1], cached[2]
+
+    keys = []
+    for kid in [None] + list(api_settings.JWT_KEYRING or ()):
+        algorithm, key, public_key, _ = get_key_config(kid)
+        if not is_asymmetric(algorithm) or (key is None and public_key is None):
+            continue
+        if is_retired(kid):
+            continue
+        jwk = json.loads(jwt.get_algorithm_by_name(algorithm).to_jwk(
+            get_verifying_key(kid)))
+        jwk.update({'alg': algorithm, 'use': 'sig'})
+        if kid is not None:
+            jwk['kid'] = kid
+        keys.append(jwk)
+
+    jwks = {'keys': keys}
+    etag = '"{0}"'.format(hashlib.sha256(
+        json.dumps(jwks, sort_keys=True).encode('utf-8')).hexdigest())
+    with _lock:
+        _jwks['current'] = (context, jwks, etag)
+    return jwks, etag
+
+
+def clear_loaded_keys():
+    with _lock:
+        _loaded_keys.clear()
+        _jwks.clear()
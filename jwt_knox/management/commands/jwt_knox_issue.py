@@ -0,0 +1,83 @@
+import json
+import sys
+from datetime import timedelta
+from itertools import islice
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from jwt_knox.settings import api_settings
+from jwt_knox.utils import create_auth_tokens_bulk, jwt_join_header_and_token
+
+
+class Command(BaseCommand):
+    help = ('Issues a token for each of the given users and writes them as '
+            'JSON lines.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'usernames', nargs='*',
+            help='Users to issue tokens for. Read from --input if omitted.')
+        parser.add_argument(
+            '--input', default='-',
+            help='File with one username per line, or - for stdin '
+                 '(default: %(default)s).')
+        parser.add_argument(
+            '--expiry', type=int, default=None,
+            help='Lifetime of the tokens in seconds (default: no expiry).')
+        parser.add_argument(
+            '--batch-size', type=int,
+            default=api_settings.JWT_BULK_BATCH_SIZE,
+            help='Number of tokens inserted per statement '
+                 '(default: %(default)s).')
+        parser.add_argument(
+            '--workers', type=int, default=None,
+            help='Number of processes signing the tokens, for asymmetric '
+                 'algorithms.')
+
+    def handle(self, *args, **options):
+        usernames = options['usernames']
+        input_file = None
+        if not usernames:
+            if options['input'] == '-':
+                usernames = sys.stdin
+            else:
+                usernames = input_file = open(options['input'])
+
+        expiry = None
+        if options['expiry'] is not None:
+            expiry = timedelta(seconds=options['expiry'])
+
+        try:
+            users = self.iter_users(
+                (username.strip() for username in usernames if username.strip()),
+                options['batch_size'])
+            for user, token in create_auth_tokens_bulk(
+                    users, expiry, batch_size=options['batch_size'],
+                    workers=options['workers']):
+                self.stdout.write(json.dumps({
+                    'username': user.get_username(),
+                    'token': jwt_join_header_and_token(token),
+                }))
+        finally:
+            if input_file is not None:
+                input_file.close()
+
+    def iter_users(self, usernames, batch_size):
+        """
+        Yields the users called `usernames`, fetched `batch_size` at a time,
+        and reports the unknown ones on stderr.
+        """
+        User = get_user_model()
+        usernames = iter(usernames)
+        while True:
+            chunk = list(islice(usernames, batch_size))
+            if not chunk:
+                break
+            users = User._default_manager.in_bulk(
+                chunk, field_name=User.USERNAME_FIELD)
+            for username in chunk:
+                if username in users:
+                    yield users[username]
+                else:
+                    self.stderr.write('Unknown user: {0}'.format(username))
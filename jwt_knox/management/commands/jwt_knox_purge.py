@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from jwt_knox.settings import api_settings
+from jwt_knox.utils import purge_expired_tokens
+
+
+class Command(BaseCommand):
+    help = 'Deletes the expired knox tokens from the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int,
+            default=api_settings.JWT_PURGE_BATCH_SIZE,
+            help='Number of rows deleted per statement (default: %(default)s).')
+
+    def handle(self, *args, **options):
+        purged = purge_expired_tokens(batch_size=options['batch_size'])
+        self.stdout.write('Purged {0} expired token(s).'.format(purged))
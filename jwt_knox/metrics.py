@@ -0,0 +1,256 @@
+"""Authentication metrics.
+
+Set `JWT_METRICS_SINK` to the import path of a sink class to record where
+authentication time goes:
+
+* `jwt_knox.metrics.PrometheusSink` keeps the metrics in process, to be
+  scraped through `prometheus_metrics_view` in the text exposition format.
+* `jwt_knox.metrics.StatsdSink` sends them over UDP to the StatsD daemon at
+  `JWT_METRICS_STATSD_HOST`:`JWT_METRICS_STATSD_PORT`.
+
+Without a sink (the default), `metrics.enabled` is False and the
+instrumented code only pays for that check.
+"""
+import socket
+import threading
+import time
+from contextlib import nullcontext
+
+from django.http import Http404, HttpResponse
+
+from jwt_knox.settings import api_settings
+
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                0.5, 1.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 100)
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'authentications_total': (
+        'counter', 'Successful authentications.', None),
+    'auth_failures_total': (
+        'counter', 'Failed authentications, by reason.', None),
+    'decode_seconds': (
+        'histogram', 'Time spent decoding and verifying JWTs.', TIME_BUCKETS),
+    'user_lookup_seconds': (
+        'histogram', 'Time spent looking up the user.', TIME_BUCKETS),
+    'token_lookup_seconds': (
+        'histogram', 'Time spent looking up the knox token.', TIME_BUCKETS),
+    'tokens_scanned': (
+        'histogram', 'Knox rows compared per token lookup.', COUNT_BUCKETS),
+    'tokens_issued_total': (
+        'counter', 'Tokens issued through get_token.', None),
+    'logins_coalesced_total': (
+        'counter', 'Duplicate logins answered with an issued token.', None),
+    'sessions_evicted_total': (
+        'counter', 'Sessions closed by JWT_MAX_TOKENS_PER_USER.', None),
+    'tokens_refreshed_total': (
+        'counter', 'Tokens reissued through refresh.', None),
+    'logouts_total': (
+        'counter', 'Logouts, by scope.', None),
+}
+
+
+class NullSink(object):
+    """
+    Discards every metric. Sinks receive `labels` as a tuple of sorted
+    `(name, value)` pairs.
+    """
+
+    def incr(self, name, value, labels):
+        pass
+
+    def observe(self, name, value, labels):
+        pass
+
+
+class PrometheusSink(NullSink):
+    """
+    Aggregates the metrics in process and renders them in the Prometheus
+    text exposition format.
+    """
+    prefix = 'jwt_knox_'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def incr(self, name, value, labels):
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels):
+        buckets = METRICS[name][2]
+        key = (name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # Bucket counts, then the count and sum of the observations
+                histogram = self.histograms[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += value
+
+    def render(self):
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {key: list(value)
+                          for key, value in self.histograms.items()}
+
+        lines = []
+        for name, (kind, help_text, buckets) in METRICS.items():
+            full_name = self.prefix + name
+            lines.append('# HELP {0} {1}'.format(full_name, help_text))
+            lines.append('# TYPE {0} {1}'.format(full_name, kind))
+            if kind == 'counter':
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append('{0}{1} {2}'.format(
+                            full_name, format_labels(labels), value))
+                continue
+
+            for (metric, labels), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, count in zip(buckets, histogram):
+                    lines.append('{0}_bucket{1} {2}'.format(
+                        full_name, format_labels(labels + (('le', bound), )),
+                        count))
+                lines.append('{0}_bucket{1} {2}'.format(
+                    full_name, format_labels(labels + (('le', '+Inf'), )),
+                    histogram[-2]))
+                lines.append('{0}_count{1} {2}'.format(
+                    full_name, format_labels(labels), histogram[-2]))
+                lines.append('{0}_sum{1} {2}'.format(
+                    full_name, format_labels(labels), histogram[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(name, str(value).replace('\\', '\\\\')
+                           .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels) + '}'
+
+
+class StatsdSink(NullSink):
+    """
+    Sends every metric to a StatsD daemon over UDP, label values being
+    appended to the metric name. Durations are sent in milliseconds.
+    """
+
+    def __init__(self):
+        self.address = (api_settings.JWT_METRICS_STATSD_HOST,
+                        api_settings.JWT_METRICS_STATSD_PORT)
+        self.prefix = api_settings.JWT_METRICS_STATSD_PREFIX
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def make_name(self, name, labels):
+        return '.'.join([self.prefix, name] +
+                        [str(value) for _, value in labels])
+
+    def send(self, line):
+        try:
+            self.socket.sendto(line.encode('utf-8'), self.address)
+        except OSError:
+            # Metrics must never break authentication
+            pass
+
+    def incr(self, name, value, labels):
+        self.send('{0}:{1}|c'.format(self.make_name(name, labels), value))
+
+    def observe(self, name, value, labels):
+        if name.endswith('_seconds'):
+            value = value * 1000
+        self.send('{0}:{1:g}|ms'.format(self.make_name(name, labels), value))
+
+
+class Timer(object):
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.sink.observe(
+            self.name, time.perf_counter() - self.start, self.labels)
+
+
+class Metrics(object):
+    """
+    Records metrics into the sink configured by `JWT_METRICS_SINK`, which
+    is instantiated on first use and again whenever the setting changes.
+    """
+    null_timer = nullcontext()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sink = (None, NullSink())
+
+    @property
+    def enabled(self):
+        return api_settings.JWT_METRICS_SINK is not None
+
+    @property
+    def sink(self):
+        sink_class = api_settings.JWT_METRICS_SINK
+        if sink_class is None:
+            sink_class = NullSink
+        current_class, sink = self._sink
+        if current_class is not sink_class:
+            with self._lock:
+                current_class, sink = self._sink
+                if current_class is not sink_class:
+                    sink = sink_class()
+                    self._sink = (sink_class, sink)
+        return sink
+
+    def reset(self):
+        """
+        Drops the sink, and with it the metrics it has aggregated.
+        """
+        with self._lock:
+            self._sink = (None, NullSink())
+
+    def incr(self, name, value=1, **labels):
+        if self.enabled:
+            self.sink.incr(name, value, tuple(sorted(labels.items())))
+
+    def observe(self, name, value, **labels):
+        if self.enabled:
+            self.sink.observe(name, value, tuple(sorted(labels.items())))
+
+    def timer(self, name, **labels):
+        """
+        Returns a context manager observing the time spent in its block.
+        """
+        if not self.enabled:
+            return self.null_timer
+        return Timer(self, name, tuple(sorted(labels.items())))
+
+
+metrics = Metrics()
+
+
+def prometheus_metrics_view(request):
+    """
+    Renders the metrics of the `PrometheusSink` for Prometheus to scrape.
+    Route it yourself, behind whatever access control suits you.
+    """
+    sink = metrics.sink
+    if not isinstance(sink, PrometheusSink):
+        raise Http404('Prometheus metrics are not enabled.')
+    return HttpResponse(sink.render(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
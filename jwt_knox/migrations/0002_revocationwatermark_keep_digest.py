@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 09:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jwt_knox', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='revocationwatermark',
+            name='keep_digest',
+            field=models.CharField(blank=True, max_length=128, null=True),
+        ),
+    ]
@@ -0,0 +1,59 @@
+from django.conf import settings
+from django.db import models
+from knox.settings import CONSTANTS
+
+
+class RevokedToken(models.Model):
+    """
+    A knox token revoked through the logout endpoints, recorded by its
+    digest until it expires so that the revocation list can be rebuilt.
+    Tokens without an expiry are kept forever.
+    """
+    digest = models.CharField(
+        max_length=CONSTANTS.DIGEST_LENGTH, primary_key=True)
+    expiry = models.DateTimeField(null=True, blank=True)
+    revoked = models.DateTimeField(auto_now_add=True, db_index=True)
+
+
+class RevocationWatermark(models.Model):
+    """
+    Every token of `user` issued before `revoked_before` is revoked, except
+    the one whose digest is `keep_digest`, if any.
+    """
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL, primary_key=True,
+        related_name='jwt_knox_watermark', on_delete=models.CASCADE)
+    revoked_before = models.DateTimeField()
+    keep_digest = models.CharField(
+        max_length=CONSTANTS.DIGEST_LENGTH, null=True, blank=True)
+    updated = models.DateTimeField(auto_now=True, db_index=True)
+
+
+class TokenActivity(models.Model):
+    """
+    When the knox token with `digest` was last used, as recorded by the
+    activity tracker. Rows are dropped by the purge once the token is gone.
+    """
+    digest = models.CharField(
+        max_length=CONSTANTS.DIGEST_LENGTH, primary_key=True)
+    last_used = models.DateTimeField(db_index=True)
+
+
+def is_issued_before(revoked_before, issued_at, created=None):
+    """
+    Returns whether a token with the `issued_at` (`iat`) timestamp was
+    issued before `revoked_before`.
+
+    `iat` only has a one second resolution, so tokens issued within the
+    same second are compared by the `created` time of their knox row,
+    which may be given as a callable so that it is only looked up then.
+    When that is unknown, the token is considered revoked.
+    """
+    watermark = int(revoked_before.timestamp())
+    if isinstance(issued_at, (int, float)) and int(issued_at) != watermark:
+        return issued_at < watermark
+    if callable(created):
+        created = created()
+    if created is None:
+        return True
+    return created < revoked_before
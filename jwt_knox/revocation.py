@@ -0,0 +1,244 @@
+"""Revocation list for stateless verification.
+
+When `JWT_REVOCATION_LIST` is enabled, the logout endpoints record the
+digests of the tokens they revoke in `RevokedToken`, and `logout_all`
+records a per-user `RevocationWatermark`. An in-memory bloom filter of
+those entries lets `is_token_revoked` answer "not revoked" for the vast
+majority of tokens without touching the database.
+
+A bloom filter can report false positives but never false negatives. On
+a positive, the token is checked against the knox table (the source of
+truth, since revoked tokens are deleted from it) and, for users with a
+watermark, against the watermark itself. False positives therefore cost
+one query and never reject a valid token.
+
+The filter is built from the store on first use, and then refreshed
+every `JWT_REVOCATION_REFRESH_INTERVAL` seconds with the entries other
+processes added since.
+"""
+import hashlib
+import math
+import threading
+import time
+from datetime import timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+from knox.models import AuthToken
+
+from jwt_knox.models import (RevocationWatermark, RevokedToken,
+                             is_issued_before)
+from jwt_knox.settings import api_settings
+from jwt_knox.utils import get_token_digest, get_username_field
+
+
+class BloomFilter(object):
+    """
+    A fixed-size bloom filter over strings.
+    """
+
+    def __init__(self, capacity, error_rate):
+        capacity = max(capacity, 1)
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hash_count = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size
+                for i in range(self.hash_count)]
+
+    def add(self, item):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self.positions(item))
+
+
+class RevocationList(object):
+    # Entries recorded by other processes while we refresh are picked up
+    # on the next refresh thanks to this overlap
+    refresh_overlap = timedelta(seconds=5)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.bloom = None
+        self.synced_at = None
+        self.refreshed_at = 0
+        self.checks = 0
+        self.bloom_positives = 0
+        self.false_positives = 0
+
+    @property
+    def enabled(self):
+        return api_settings.JWT_REVOCATION_LIST
+
+    def token_key(self, digest):
+        return 'token:' + digest
+
+    def user_key(self, username):
+        return 'user:' + str(username)
+
+    def rebuild(self):
+        """
+        Builds a new bloom filter from every entry of the store.
+        """
+        synced_at = timezone.now()
+        digests = RevokedToken.objects.values_list('digest', flat=True)
+        usernames = RevocationWatermark.objects.values_list(
+            'user__' + get_username_field(), flat=True)
+
+        bloom = BloomFilter(
+            max(api_settings.JWT_REVOCATION_BLOOM_CAPACITY,
+                2 * (digests.count() + usernames.count())),
+            api_settings.JWT_REVOCATION_BLOOM_ERROR_RATE)
+        # Streamed, since the store grows with every revoked token that
+        # never expires
+        for digest in digests.iterator():
+            bloom.add(self.token_key(digest))
+        for username in usernames.iterator():
+            bloom.add(self.user_key(username))
+
+        with self._lock:
+            self.bloom = bloom
+            self.synced_at = synced_at
+            self.refreshed_at = time.monotonic()
+
+    def refresh(self):
+        """
+        Adds the entries recorded since the last refresh, possibly by other
+        processes, to the bloom filter.
+        """
+        synced_at = timezone.now()
+        since = self.synced_at - self.refresh_overlap
+        digests = RevokedToken.objects.filter(
+            revoked__gte=since).values_list('digest', flat=True)
+        usernames = RevocationWatermark.objects.filter(
+            updated__gte=since).values_list(
+                'user__' + get_username_field(), flat=True)
+
+        with self._lock:
+            for digest in digests:
+                self.bloom.add(self.token_key(digest))
+            for username in usernames:
+                self.bloom.add(self.user_key(username))
+            self.synced_at = synced_at
+            self.refreshed_at = time.monotonic()
+
+    def ensure_fresh(self):
+        if self.bloom is None:
+            self.rebuild()
+        elif (time.monotonic() - self.refreshed_at
+                >= api_settings.JWT_REVOCATION_REFRESH_INTERVAL):
+            self.refresh()
+
+    def revoke_tokens(self, tokens):
+        """
+        Records the `(digest, expiry)` pairs of `tokens` as revoked.
+        """
+        RevokedToken.objects.bulk_create(
+            [RevokedToken(digest=digest, expiry=expiry)
+             for digest, expiry in tokens],
+            ignore_conflicts=True)
+        if self.bloom is not None:
+            with self._lock:
+                for digest, _ in tokens:
+                    self.bloom.add(self.token_key(digest))
+
+    def revoke_user(self, user, revoked_before=None, keep_digest=None):
+        """
+        Records that every token of `user` issued before `revoked_before`
+        (now, by default) is revoked, except the one with `keep_digest`.
+        """
+        if revoked_before is None:
+            revoked_before = timezone.now()
+        RevocationWatermark.objects.update_or_create(
+            user=user, defaults={'revoked_before': revoked_before,
+                                 'keep_digest': keep_digest})
+        if self.bloom is not None:
+            with self._lock:
+                self.bloom.add(self.user_key(user.get_username()))
+
+    def is_revoked(self, username, token, issued_at):
+        """
+        Returns whether the knox `token` of `username`, issued at the
+        `issued_at` timestamp, has been revoked. Malformed tokens are
+        reported as revoked.
+        """
+        digest = get_token_digest(token)
+        if digest is None:
+            return True
+
+        self.ensure_fresh()
+        bloom = self.bloom
+
+        revoked = False
+        positive = False
+        if self.token_key(digest) in bloom:
+            positive = True
+            revoked = not self.knox_token_exists(digest)
+        if not revoked and self.user_key(username) in bloom:
+            positive = True
+            revoked = self.is_before_watermark(username, digest, issued_at)
+
+        with self._lock:
+            self.checks += 1
+            if positive:
+                self.bloom_positives += 1
+                if not revoked:
+                    self.false_positives += 1
+        return revoked
+
+    def knox_token_exists(self, digest):
+        return AuthToken.objects.filter(
+            Q(expiry__isnull=True) | Q(expiry__gt=timezone.now()),
+            digest=digest).exists()
+
+    def is_before_watermark(self, username, digest, issued_at):
+        watermark = RevocationWatermark.objects.filter(**{
+            'user__' + get_username_field(): username,
+        }).values_list('revoked_before', 'keep_digest').first()
+        if watermark is None:
+            return False
+
+        revoked_before, keep_digest = watermark
+        if digest == keep_digest:
+            return False
+        return is_issued_before(
+            revoked_before, issued_at,
+            lambda: AuthToken.objects.filter(digest=digest).values_list(
+                'created', flat=True).first())
+
+    def stats(self):
+        """
+        Returns how many checks were made, how many hit the bloom filter and
+        how many of those turned out not to be revoked after the fallback.
+        """
+        with self._lock:
+            return {'checks': self.checks,
+                    'bloom_positives': self.bloom_positives,
+                    'false_positives': self.false_positives}
+
+    def reset(self):
+        with self._lock:
+            self.bloom = None
+            self.synced_at = None
+            self.checks = 0
+            self.bloom_positives = 0
+            self.false_positives = 0
+
+
+revocation_list = RevocationList()
+
+
+def is_token_revoked(payload):
+    """
+    `JWT_REVOCATION_CHECK_HANDLER` backed by the revocation list.
+    """
+    username = api_settings.JWT_PAYLOAD_GET_USERNAME_HANDLER(payload)
+    token = api_settings.JWT_PAYLOAD_GET_TOKEN_HANDLER(payload)
+    return revocation_list.is_revoked(username, token, payload.get('iat'))
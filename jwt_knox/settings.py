@@ -1,24 +1,67 @@
-import datetime
+"""Settings for jwt_knox, read from the `JWT_AUTH` dict of the Django
+settings.
 
+Nothing is read when this module is imported: settings are looked up,
+and handlers imported, the first time they are used, and then cached
+until Django's `setting_changed` signal reports a change to `JWT_AUTH`,
+`SECRET_KEY` or `REST_FRAMEWORK`.
+"""
 from django.conf import settings
-from rest_framework.settings import APISettings
-
-USER_SETTINGS = getattr(settings, 'JWT_AUTH', None)
+from django.core.signals import setting_changed
+from rest_framework.settings import DEFAULTS as DRF_DEFAULTS
+from rest_framework.settings import APISettings, perform_import
 
 DEFAULTS = {
-    'JWT_LOGIN_AUTHENTICATION_CLASSES': settings.REST_FRAMEWORK['DEFAULT_AUTHENTICATION_CLASSES'],
+    # Defaults to REST framework's DEFAULT_AUTHENTICATION_CLASSES
+    'JWT_LOGIN_AUTHENTICATION_CLASSES': None,
     'JWT_ENCODE_HANDLER': 'jwt_knox.utils.jwt_encode_handler',
     'JWT_DECODE_HANDLER': 'jwt_knox.utils.jwt_decode_handler',
     'JWT_PAYLOAD_HANDLER': 'jwt_knox.utils.jwt_payload_handler',
     'JWT_PAYLOAD_GET_USERNAME_HANDLER': 'jwt_knox.utils.jwt_get_username_from_payload_handler',
     'JWT_PAYLOAD_GET_TOKEN_HANDLER': 'jwt_knox.utils.jwt_get_token_from_payload_handler',
     'JWT_RESPONSE_PAYLOAD_HANDLER': 'jwt_knox.utils.jwt_response_payload_handler',
-    'JWT_SECRET_KEY': settings.SECRET_KEY,
+    # Defaults to SECRET_KEY
+    'JWT_SECRET_KEY': None,
     'JWT_ALGORITHM': 'HS256',
+    'JWT_PRIVATE_KEY': None,
+    'JWT_PUBLIC_KEY': None,
+    'JWT_KEYRING': None,
+    'JWT_ACTIVE_KID': None,
+    'JWT_KIDLESS_RETIRE_AT': None,
     'JWT_AUTH_HEADER_PREFIX': 'Bearer',
+    'JWT_AUTH_HEADER_MAX_LENGTH': 8192,
     'JWT_AUDIENCE': None,
     'JWT_ISSUER': None,
     'JWT_LEEWAY': 0,
+    'JWT_PURGE_BATCH_SIZE': 1000,
+    'JWT_BULK_BATCH_SIZE': 500,
+    'JWT_KNOX_CACHE': None,
+    'JWT_KNOX_CACHE_TTL': 300,
+    'JWT_PAYLOAD_CACHE_SIZE': 0,
+    'JWT_SELECT_RELATED_USER': False,
+    'JWT_READ_DATABASE': None,
+    'JWT_JWKS_MAX_AGE': 3600,
+    'JWT_VERIFY_BATCH_MAX_SIZE': 100,
+    'JWT_REVOCATION_CHECK_HANDLER': None,
+    'JWT_REVOCATION_LIST': False,
+    'JWT_REVOCATION_BLOOM_CAPACITY': 100000,
+    'JWT_REVOCATION_BLOOM_ERROR_RATE': 0.001,
+    'JWT_REVOCATION_REFRESH_INTERVAL': 60,
+    'JWT_LOGOUT_WATERMARK': False,
+    'JWT_MAX_TOKENS_PER_USER': None,
+    'JWT_MAX_TOKENS_POLICY': 'evict',
+    'JWT_IDEMPOTENCY_CACHE': None,
+    'JWT_IDEMPOTENCY_TTL': 30,
+    'JWT_IDEMPOTENCY_WAIT': 5,
+    'JWT_REFRESH_EXPIRY': None,
+    'JWT_REFRESH_MIN_INTERVAL': 60,
+    'JWT_TRACK_LAST_USED': False,
+    'JWT_LAST_USED_INTERVAL': 300,
+    'JWT_LAST_USED_FLUSH_INTERVAL': 10,
+    'JWT_METRICS_SINK': None,
+    'JWT_METRICS_STATSD_HOST': '127.0.0.1',
+    'JWT_METRICS_STATSD_PORT': 8125,
+    'JWT_METRICS_STATSD_PREFIX': 'jwt_knox',
 }
 
 IMPORT_STRINGS = (
@@ -29,8 +72,122 @@ IMPORT_STRINGS = (
     'JWT_PAYLOAD_GET_USERNAME_HANDLER',
     'JWT_PAYLOAD_GET_TOKEN_HANDLER',
     'JWT_RESPONSE_PAYLOAD_HANDLER',
+    'JWT_REVOCATION_CHECK_HANDLER',
+    'JWT_METRICS_SINK',
 )
 
 
-api_settings = APISettings(USER_SETTINGS, DEFAULTS, IMPORT_STRINGS)
+def get_default_login_authentication_classes():
+    return getattr(settings, 'REST_FRAMEWORK', {}).get(
+        'DEFAULT_AUTHENTICATION_CLASSES',
+        DRF_DEFAULTS['DEFAULT_AUTHENTICATION_CLASSES'])
+
+
+def get_default_secret_key():
+    return settings.SECRET_KEY
+
+
+LAZY_DEFAULTS = {
+    'JWT_LOGIN_AUTHENTICATION_CLASSES':
+        get_default_login_authentication_classes,
+    'JWT_SECRET_KEY': get_default_secret_key,
+}
+
+
+def derive_auth_header_prefix(prefix):
+    # Compared with the raw `Authorization` header, which is bytes
+    return prefix.lower().encode('iso-8859-1')
+
+
+def derive_decode_options(leeway, audience, issuer):
+    # Keyword arguments of `jwt.decode`, besides the key and algorithms
+    return {
+        'options': {'verify_exp': True},
+        'leeway': leeway,
+        'audience': audience,
+        'issuer': issuer,
+    }
+
+
+# name: (settings it depends on, function computing it from them)
+DERIVED = {
+    'auth_header_prefix': (('JWT_AUTH_HEADER_PREFIX', ),
+                           derive_auth_header_prefix),
+    'decode_options': (('JWT_LEEWAY', 'JWT_AUDIENCE', 'JWT_ISSUER'),
+                       derive_decode_options),
+}
+
+
+class JWTKnoxSettings(APISettings):
+    """
+    `APISettings` reading `JWT_AUTH` lazily, whose `None` defaults in
+    `LAZY_DEFAULTS` are computed from other settings on first use.
+
+    Values `DERIVED` from the settings are computed once and cached like
+    the settings themselves, and dropped whenever a setting they depend on
+    is reloaded or assigned, as `mock.patch.object` does.
+    """
+
+    def __init__(self, defaults=None, import_strings=None,
+                 lazy_defaults=None, derived=None):
+        super(JWTKnoxSettings, self).__init__(None, defaults, import_strings)
+        self.lazy_defaults = lazy_defaults or {}
+        self.derived = derived or {}
+
+    @property
+    def user_settings(self):
+        if not hasattr(self, '_user_settings'):
+            self._user_settings = getattr(settings, 'JWT_AUTH', None) or {}
+        return self._user_settings
+
+    def __getattr__(self, attr):
+        if attr in self.__dict__.get('derived', ()):
+            setting_names, compute = self.derived[attr]
+            val = compute(*[getattr(self, name) for name in setting_names])
+            self.__dict__[attr] = val
+            return val
+
+        if attr not in self.defaults:
+            raise AttributeError("Invalid jwt_knox setting: '%s'" % attr)
+
+        val = self.user_settings.get(attr, self.defaults[attr])
+        if val is None and attr in self.lazy_defaults:
+            val = self.lazy_defaults[attr]()
+
+        if attr in self.import_strings:
+            val = perform_import(val, attr)
+
+        self._cached_attrs.add(attr)
+        setattr(self, attr, val)
+        return val
+
+    def __setattr__(self, attr, value):
+        super(JWTKnoxSettings, self).__setattr__(attr, value)
+        self.forget_derived(attr)
+
+    def __delattr__(self, attr):
+        super(JWTKnoxSettings, self).__delattr__(attr)
+        self.forget_derived(attr)
+
+    def forget_derived(self, setting_name):
+        for name, (setting_names, _) in self.__dict__.get(
+                'derived', {}).items():
+            if setting_name in setting_names:
+                self.__dict__.pop(name, None)
+
+    def reload(self):
+        super(JWTKnoxSettings, self).reload()
+        for name in self.derived:
+            self.__dict__.pop(name, None)
+
+
+api_settings = JWTKnoxSettings(DEFAULTS, IMPORT_STRINGS, LAZY_DEFAULTS,
+                               DERIVED)
+
+
+def reload_api_settings(*args, **kwargs):
+    if kwargs['setting'] in ('JWT_AUTH', 'SECRET_KEY', 'REST_FRAMEWORK'):
+        api_settings.reload()
+
 
+setting_changed.connect(reload_api_settings)
@@ -0,0 +1,23 @@
+"""Signing in worker processes, for `create_auth_tokens_bulk`.
+
+This module must not import Django nor the rest of `jwt_knox`, so that the
+workers of a process pool can import it without configured settings,
+whatever the start method. The signing key is handed over as PEM once,
+when each worker starts, and parsed there a single time.
+"""
+import jwt
+
+_signer = {}
+
+
+def init_signing_worker(pem, algorithm, headers):
+    from cryptography.hazmat.primitives import serialization
+
+    _signer['key'] = serialization.load_pem_private_key(pem, password=None)
+    _signer['algorithm'] = algorithm
+    _signer['headers'] = headers
+
+
+def sign_payload(payload):
+    return jwt.encode(payload, _signer['key'], _signer['algorithm'],
+                      headers=_signer['headers'])
@@ -1,14 +1,27 @@
 from typing import Optional
+import base64
+import binascii
 import jwt
 import uuid
 from calendar import timegm
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from itertools import islice
 
+from asgiref.sync import sync_to_async
 from django.contrib.auth import get_user_model
+from django.db.models import F
+from django.utils import timezone
 
+from knox.crypto import create_token_string, hash_token
 from knox.models import AuthToken, User
+from knox.settings import CONSTANTS, knox_settings
 
+from jwt_knox.keys import (export_signing_key, get_algorithm, get_signing_key,
+                           get_signing_kid, get_verifying_key, is_asymmetric)
+from jwt_knox.models import RevokedToken, TokenActivity
 from jwt_knox.settings import api_settings
+from jwt_knox.signing import init_signing_worker, sign_payload
 
 
 def get_username_field():
@@ -29,18 +42,242 @@ def get_username(user):
     return username
 
 
-def create_auth_token(user, expiry):
-    _, token = AuthToken.objects.create(user=user, expiry=expiry)
-    payload = jwt_payload_handler(user, token, expiry)
+def get_token_prefix():
+    # TOKEN_PREFIX was added in knox 5
+    return getattr(knox_settings, 'TOKEN_PREFIX', '')
+
+
+def get_token_digest(token):
+    """
+    Returns the knox digest of the raw `token`, or None if it is not a
+    valid knox token.
+    """
+    if isinstance(token, str):
+        try:
+            return hash_token(token)
+        except (TypeError, binascii.Error):
+            pass
+    return None
+
+
+def build_auth_token(user, token, expiry, now):
+    """
+    Returns an unsaved knox `AuthToken` of `user` for the raw `token`.
+    """
+    return AuthToken(
+        digest=hash_token(token),
+        token_key=token[:CONSTANTS.TOKEN_KEY_LENGTH], user=user,
+        expiry=None if expiry is None else now + expiry)
+
+
+def create_auth_token(user, expiry, token=None):
+    """
+    Inserts a knox token for `user` and returns a JWT for it. `token` sets
+    the raw knox token instead of a random one.
+    """
+    if token is None:
+        _, token = AuthToken.objects.create(user=user, expiry=expiry)
+    else:
+        build_auth_token(user, token, expiry, timezone.now()).save(
+            force_insert=True)
+    payload = api_settings.JWT_PAYLOAD_HANDLER(user, token, expiry)
 
     return jwt_encode_handler(payload)
 
 
+async def acreate_auth_token(user, expiry):
+    """
+    Asynchronous counterpart of `create_auth_token`.
+    """
+    # knox's manager overrides `create`, which `acreate` would bypass
+    _, token = await sync_to_async(AuthToken.objects.create)(
+        user=user, expiry=expiry)
+    payload = api_settings.JWT_PAYLOAD_HANDLER(user, token, expiry)
+
+    return jwt_encode_handler(payload)
+
+
+def create_auth_tokens_bulk(users_or_specs, expiry=None, batch_size=None,
+                            workers=None):
+    """
+    Issues a token for each item of `users_or_specs`, either a user or a
+    `(user, expiry)` pair overriding `expiry`, and yields `(user, token)`
+    pairs in the same order.
+
+    The input is consumed `batch_size` items at a time
+    (`JWT_BULK_BATCH_SIZE` by default) and the knox rows of each chunk are
+    inserted with a single `bulk_create`, so memory stays bounded however
+    many tokens are issued. With an asymmetric algorithm and `workers`
+    above 1, the JWTs are signed across a pool of that many processes.
+    """
+    if batch_size is None:
+        batch_size = api_settings.JWT_BULK_BATCH_SIZE
+
+    kid = get_signing_kid()
+    algorithm = get_algorithm(kid)
+    pool = None
+    if workers is not None and workers > 1 and is_asymmetric(algorithm):
+        headers = None if kid is None else {'kid': kid}
+        pool = ProcessPoolExecutor(
+            workers, initializer=init_signing_worker,
+            initargs=(export_signing_key(kid), algorithm, headers))
+
+    specs = iter(users_or_specs)
+    try:
+        while True:
+            chunk = [spec if isinstance(spec, tuple) else (spec, expiry)
+                     for spec in islice(specs, batch_size)]
+            if not chunk:
+                break
+
+            payloads = issue_auth_tokens(chunk)
+            if pool is None:
+                tokens = [jwt_encode_handler(payload) for payload in payloads]
+            else:
+                tokens = pool.map(sign_payload, payloads,
+                                  chunksize=max(len(payloads) // workers, 1))
+            for (user, _), token in zip(chunk, tokens):
+                yield (user, token)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+def issue_auth_tokens(specs):
+    """
+    Inserts a knox token for each `(user, expiry)` pair of `specs` with a
+    single `bulk_create`, and returns the JWT payloads for them.
+    """
+    now = timezone.now()
+    auth_tokens = []
+    payloads = []
+    for user, expiry in specs:
+        token = get_token_prefix() + create_token_string()
+        auth_tokens.append(build_auth_token(user, token, expiry, now))
+        payloads.append(api_settings.JWT_PAYLOAD_HANDLER(user, token, expiry))
+
+    AuthToken.objects.bulk_create(auth_tokens)
+    return payloads
+
+
+def refresh_auth_token(user, auth_token, token, now=None):
+    """
+    Issues a new JWT for the existing knox `auth_token`, whose raw key is
+    `token`, instead of creating another row.
+
+    With `JWT_REFRESH_EXPIRY`, the expiry of an expiring token slides to
+    `now + JWT_REFRESH_EXPIRY`, but like knox's auto refresh it is only
+    written when it moves by more than `JWT_REFRESH_MIN_INTERVAL` seconds.
+    The new JWT expires along with the row.
+    """
+    if now is None:
+        now = timezone.now()
+
+    refresh_expiry = api_settings.JWT_REFRESH_EXPIRY
+    if refresh_expiry is not None and auth_token.expiry is not None:
+        new_expiry = now + refresh_expiry
+        delta = (new_expiry - auth_token.expiry).total_seconds()
+        if delta > api_settings.JWT_REFRESH_MIN_INTERVAL:
+            AuthToken.objects.filter(pk=auth_token.pk).update(
+                expiry=new_expiry)
+            auth_token.expiry = new_expiry
+
+    return encode_auth_token(user, auth_token, token, now)
+
+
+def encode_auth_token(user, auth_token, token, now=None):
+    """
+    Returns a JWT for the existing knox `auth_token`, whose raw key is
+    `token`, expiring along with it.
+    """
+    if now is None:
+        now = timezone.now()
+
+    expiry = None
+    if auth_token.expiry is not None:
+        expiry = auth_token.expiry - now
+    payload = api_settings.JWT_PAYLOAD_HANDLER(user, token, expiry)
+
+    return jwt_encode_handler(payload)
+
+
+def purge_expired_tokens(batch_size=None, now=None):
+    """
+    Deletes the expired knox tokens, the ones revoked by a logout
+    watermark, the expired entries of the revocation list and the activity
+    of tokens that no longer exist, in chunks of
+    `batch_size` rows (`JWT_PURGE_BATCH_SIZE` by default) and returns how
+    many were deleted.
+
+    Meant to be called from a scheduler or through the `jwt_knox_purge`
+    management command, so that authentication never has to write.
+    """
+    if batch_size is None:
+        batch_size = api_settings.JWT_PURGE_BATCH_SIZE
+    if now is None:
+        now = timezone.now()
+
+    watermarked = AuthToken.objects.filter(
+        user__jwt_knox_watermark__revoked_before__gt=F('created'),
+    ).exclude(digest=F('user__jwt_knox_watermark__keep_digest'))
+
+    purged = 0
+    for model, expired in (
+            (AuthToken, AuthToken.objects.filter(expiry__lt=now)),
+            (AuthToken, watermarked),
+            (RevokedToken, RevokedToken.objects.filter(expiry__lt=now)),
+            (TokenActivity, TokenActivity.objects.exclude(
+                digest__in=AuthToken.objects.values('digest')))):
+        while True:
+            pks = list(expired.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            _, per_model = model.objects.filter(pk__in=pks).delete()
+            purged += per_model.get(model._meta.label, 0)
+
+    return purged
+
+
+def is_compact_payload(payload):
+    return 'username' not in payload and 'sub' in payload
+
+
+def compact_token_id(token):
+    """
+    Returns the knox `token` with its hexadecimal part, the `token_key`
+    and the secret remainder, encoded as unpadded base64url, which takes
+    two thirds of the space.
+    """
+    prefix = get_token_prefix()
+    raw = binascii.unhexlify(token[len(prefix):])
+    return prefix + base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def expand_token_id(token_id):
+    """
+    Returns the knox token encoded by `compact_token_id`, or None if
+    `token_id` is not one.
+    """
+    prefix = get_token_prefix()
+    if not isinstance(token_id, str) or not token_id.startswith(prefix):
+        return None
+    encoded = token_id[len(prefix):]
+    try:
+        raw = base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4))
+    except (ValueError, binascii.Error):
+        return None
+    return prefix + binascii.hexlify(raw).decode('ascii')
+
+
 def jwt_get_token_from_payload_handler(payload):
+    if is_compact_payload(payload):
+        return expand_token_id(payload.get('jti'))
     return payload.get('jti')
 
 
 def jwt_get_username_from_payload_handler(payload):
+    if is_compact_payload(payload):
+        return payload.get('sub')
     return payload.get('username')
 
 
@@ -71,22 +308,55 @@ def jwt_payload_handler(user: User, token: str, expiry: Optional[datetime]):
     return payload
 
 
+def jwt_compact_payload_handler(user: User, token: str,
+                                expiry: Optional[datetime]):
+    """
+    `JWT_PAYLOAD_HANDLER` writing a smaller payload than
+    `jwt_payload_handler`: the username goes once in `sub`, the knox token
+    in `jti` is encoded by `compact_token_id`, and no `user_id` is added.
+    """
+    now = timegm(datetime.utcnow().utctimetuple())
+
+    payload = {
+        'sub': get_username(user),
+        'iat': now,
+        'jti': compact_token_id(token),
+    }
+
+    if expiry:
+        payload['exp'] = now + int(expiry.total_seconds())
+
+    if api_settings.JWT_AUDIENCE is not None:
+        payload['aud'] = api_settings.JWT_AUDIENCE
+
+    if api_settings.JWT_ISSUER is not None:
+        payload['iss'] = api_settings.JWT_ISSUER
+
+    return payload
+
+
 def jwt_encode_handler(payload):
-    return jwt.encode(payload, api_settings.JWT_SECRET_KEY,
-                      api_settings.JWT_ALGORITHM)
+    kid = get_signing_kid()
+    headers = None if kid is None else {'kid': kid}
+
+    return jwt.encode(payload, get_signing_key(kid), get_algorithm(kid),
+                      headers=headers)
+
+
+def jwt_get_kid(token):
+    if not api_settings.JWT_KEYRING:
+        return None
+    return jwt.get_unverified_header(token).get('kid')
 
 
 def jwt_decode_handler(token):
-    options = {'verify_exp': True, }
+    kid = jwt_get_kid(token)
 
     return jwt.decode(
         token,
-        api_settings.JWT_SECRET_KEY,
-        algorithms=api_settings.JWT_ALGORITHM,
-        options=options,
-        leeway=api_settings.JWT_LEEWAY,
-        audience=api_settings.JWT_AUDIENCE,
-        issuer=api_settings.JWT_ISSUER,
+        get_verifying_key(kid),
+        algorithms=get_algorithm(kid),
+        **api_settings.decode_options
     )
 
 
@@ -1,23 +1,45 @@
-from rest_framework import status
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.translation import gettext as _
+from rest_framework import exceptions, status
 from rest_framework.decorators import action
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.request import ForcedAuthentication
 from rest_framework.response import Response
 from rest_framework.viewsets import ViewSet
 
+from knox.models import AuthToken
+
 from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+from jwt_knox.cache import token_cache
+from jwt_knox.idempotency import login_coalescer
+from jwt_knox.keys import get_jwks
+from jwt_knox.metrics import metrics
+from jwt_knox.models import RevocationWatermark
+from jwt_knox.revocation import revocation_list
 from jwt_knox.settings import api_settings
-from jwt_knox.utils import create_auth_token
+from jwt_knox.utils import (create_auth_token, get_username,
+                            refresh_auth_token)
 
-response_payload_handler = api_settings.JWT_RESPONSE_PAYLOAD_HANDLER
 
 class PerViewAuthenticatorMixin(object):
+    """
+    Lets a viewset pick its authenticators per action through
+    `get_authenticators_for_view`.
+
+    The authenticators of each action are resolved once per viewset class,
+    and instances of authenticator classes that set `reusable` themselves,
+    rather than inheriting it, are shared between requests instead of being
+    created for each one.
+    """
+
     def initialize_request(self, request, *args, **kwargs):
         """
         Returns the initial request object.
         """
         request = super(PerViewAuthenticatorMixin, self).initialize_request(request, *args, **kwargs)
-        if not any([isinstance(auth, ForcedAuthentication) for auth in request.authenticators]):
+        if not any(isinstance(auth, ForcedAuthentication) for auth in request.authenticators):
             request.authenticators = self.get_authenticators()
         return request
 
@@ -27,15 +49,40 @@ class PerViewAuthenticatorMixin(object):
         calling `.get_authenticators_for_view`, but falls back on the
         class's authenticators.
         """
+        if not hasattr(self, 'action'):
+            if hasattr(self, 'action_map'):
+                # `initialize_request` asks again once `action` is known
+                return ()
+            return self.resolve_authenticators(
+                None, self.authentication_classes or ())
+
         authenticators = self.authentication_classes or ()
+        # action gets populated on the second time we are called
+        per_view = self.get_authenticators_for_view(self.action)
+        if per_view is not None:
+            authenticators = per_view
 
-        if hasattr(self, 'action'):
-            # action gets populated on the second time we are called
-            per_view = self.get_authenticators_for_view(self.action)
-            if per_view is not None:
-                authenticators = per_view
+        return self.resolve_authenticators(self.action, authenticators)
 
-        return [auth() for auth in authenticators]
+    def resolve_authenticators(self, action, authenticator_classes):
+        """
+        Returns the authenticators for `authenticator_classes`, reusing the
+        instances cached for `action` while the classes stay the same.
+        """
+        cache = type(self).__dict__.get('_authenticators_cache')
+        if cache is None:
+            cache = {}
+            setattr(type(self), '_authenticators_cache', cache)
+
+        cached = cache.get(action)
+        if cached is None or cached[0] is not authenticator_classes:
+            cached = (authenticator_classes, tuple(
+                (auth, auth() if auth.__dict__.get('reusable') else None)
+                for auth in authenticator_classes))
+            cache[action] = cached
+
+        return [instance if instance is not None else auth()
+                for auth, instance in cached[1]]
 
     def get_authenticators_for_view(self, view_name):
         """
@@ -58,9 +105,49 @@ class JWTKnoxAPIViewSet(PerViewAuthenticatorMixin, ViewSet):
     authentication_classes = (JSONWebTokenKnoxAuthentication, )
     permission_classes = (IsAuthenticated, )
 
+    # Idempotency credentials and key of this `get_token` request, whether
+    # it leads the login for them in this process, and the token issued for
+    # them by an earlier request
+    login_credentials = None
+    login_key = None
+    leads_login = False
+    coalesced_token = None
+
     def get_authenticators_for_view(self, view_name):
         if view_name == 'get_token':
             return api_settings.JWT_LOGIN_AUTHENTICATION_CLASSES
+        if view_name == 'jwks':
+            return ()
+
+    def perform_authentication(self, request):
+        """
+        Answers duplicate `get_token` requests with the token issued for
+        their idempotency key and credentials, if still valid, instead of
+        logging in again.
+        """
+        if self.action == 'get_token' and login_coalescer.enabled:
+            credentials = login_coalescer.get_credentials(
+                request, request.authenticators)
+            if credentials is not None:
+                key = login_coalescer.make_key(credentials)
+                entry, self.leads_login = login_coalescer.claim(key)
+                self.login_key = key
+                if entry is not None:
+                    replayed = login_coalescer.replay(credentials, entry)
+                    if replayed is not None:
+                        request.user, request.auth = replayed[0], None
+                        self.coalesced_token = replayed[1]
+                        return
+                self.login_credentials = credentials
+
+        super(JWTKnoxAPIViewSet, self).perform_authentication(request)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        if self.leads_login:
+            # Let the duplicates waiting in this process go on
+            login_coalescer.release(self.login_key)
+        return super(JWTKnoxAPIViewSet, self).finalize_response(
+            request, response, *args, **kwargs)
 
     @action(methods=['post', ], detail=False)
     def get_token(self, request, expiry=None):
@@ -69,9 +156,56 @@ class JWTKnoxAPIViewSet(PerViewAuthenticatorMixin, ViewSet):
         `JWT_LOGIN_AUTHENTICATION_CLASSES` (which, in turn, defaults to
         rest_framework's `DEFAULT_AUTHENTICATION_CLASSES`) to get a view
         token.
+
+        Duplicate requests with the same `Idempotency-Key` header and
+        credentials get the same token, see `jwt_knox.idempotency`.
+
+        With `JWT_MAX_TOKENS_PER_USER`, the oldest sessions of the user are
+        closed to make room for the new one, or the request is rejected
+        with a 429 if `JWT_MAX_TOKENS_POLICY` is `'reject'`.
         """
-        token = create_auth_token(user=request.user, expiry=expiry)
-        return Response(response_payload_handler(token, request.user, request))
+        if self.coalesced_token is not None:
+            metrics.incr('logins_coalesced_total')
+            return Response(api_settings.JWT_RESPONSE_PAYLOAD_HANDLER(
+                self.coalesced_token, request.user, request))
+
+        knox_token = nonce = None
+        if self.login_credentials is not None:
+            nonce = login_coalescer.make_nonce()
+            knox_token = login_coalescer.make_token(
+                self.login_credentials, nonce)
+
+        limit = api_settings.JWT_MAX_TOKENS_PER_USER
+        if limit is None:
+            token = create_auth_token(request.user, expiry, knox_token)
+        else:
+            with transaction.atomic():
+                self.make_room_for_token(request.user, limit)
+                token = create_auth_token(request.user, expiry, knox_token)
+        metrics.incr('tokens_issued_total')
+        if nonce is not None:
+            login_coalescer.complete(self.login_key, request.user, nonce)
+        return Response(api_settings.JWT_RESPONSE_PAYLOAD_HANDLER(
+            token, request.user, request))
+
+    @action(methods=('post', ), detail=False)
+    def refresh(self, request):
+        """
+        This view issues a new web token for the current session, without
+        going through the login authentication classes nor creating a new
+        knox token. With `JWT_REFRESH_EXPIRY`, the session expiry slides
+        forward.
+        """
+        payload, auth_token = request.auth
+        expiry = auth_token.expiry
+        token = refresh_auth_token(
+            request.user, auth_token,
+            api_settings.JWT_PAYLOAD_GET_TOKEN_HANDLER(payload))
+        if token_cache.enabled and auth_token.expiry != expiry:
+            token_cache.set(auth_token)
+        metrics.incr('tokens_refreshed_total')
+        return Response(api_settings.JWT_RESPONSE_PAYLOAD_HANDLER(
+            token, request.user, request))
 
     @action(methods=('get', 'post'), detail=False)
     def verify(self, request):
@@ -80,6 +214,62 @@ class JWTKnoxAPIViewSet(PerViewAuthenticatorMixin, ViewSet):
         """
         return Response(None, status=status.HTTP_204_NO_CONTENT)
 
+    @action(methods=('post', ), detail=False)
+    def verify_batch(self, request):
+        """
+        This view allows a third party to verify several web tokens at once.
+        It expects a `tokens` list, with or without the
+        `JWT_AUTH_HEADER_PREFIX`, and returns whether each one is valid and
+        the username it belongs to, in the same order.
+        """
+        tokens = None
+        if isinstance(request.data, dict):
+            tokens = request.data.get('tokens')
+        if not isinstance(tokens, list) or not all(
+                isinstance(token, str) for token in tokens):
+            raise exceptions.ValidationError(
+                {'tokens': _('Expected a list of tokens.')})
+        if len(tokens) > api_settings.JWT_VERIFY_BATCH_MAX_SIZE:
+            raise exceptions.ValidationError({'tokens': _(
+                'Ensure this list has no more than {0} tokens.').format(
+                    api_settings.JWT_VERIFY_BATCH_MAX_SIZE)})
+
+        prefix = api_settings.JWT_AUTH_HEADER_PREFIX.lower() + ' '
+        jwt_values = [
+            token[len(prefix):].strip() if token.lower().startswith(prefix)
+            else token.strip()
+            for token in tokens]
+
+        results = []
+        authenticator = JSONWebTokenKnoxAuthentication()
+        for result in authenticator.authenticate_batch(jwt_values):
+            if result is None:
+                results.append({'valid': False, 'username': None})
+            else:
+                results.append({'valid': True,
+                                'username': get_username(result[0])})
+        return Response({'results': results})
+
+    @action(methods=('get', ), detail=False, permission_classes=(AllowAny, ))
+    def jwks(self, request):
+        """
+        Publishes the public keys that verify the issued tokens as a JSON Web
+        Key Set, so that other services can verify them locally. Clients
+        should honour the `Cache-Control` and `ETag` headers.
+        """
+        jwks, etag = get_jwks()
+        if_none_match = [
+            tag.strip().replace('W/', '', 1)
+            for tag in request.headers.get('If-None-Match', '').split(',')]
+        if etag in if_none_match or '*' in if_none_match:
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = Response(jwks)
+        response['ETag'] = etag
+        response['Cache-Control'] = 'public, max-age={0}'.format(
+            api_settings.JWT_JWKS_MAX_AGE)
+        return response
+
     @action(methods=('get', ), detail=False)
     def debug_verify(self, request):
         """
@@ -90,7 +280,8 @@ class JWTKnoxAPIViewSet(PerViewAuthenticatorMixin, ViewSet):
         """
         token = request.auth[0]
         return Response(
-            response_payload_handler(token, request.user, request),
+            api_settings.JWT_RESPONSE_PAYLOAD_HANDLER(
+                token, request.user, request),
             status=status.HTTP_200_OK)
 
     @action(methods=('post', ), detail=False)
@@ -99,7 +290,11 @@ class JWTKnoxAPIViewSet(PerViewAuthenticatorMixin, ViewSet):
         Invalidates the current token, so that it cannot be used anymore
         for authentication.
         """
-        request.auth[1].delete()
+        auth_token = request.auth[1]
+        revoked = [(auth_token.digest, auth_token.expiry)]
+        auth_token.delete()
+        self.forget_tokens(revoked)
+        metrics.incr('logouts_total', scope='current')
         return Response(None, status=status.HTTP_204_NO_CONTENT)
 
     @action(methods=('post', ), detail=False)
@@ -111,7 +306,14 @@ class JWTKnoxAPIViewSet(PerViewAuthenticatorMixin, ViewSet):
         """
         tokens_to_delete = request.user.auth_token_set.exclude(
             pk=request.auth[1].pk)
-        num = tokens_to_delete.delete()
+        metrics.incr('logouts_total', scope='other')
+        if api_settings.JWT_LOGOUT_WATERMARK:
+            num = self.get_live_tokens(request.user, tokens_to_delete).count()
+            revocation_list.revoke_user(request.user,
+                                        keep_digest=request.auth[1].digest)
+            return Response({"deleted_sessions": num})
+
+        num = self.delete_tokens(tokens_to_delete)
         return Response({"deleted_sessions": num[0]})
 
     @action(methods=('post', ), detail=False)
@@ -121,5 +323,76 @@ class JWTKnoxAPIViewSet(PerViewAuthenticatorMixin, ViewSet):
         current session. This endpoint invalidates the current token, and you
         will need to authenticate again.
         """
-        request.user.auth_token_set.all().delete()
+        metrics.incr('logouts_total', scope='all')
+        if api_settings.JWT_LOGOUT_WATERMARK:
+            revocation_list.revoke_user(request.user)
+            return Response(None, status=status.HTTP_204_NO_CONTENT)
+
+        self.delete_tokens(request.user.auth_token_set.all(), revoke=False)
+        if revocation_list.enabled:
+            revocation_list.revoke_user(request.user)
         return Response(None, status=status.HTTP_204_NO_CONTENT)
+
+    def make_room_for_token(self, user, limit):
+        """
+        Evicts the oldest live sessions of `user` beyond the `limit - 1`
+        newest ones, so that it has at most `limit` once a token is issued,
+        or raises `Throttled` if `JWT_MAX_TOKENS_POLICY` is `'reject'`.
+
+        Meant to run in the issuing transaction: the user row is locked, so
+        concurrent logins of the same user are serialized on the databases
+        supporting `select_for_update`. When the limit is enforced there
+        is at most one session to evict.
+        """
+        list(type(user)._default_manager.select_for_update().filter(
+            pk=user.pk).values_list('pk', flat=True))
+
+        live = self.get_live_tokens(user, user.auth_token_set.all())
+        excess = list(live.order_by('-created').values_list(
+            'pk', flat=True)[max(limit - 1, 0):])
+        if not excess:
+            return
+
+        if api_settings.JWT_MAX_TOKENS_POLICY == 'reject':
+            raise exceptions.Throttled(
+                detail=_('Too many open sessions.'), code='too_many_sessions')
+
+        self.delete_tokens(AuthToken.objects.filter(pk__in=excess))
+        metrics.incr('sessions_evicted_total', len(excess))
+
+    def get_live_tokens(self, user, queryset):
+        """
+        Returns the tokens in `queryset` that are neither expired nor revoked
+        by the current watermark of `user`.
+        """
+        queryset = queryset.filter(
+            Q(expiry__isnull=True) | Q(expiry__gt=timezone.now()))
+        watermark = RevocationWatermark.objects.filter(user=user).first()
+        if watermark is not None:
+            queryset = queryset.filter(
+                Q(created__gte=watermark.revoked_before) |
+                Q(digest=watermark.keep_digest))
+        return queryset
+
+    def delete_tokens(self, queryset, revoke=True):
+        """
+        Deletes the tokens in `queryset`, so that they cannot be used
+        anymore. See `forget_tokens`.
+        """
+        tokens = None
+        if token_cache.enabled or revocation_list.enabled:
+            tokens = list(queryset.values_list('digest', 'expiry'))
+        deleted = queryset.delete()
+        if tokens:
+            self.forget_tokens(tokens, revoke=revoke)
+        return deleted
+
+    def forget_tokens(self, tokens, revoke=True):
+        """
+        Drops the deleted `(digest, expiry)` tokens from the token cache and,
+        if `revoke` is set, records them in the revocation list.
+        """
+        if token_cache.enabled:
+            token_cache.delete_many([digest for digest, _ in tokens])
+        if revoke and revocation_list.enabled:
+            revocation_list.revoke_tokens(tokens)
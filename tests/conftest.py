@@ -1,4 +1,6 @@
 def pytest_configure():
+    import tempfile
+
     from django.conf import settings
 
     settings.configure(
@@ -7,7 +9,25 @@ def pytest_configure():
             'default': {
                 'ENGINE': 'django.db.backends.sqlite3',
                 'NAME': ':memory:'
-            }
+            },
+            # Stands in for a read replica of `default`
+            'replica': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': ':memory:'
+            },
+        },
+        CACHES={
+            'default': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            },
+            'jwt_knox_locmem': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                'LOCATION': 'jwt_knox',
+            },
+            'jwt_knox_file': {
+                'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                'LOCATION': tempfile.mkdtemp(prefix='jwt_knox_cache_'),
+            },
         },
         SITE_ID=1,
         SECRET_KEY='not very secret in tests',
@@ -34,6 +54,7 @@ def pytest_configure():
             'django.contrib.staticfiles',
             'rest_framework',
             'knox',
+            'jwt_knox',
             'tests',
         ),
         PASSWORD_HASHERS=(
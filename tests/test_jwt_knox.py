@@ -1,12 +1,19 @@
 from rest_framework.test import APITestCase
 
+import time
 from datetime import timedelta
+from unittest import mock, skipUnless
+import django
 from django.contrib.auth.models import User
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
 
 
-class APIAuthTest(APITestCase):
+class AuthTestMixin(object):
+    """
+    Default user, URLs and helpers of the API tests.
+    """
 
     # Our default user's credentials
     username = 'test_user'
@@ -20,6 +27,8 @@ class APIAuthTest(APITestCase):
     logout_current_url = reverse('jwt_knox-logout')
     logout_other_url = reverse('jwt_knox-logout-other')
     logout_all_url = reverse('jwt_knox-logout-all')
+    verify_batch_url = reverse('jwt_knox-verify-batch')
+    refresh_url = reverse('jwt_knox-refresh')
 
     def setUp(self):
         """
@@ -100,6 +109,12 @@ class APIAuthTest(APITestCase):
         self.client.force_authenticate()
         return response_list
 
+
+class APIAuthTest(AuthTestMixin, APITestCase):
+    """
+    Authentication suite, run again by the subclasses under other settings.
+    """
+
     def test_authentication_bad_token_info(self):
         """
         Verify that a valid JWT without the token jti information
@@ -273,3 +288,2348 @@ class APIAuthTest(APITestCase):
             response = self.verify_token(token_list[i])
             self.assertEqual(response.status_code,
                              status.HTTP_401_UNAUTHORIZED)
+
+    def test_token_lookup_does_not_scan_sessions(self):
+        """
+        The knox row is resolved with a single query no matter how many
+        sessions the user has open
+        :return:
+        """
+        from knox.models import AuthToken
+
+        from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+
+        for i in range(0, 20):
+            AuthToken.objects.create(user=self.user, expiry=None)
+        auth_token, token = AuthToken.objects.create(user=self.user,
+                                                     expiry=None)
+        authenticator = JSONWebTokenKnoxAuthentication()
+        with self.assertNumQueries(1):
+            found = authenticator.ensure_valid_auth_token(self.user, token)
+        self.assertEqual(found.pk, auth_token.pk)
+
+    def test_token_of_another_user(self):
+        """
+        A knox token that belongs to another user does not authenticate
+        :return:
+        """
+        from knox.models import AuthToken
+        from rest_framework.exceptions import AuthenticationFailed
+
+        from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+
+        other = User.objects.create_user(username='other_user')
+        _, token = AuthToken.objects.create(user=other, expiry=None)
+        authenticator = JSONWebTokenKnoxAuthentication()
+        with self.assertRaises(AuthenticationFailed):
+            authenticator.ensure_valid_auth_token(self.user, token)
+
+    def test_expired_token_is_not_deleted_on_authentication(self):
+        """
+        Authenticating with an expired knox token fails without writing to
+        the database; the row is left for the purge
+        :return:
+        """
+        from knox.models import AuthToken
+        from rest_framework.exceptions import AuthenticationFailed
+
+        from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+
+        auth_token, token = AuthToken.objects.create(
+            user=self.user, expiry=timedelta(seconds=-1))
+        authenticator = JSONWebTokenKnoxAuthentication()
+        with self.assertNumQueries(1):
+            with self.assertRaises(AuthenticationFailed):
+                authenticator.ensure_valid_auth_token(self.user, token)
+        self.assertTrue(AuthToken.objects.filter(pk=auth_token.pk).exists())
+
+
+class TokenIssueTest(AuthTestMixin, APITestCase):
+    """
+    Bulk issuing and purging of knox tokens.
+    """
+
+    def test_create_auth_tokens_bulk(self):
+        """
+        Bulk issued tokens are inserted one chunk per query and are valid,
+        with per-item expiries
+        :return:
+        """
+        from knox.models import AuthToken
+
+        from jwt_knox.utils import (create_auth_tokens_bulk,
+                                    jwt_join_header_and_token)
+
+        other = User.objects.create_user(username='other_user')
+        specs = [self.user, (other, timedelta(hours=1)), self.user, other,
+                 self.user]
+        with self.assertNumQueries(3):
+            issued = list(create_auth_tokens_bulk(
+                iter(specs), expiry=timedelta(days=1), batch_size=2))
+
+        self.assertEqual([user for user, _ in issued],
+                         [spec[0] if isinstance(spec, tuple) else spec
+                          for spec in specs])
+        self.assertEqual(AuthToken.objects.count(), 5)
+        self.assertEqual(AuthToken.objects.filter(
+            expiry__lt=timezone.now() + timedelta(hours=2)).count(), 1)
+        for _, token in issued:
+            self.assertEqual(
+                self.verify_token(jwt_join_header_and_token(token)).status_code,
+                status.HTTP_204_NO_CONTENT)
+
+    def test_issue_management_command(self):
+        """
+        `jwt_knox_issue` writes one JSON line per known user
+        :return:
+        """
+        import json
+        from io import StringIO
+
+        from django.core.management import call_command
+
+        out = StringIO()
+        err = StringIO()
+        call_command('jwt_knox_issue', self.username, 'missing_user',
+                     self.username, '--expiry=60', stdout=out, stderr=err)
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([line['username'] for line in lines],
+                         [self.username, self.username])
+        self.assertIn('Unknown user: missing_user', err.getvalue())
+        for line in lines:
+            self.assertEqual(self.verify_token(line['token']).status_code,
+                             status.HTTP_204_NO_CONTENT)
+
+    def test_purge_expired_tokens(self):
+        """
+        Only expired tokens are purged, in batches, and the purged rows are
+        counted
+        :return:
+        """
+        from knox.models import AuthToken
+
+        from jwt_knox.utils import purge_expired_tokens
+
+        for i in range(0, 5):
+            AuthToken.objects.create(user=self.user,
+                                     expiry=timedelta(seconds=-1))
+        AuthToken.objects.create(user=self.user, expiry=timedelta(hours=1))
+        AuthToken.objects.create(user=self.user, expiry=None)
+
+        self.assertEqual(purge_expired_tokens(batch_size=2), 5)
+        self.assertEqual(AuthToken.objects.count(), 2)
+        self.assertEqual(purge_expired_tokens(), 0)
+
+    def test_purge_management_command(self):
+        """
+        The `jwt_knox_purge` command reports how many tokens it purged
+        :return:
+        """
+        from io import StringIO
+
+        from django.core.management import call_command
+        from knox.models import AuthToken
+
+        AuthToken.objects.create(user=self.user, expiry=timedelta(seconds=-1))
+        out = StringIO()
+        call_command('jwt_knox_purge', '--batch-size=10', stdout=out)
+        self.assertIn('Purged 1 expired token(s).', out.getvalue())
+        self.assertFalse(AuthToken.objects.exists())
+
+
+class VerifyBatchTest(AuthTestMixin, APITestCase):
+
+    def test_verify_batch(self):
+        """
+        `verify_batch` reports the validity and owner of every token,
+        resolving them with a single query
+        :return:
+        """
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        other = User.objects.create_user(username='other_user')
+        valid, revoked = [response.data['token']
+                          for response in self.get_n_tokens(2)]
+        self.with_token(revoked).logout_current()
+        self.client.force_authenticate(user=other)
+        other_token = self.client.post(self.login_url).data['token']
+        self.client.force_authenticate()
+
+        tokens = [valid, revoked, 'not a token', other_token.split()[1]]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.with_token(valid).client.post(
+                self.verify_batch_url, {'tokens': tokens}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'], [
+            {'valid': True, 'username': self.username},
+            {'valid': False, 'username': None},
+            {'valid': False, 'username': None},
+            {'valid': True, 'username': 'other_user'},
+        ])
+        knox_queries = [query for query in queries.captured_queries
+                        if 'knox_authtoken' in query['sql']]
+        # One to authenticate the caller, one for the whole batch
+        self.assertEqual(len(knox_queries), 2)
+
+    def test_verify_batch_max_size(self):
+        from jwt_knox.settings import api_settings
+
+        token = self.get_token().data['token']
+        with mock.patch.object(api_settings, 'JWT_VERIFY_BATCH_MAX_SIZE', 2):
+            response = self.with_token(token).client.post(
+                self.verify_batch_url, {'tokens': [token] * 3}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(self.verify_batch_url,
+                                    {'tokens': 'not a list'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class RefreshTest(AuthTestMixin, APITestCase):
+
+    def test_refresh(self):
+        """
+        Refreshing issues a new JWT for the same knox token, without
+        creating a row
+        :return:
+        """
+        from knox.models import AuthToken
+
+        token = self.get_token().data['token']
+        response = self.with_token(token).client.post(self.refresh_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        new_token = response.data['token']
+        self.assertEqual(AuthToken.objects.count(), 1)
+        self.assertEqual(self.verify_token(new_token).status_code,
+                         status.HTTP_204_NO_CONTENT)
+
+        self.logout_current(new_token)
+        self.assertEqual(self.verify_token(token).status_code,
+                         status.HTTP_401_UNAUTHORIZED)
+        self.client.credentials()
+        self.assertEqual(self.client.post(self.refresh_url).status_code,
+                         status.HTTP_401_UNAUTHORIZED)
+
+    def test_refresh_slides_expiry(self):
+        """
+        With `JWT_REFRESH_EXPIRY`, the expiry of the knox token slides, but
+        is only written when it moves by more than the minimum interval
+        :return:
+        """
+        import jwt
+        from knox.models import AuthToken
+
+        from jwt_knox.settings import api_settings
+        from jwt_knox.utils import (create_auth_token,
+                                    jwt_join_header_and_token)
+
+        token = jwt_join_header_and_token(
+            create_auth_token(self.user, timedelta(minutes=5)))
+        auth_token = AuthToken.objects.get()
+        expiry = auth_token.expiry
+
+        with mock.patch.object(api_settings, 'JWT_REFRESH_EXPIRY',
+                               timedelta(minutes=5, seconds=30)):
+            response = self.with_token(token).client.post(self.refresh_url)
+            # Below JWT_REFRESH_MIN_INTERVAL: nothing is written
+            self.assertEqual(AuthToken.objects.get().expiry, expiry)
+            payload = jwt.decode(response.data['token'].split()[1],
+                                 options={'verify_signature': False})
+            self.assertLessEqual(payload['exp'], expiry.timestamp())
+
+            with mock.patch.object(api_settings, 'JWT_REFRESH_EXPIRY',
+                                   timedelta(hours=1)):
+                response = self.with_token(token).client.post(
+                    self.refresh_url)
+            new_expiry = AuthToken.objects.get().expiry
+            self.assertGreater(new_expiry, expiry + timedelta(minutes=50))
+            payload = jwt.decode(response.data['token'].split()[1],
+                                 options={'verify_signature': False})
+            self.assertGreater(payload['exp'],
+                               (expiry + timedelta(minutes=50)).timestamp())
+
+        # The refreshed JWT keeps working
+        self.assertEqual(self.verify_token(response.data['token']).status_code,
+                         status.HTTP_204_NO_CONTENT)
+
+
+class TokenCacheTest(APIAuthTest):
+    """
+    Runs the whole authentication suite with the token cache enabled, plus
+    cache specific checks.
+    """
+    cache_alias = 'jwt_knox_locmem'
+
+    def setUp(self):
+        from django.core.cache import caches
+
+        from jwt_knox.cache import token_cache
+        from jwt_knox.settings import api_settings
+
+        super(TokenCacheTest, self).setUp()
+        patcher = mock.patch.object(api_settings, 'JWT_KNOX_CACHE',
+                                    self.cache_alias)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        caches[self.cache_alias].clear()
+        token_cache.reset_stats()
+        self.token_cache = token_cache
+
+    def test_cache_hit_skips_token_query(self):
+        """
+        Once a token has been resolved, authenticating with it again does
+        not query the knox table
+        :return:
+        """
+        from knox.models import AuthToken
+
+        from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+
+        auth_token, token = AuthToken.objects.create(user=self.user,
+                                                     expiry=None)
+        authenticator = JSONWebTokenKnoxAuthentication()
+        authenticator.ensure_valid_auth_token(self.user, token)
+        with self.assertNumQueries(0):
+            cached = authenticator.ensure_valid_auth_token(self.user, token)
+        self.assertEqual(cached.pk, auth_token.pk)
+        self.assertEqual(self.token_cache.stats(), {'hits': 1, 'misses': 1})
+
+    def test_logout_invalidates_cache(self):
+        """
+        A cached token is rejected once logged out
+        :return:
+        """
+        token = self.get_token().data['token']
+        self.assertEqual(self.verify_token(token).status_code,
+                         status.HTTP_204_NO_CONTENT)
+        self.logout_current(token)
+        self.assertEqual(self.verify_token(token).status_code,
+                         status.HTTP_401_UNAUTHORIZED)
+
+    def test_logout_other_and_all_invalidate_cache(self):
+        """
+        Tokens revoked through `logout_other` and `logout_all` are dropped
+        from the cache as well
+        :return:
+        """
+        token1, token2, token3 = [
+            response.data['token'] for response in self.get_n_tokens(3)]
+        for token in (token1, token2, token3):
+            self.assertEqual(self.verify_token(token).status_code,
+                             status.HTTP_204_NO_CONTENT)
+
+        self.with_token(token1).logout_other()
+        self.assertEqual(self.verify_token(token2).status_code,
+                         status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(self.verify_token(token1).status_code,
+                         status.HTTP_204_NO_CONTENT)
+
+        self.with_token(token1).logout_all()
+        self.assertEqual(self.verify_token(token1).status_code,
+                         status.HTTP_401_UNAUTHORIZED)
+
+    def test_cached_token_matches_row(self):
+        """
+        A token rebuilt from the cache has the expiry and creation time of
+        its row
+        :return:
+        """
+        from knox.models import AuthToken
+
+        from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+
+        row, token = AuthToken.objects.create(user=self.user,
+                                              expiry=timedelta(hours=1))
+        row = AuthToken.objects.get(pk=row.pk)
+        authenticator = JSONWebTokenKnoxAuthentication()
+        authenticator.ensure_valid_auth_token(self.user, token)
+        with self.assertNumQueries(0):
+            cached = authenticator.ensure_valid_auth_token(self.user, token)
+        self.assertEqual(cached.expiry, row.expiry)
+        self.assertEqual(cached.created, row.created)
+
+    def test_refresh_and_logout_cached_token(self):
+        """
+        Refreshing and logging out an expiring token served by the cache
+        keep its expiry
+        :return:
+        """
+        import jwt
+        from knox.models import AuthToken
+
+        from jwt_knox.models import RevokedToken
+        from jwt_knox.settings import api_settings
+        from jwt_knox.utils import (create_auth_token,
+                                    jwt_join_header_and_token)
+
+        token = jwt_join_header_and_token(
+            create_auth_token(self.user, timedelta(hours=1)))
+        expiry = AuthToken.objects.get().expiry
+        self.assertEqual(self.verify_token(token).status_code,
+                         status.HTTP_204_NO_CONTENT)
+
+        response = self.with_token(token).client.post(self.refresh_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        refreshed = response.data['token']
+        payload = jwt.decode(refreshed.split()[1],
+                             options={'verify_signature': False})
+        self.assertEqual(payload['exp'], int(expiry.timestamp()))
+        self.assertEqual(self.verify_token(refreshed).status_code,
+                         status.HTTP_204_NO_CONTENT)
+
+        with mock.patch.object(api_settings, 'JWT_REVOCATION_LIST', True):
+            self.logout_current(refreshed)
+        self.assertEqual(RevokedToken.objects.get().expiry, expiry)
+
+    def test_refresh_updates_cached_expiry(self):
+        """
+        A refresh sliding the expiry of a cached token updates its entry
+        :return:
+        """
+        from knox.models import AuthToken
+
+        from jwt_knox.settings import api_settings
+        from jwt_knox.utils import (create_auth_token,
+                                    jwt_join_header_and_token)
+
+        token = jwt_join_header_and_token(
+            create_auth_token(self.user, timedelta(minutes=5)))
+        self.assertEqual(self.verify_token(token).status_code,
+                         status.HTTP_204_NO_CONTENT)
+        with mock.patch.object(api_settings, 'JWT_REFRESH_EXPIRY',
+                               timedelta(hours=1)):
+            response = self.with_token(token).client.post(self.refresh_url)
+        auth_token = AuthToken.objects.get()
+        self.assertEqual(self.token_cache.get(auth_token.digest)[2],
+                         auth_token.expiry)
+        self.assertEqual(self.verify_token(response.data['token']).status_code,
+                         status.HTTP_204_NO_CONTENT)
+
+
+class FileTokenCacheTest(TokenCacheTest):
+    cache_alias = 'jwt_knox_file'
+
+
+class PayloadCacheTest(APITestCase):
+    """
+    Checks the LRU of verified JWT payloads used by `get_jwt_value`.
+    """
+
+    def setUp(self):
+        from jwt_knox.cache import payload_cache
+        from jwt_knox.settings import api_settings
+
+        self.user = User.objects.create_user(username='test_user')
+        patcher = mock.patch.object(api_settings, 'JWT_PAYLOAD_CACHE_SIZE', 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(payload_cache.clear)
+        payload_cache.clear()
+        payload_cache.reset_stats()
+        self.payload_cache = payload_cache
+        self.api_settings = api_settings
+
+    def make_token(self, expiry=timedelta(hours=1)):
+        from jwt_knox.utils import jwt_encode_handler, jwt_payload_handler
+
+        return jwt_encode_handler(
+            jwt_payload_handler(self.user, 'knox-token', expiry))
+
+    def get_jwt_value(self, token):
+        from rest_framework.test import APIRequestFactory
+
+        from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+
+        request = APIRequestFactory().get(
+            '/', HTTP_AUTHORIZATION='Bearer {0}'.format(token))
+        return JSONWebTokenKnoxAuthentication().get_jwt_value(request)
+
+    def test_cached_payload_skips_decoding(self):
+        token = self.make_token()
+        payload = self.get_jwt_value(token)
+        with mock.patch('jwt.decode') as decode:
+            self.assertEqual(self.get_jwt_value(token), payload)
+        decode.assert_not_called()
+        self.assertEqual(self.payload_cache.stats(),
+                         {'hits': 1, 'misses': 1, 'size': 1})
+
+    def test_size_is_bounded(self):
+        tokens = [self.make_token(timedelta(hours=i + 1)) for i in range(3)]
+        for token in tokens:
+            self.get_jwt_value(token)
+        self.assertEqual(self.payload_cache.stats()['size'], 2)
+        self.assertIsNone(self.payload_cache.get(tokens[0]))
+
+    def test_entry_dropped_before_expiry(self):
+        import time
+
+        token = self.make_token(timedelta(seconds=30))
+        self.get_jwt_value(token)
+        now = time.time()
+        with mock.patch('time.time', return_value=now + 25):
+            self.assertIsNotNone(self.payload_cache.get(token))
+            with mock.patch.object(self.api_settings, 'JWT_LEEWAY', 10):
+                self.assertIsNone(self.payload_cache.get(token))
+        self.get_jwt_value(token)
+        with mock.patch('time.time', return_value=now + 60):
+            self.assertIsNone(self.payload_cache.get(token))
+
+    def test_entry_dropped_on_settings_change(self):
+        from rest_framework.exceptions import AuthenticationFailed
+
+        token = self.make_token()
+        self.get_jwt_value(token)
+        with mock.patch.object(self.api_settings, 'JWT_AUDIENCE', 'other'):
+            with self.assertRaises(AuthenticationFailed):
+                self.get_jwt_value(token)
+
+    def test_disabled_by_default(self):
+        with mock.patch.object(self.api_settings, 'JWT_PAYLOAD_CACHE_SIZE', 0):
+            self.get_jwt_value(self.make_token())
+        self.assertEqual(self.payload_cache.stats()['size'], 0)
+
+
+class SelectRelatedUserTest(APIAuthTest):
+    """
+    Runs the whole authentication suite resolving the user and its token
+    in a single query.
+    """
+
+    def setUp(self):
+        from jwt_knox.settings import api_settings
+
+        super(SelectRelatedUserTest, self).setUp()
+        patcher = mock.patch.object(api_settings, 'JWT_SELECT_RELATED_USER',
+                                    True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def authenticate(self, token):
+        from rest_framework.test import APIRequestFactory
+
+        from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+
+        request = APIRequestFactory().get('/', HTTP_AUTHORIZATION=token)
+        return JSONWebTokenKnoxAuthentication().authenticate(request)
+
+    def test_single_query(self):
+        """
+        Authenticating costs one query, against two for the default mode
+        :return:
+        """
+        from jwt_knox.settings import api_settings
+
+        token = self.get_token().data['token']
+        with self.assertNumQueries(1):
+            user, _ = self.authenticate(token)
+        self.assertEqual(user, self.user)
+
+        with mock.patch.object(api_settings, 'JWT_SELECT_RELATED_USER',
+                               False):
+            with self.assertNumQueries(2):
+                self.authenticate(token)
+
+    def test_username_must_match_token_owner(self):
+        """
+        A valid knox token presented under another user's name is rejected
+        :return:
+        """
+        from knox.models import AuthToken
+        from rest_framework.exceptions import AuthenticationFailed
+
+        from jwt_knox.utils import (jwt_encode_handler,
+                                    jwt_join_header_and_token,
+                                    jwt_payload_handler)
+
+        other = User.objects.create_user(username='other_user')
+        _, knox_token = AuthToken.objects.create(user=self.user, expiry=None)
+        token = jwt_join_header_and_token(jwt_encode_handler(
+            jwt_payload_handler(other, knox_token, None)))
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(token)
+
+    def test_custom_username_field(self):
+        """
+        The joined user is checked against its own `USERNAME_FIELD`
+        :return:
+        """
+        self.user.email = 'test_user@example.com'
+        self.user.save()
+        with mock.patch.object(User, 'USERNAME_FIELD', 'email'):
+            token = self.get_token().data['token']
+            with self.assertNumQueries(1):
+                user, _ = self.authenticate(token)
+        self.assertEqual(user, self.user)
+
+
+class AsyncAuthenticationTest(APITestCase):
+    """
+    Checks the async authentication path against the sync one.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='test_user')
+
+    def make_request(self, token):
+        from rest_framework.test import APIRequestFactory
+
+        return APIRequestFactory().get('/', HTTP_AUTHORIZATION=token)
+
+    async def test_aauthenticate(self):
+        from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+        from jwt_knox.utils import acreate_auth_token, jwt_join_header_and_token
+
+        token = await acreate_auth_token(self.user, None)
+        request = self.make_request(jwt_join_header_and_token(token))
+        user, (payload, auth_token) = \
+            await JSONWebTokenKnoxAuthentication().aauthenticate(request)
+        self.assertEqual(user.pk, self.user.pk)
+        self.assertEqual(auth_token.user_id, self.user.pk)
+        self.assertEqual(payload['username'], self.user.username)
+
+    async def test_aauthenticate_select_related(self):
+        from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+        from jwt_knox.settings import api_settings
+        from jwt_knox.utils import acreate_auth_token, jwt_join_header_and_token
+
+        token = await acreate_auth_token(self.user, None)
+        request = self.make_request(jwt_join_header_and_token(token))
+        with mock.patch.object(api_settings, 'JWT_SELECT_RELATED_USER', True):
+            user, _ = \
+                await JSONWebTokenKnoxAuthentication().aauthenticate(request)
+        self.assertEqual(user.pk, self.user.pk)
+
+    async def test_aauthenticate_revoked_token(self):
+        from asgiref.sync import sync_to_async
+        from knox.models import AuthToken
+        from rest_framework.exceptions import AuthenticationFailed
+
+        from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+        from jwt_knox.utils import acreate_auth_token, jwt_join_header_and_token
+
+        token = await acreate_auth_token(self.user, None)
+        await sync_to_async(
+            AuthToken.objects.filter(user=self.user).delete)()
+        request = self.make_request(jwt_join_header_and_token(token))
+        with self.assertRaises(AuthenticationFailed):
+            await JSONWebTokenKnoxAuthentication().aauthenticate(request)
+
+    async def test_aauthenticate_natural_key(self):
+        """
+        Users are looked up by the natural key of their manager, as on the
+        sync path
+        :return:
+        """
+        from django.contrib.auth.models import UserManager
+
+        from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+        from jwt_knox.utils import acreate_auth_token, jwt_join_header_and_token
+
+        token = await acreate_auth_token(self.user, None)
+        request = self.make_request(jwt_join_header_and_token(token))
+        name = 'get_by_natural_key'
+        if hasattr(UserManager, 'aget_by_natural_key'):
+            name = 'aget_by_natural_key'
+        with mock.patch.object(UserManager, name, autospec=True,
+                               side_effect=getattr(UserManager, name)) as lookup:
+            user, _ = \
+                await JSONWebTokenKnoxAuthentication().aauthenticate(request)
+        self.assertEqual(user.pk, self.user.pk)
+        lookup.assert_called_once_with(mock.ANY, self.user.username)
+
+    async def test_aauthenticate_without_header(self):
+        from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+
+        request = self.make_request('')
+        self.assertIsNone(
+            await JSONWebTokenKnoxAuthentication().aauthenticate(request))
+
+
+def generate_private_key(algorithm):
+    from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+
+    if algorithm.startswith(('RS', 'PS')):
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    elif algorithm.startswith('ES'):
+        return ec.generate_private_key(ec.SECP256R1())
+    return ed25519.Ed25519PrivateKey.generate()
+
+
+def private_pem(key):
+    from cryptography.hazmat.primitives import serialization
+
+    return key.private_bytes(serialization.Encoding.PEM,
+                             serialization.PrivateFormat.PKCS8,
+                             serialization.NoEncryption())
+
+
+def public_pem(key):
+    from cryptography.hazmat.primitives import serialization
+
+    return key.public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo)
+
+
+try:
+    import cryptography  # noqa: F401
+except ImportError:
+    has_crypto = False
+else:
+    has_crypto = True
+
+
+@skipUnless(has_crypto, 'cryptography is not installed')
+class AsymmetricKeyTest(APIAuthTest):
+    """
+    Runs the whole authentication suite signing with an RSA key given as
+    PEM text, plus checks for the other key types and formats.
+    """
+    algorithm = 'RS256'
+
+    def setUp(self):
+        from jwt_knox.keys import clear_loaded_keys
+
+        super(AsymmetricKeyTest, self).setUp()
+        self.private_key = generate_private_key(self.algorithm)
+        self.use_keys(self.algorithm, private_pem(self.private_key))
+        self.addCleanup(clear_loaded_keys)
+
+    def use_keys(self, algorithm, private_key, public_key=None):
+        from jwt_knox.settings import api_settings
+
+        for name, value in (('JWT_ALGORITHM', algorithm),
+                            ('JWT_PRIVATE_KEY', private_key),
+                            ('JWT_PUBLIC_KEY', public_key)):
+            patcher = mock.patch.object(api_settings, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_signed_with_private_key(self):
+        import jwt
+
+        token = self.get_token().data['token'].split()[1]
+        self.assertEqual(jwt.get_unverified_header(token)['alg'],
+                         self.algorithm)
+        jwt.decode(token, public_pem(self.private_key),
+                   algorithms=[self.algorithm])
+
+    def test_bulk_signing_across_processes(self):
+        from jwt_knox.utils import (create_auth_tokens_bulk,
+                                    jwt_join_header_and_token)
+
+        issued = list(create_auth_tokens_bulk(
+            [self.user] * 4, batch_size=3, workers=2))
+        self.assertEqual(len(issued), 4)
+        for _, token in issued:
+            self.assertEqual(
+                self.verify_token(jwt_join_header_and_token(token)).status_code,
+                status.HTTP_204_NO_CONTENT)
+
+    def test_key_types(self):
+        for algorithm in ('ES256', 'EdDSA'):
+            key = generate_private_key(algorithm)
+            self.use_keys(algorithm, private_pem(key), public_pem(key))
+            token = self.get_token().data['token']
+            self.assertEqual(self.verify_token(token).status_code,
+                             status.HTTP_204_NO_CONTENT)
+
+    def test_public_key_only_verifies(self):
+        """
+        A service holding only the public key verifies tokens but cannot
+        issue them
+        :return:
+        """
+        from django.core.exceptions import ImproperlyConfigured
+
+        from jwt_knox.utils import jwt_decode_handler, jwt_encode_handler
+
+        token = self.get_token().data['token'].split()[1]
+        self.use_keys(self.algorithm, None, public_pem(self.private_key))
+        self.assertEqual(jwt_decode_handler(token)['username'],
+                         self.username)
+        with self.assertRaises(ImproperlyConfigured):
+            jwt_encode_handler({'username': self.username})
+
+    def test_keys_parsed_once(self):
+        from cryptography.hazmat.primitives import serialization
+
+        from jwt_knox.keys import clear_loaded_keys
+
+        clear_loaded_keys()
+        with mock.patch.object(
+                serialization, 'load_pem_private_key',
+                wraps=serialization.load_pem_private_key) as load:
+            for i in range(0, 3):
+                token = self.get_token().data['token']
+                self.verify_token(token)
+        self.assertEqual(load.call_count, 1)
+
+    def test_key_from_path(self):
+        import tempfile
+
+        with tempfile.NamedTemporaryFile(suffix='.pem') as key_file:
+            key_file.write(private_pem(self.private_key))
+            key_file.flush()
+            self.use_keys(self.algorithm, key_file.name)
+            token = self.get_token().data['token']
+        self.assertEqual(self.verify_token(token).status_code,
+                         status.HTTP_204_NO_CONTENT)
+
+
+class KeyRotationTest(APIAuthTest):
+    """
+    Runs the whole authentication suite signing through `JWT_KEYRING`,
+    plus key rotation checks with tokens still in flight.
+    """
+    first_secret = 'first secret of at least thirty-two bytes'
+    second_secret = 'second secret of at least thirty-two bytes'
+
+    def setUp(self):
+        super(KeyRotationTest, self).setUp()
+        self.use_keyring({'first': self.first_secret}, 'first')
+
+    def use_keyring(self, keyring, active_kid):
+        from jwt_knox.settings import api_settings
+
+        for name, value in (('JWT_KEYRING', keyring),
+                            ('JWT_ACTIVE_KID', active_kid)):
+            patcher = mock.patch.object(api_settings, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def get_kid(self, token):
+        import jwt
+
+        return jwt.get_unverified_header(token.split()[1])['kid']
+
+    def test_rotation_keeps_tokens_in_flight(self):
+        old_token = self.get_token().data['token']
+        self.assertEqual(self.get_kid(old_token), 'first')
+
+        self.use_keyring({'first': self.first_secret,
+                          'second': self.second_secret}, 'second')
+        new_token = self.get_token().data['token']
+        self.assertEqual(self.get_kid(new_token), 'second')
+
+        for token in (old_token, new_token):
+            self.assertEqual(self.verify_token(token).status_code,
+                             status.HTTP_204_NO_CONTENT)
+
+    def test_retired_key(self):
+        from django.utils import timezone
+
+        old_token = self.get_token().data['token']
+        self.use_keyring({
+            'first': {'key': self.first_secret,
+                      'retire_at': timezone.now() + timedelta(hours=1)},
+            'second': self.second_secret,
+        }, 'second')
+        self.assertEqual(self.verify_token(old_token).status_code,
+                         status.HTTP_204_NO_CONTENT)
+
+        self.use_keyring({
+            'first': {'key': self.first_secret,
+                      'retire_at': timezone.now() - timedelta(seconds=1)},
+            'second': self.second_secret,
+        }, 'second')
+        self.assertEqual(self.verify_token(old_token).status_code,
+                         status.HTTP_401_UNAUTHORIZED)
+
+    def test_removed_key(self):
+        old_token = self.get_token().data['token']
+        self.use_keyring({'second': self.second_secret}, 'second')
+        self.assertEqual(self.verify_token(old_token).status_code,
+                         status.HTTP_401_UNAUTHORIZED)
+
+    def test_tokens_without_kid(self):
+        """
+        Tokens issued before the keyring was configured keep being verified
+        with `JWT_SECRET_KEY`
+        :return:
+        """
+        from jwt_knox.settings import api_settings
+
+        with mock.patch.object(api_settings, 'JWT_KEYRING', None):
+            token = self.get_token().data['token']
+        self.assertEqual(self.verify_token(token).status_code,
+                         status.HTTP_204_NO_CONTENT)
+
+    def test_tokens_without_kid_retired(self):
+        """
+        Tokens without a `kid` are rejected once `JWT_KIDLESS_RETIRE_AT`
+        passes, but only when a keyring is configured
+        :return:
+        """
+        from django.utils import timezone
+
+        from jwt_knox.settings import api_settings
+
+        with mock.patch.object(api_settings, 'JWT_KEYRING', None):
+            token = self.get_token().data['token']
+        with mock.patch.object(api_settings, 'JWT_KIDLESS_RETIRE_AT',
+                               timezone.now() + timedelta(hours=1)):
+            self.assertEqual(self.verify_token(token).status_code,
+                             status.HTTP_204_NO_CONTENT)
+        with mock.patch.object(api_settings, 'JWT_KIDLESS_RETIRE_AT',
+                               timezone.now() - timedelta(seconds=1)):
+            self.assertEqual(self.verify_token(token).status_code,
+                             status.HTTP_401_UNAUTHORIZED)
+            new_token = self.get_token().data['token']
+            self.assertEqual(self.verify_token(new_token).status_code,
+                             status.HTTP_204_NO_CONTENT)
+            with mock.patch.object(api_settings, 'JWT_KEYRING', None):
+                self.assertEqual(self.verify_token(token).status_code,
+                                 status.HTTP_204_NO_CONTENT)
+
+    def test_single_key_lookup(self):
+        """
+        Verification only resolves the key named by the token's `kid`
+        :return:
+        """
+        from jwt_knox import keys
+
+        token = self.get_token().data['token']
+        keyring = dict(('kid-%d' % i, 'secret %d' % i) for i in range(100))
+        keyring['first'] = self.first_secret
+        self.use_keyring(keyring, 'first')
+        with mock.patch.object(keys, 'get_key_config',
+                               wraps=keys.get_key_config) as get_config:
+            self.assertEqual(self.verify_token(token).status_code,
+                             status.HTTP_204_NO_CONTENT)
+        self.assertEqual(set(call.args[0] for call in get_config.mock_calls),
+                         {'first'})
+
+    @skipUnless(has_crypto, 'cryptography is not installed')
+    def test_rotate_to_asymmetric_key(self):
+        old_token = self.get_token().data['token']
+        private_key = generate_private_key('ES256')
+        self.use_keyring({
+            'first': self.first_secret,
+            'second': {'algorithm': 'ES256',
+                       'key': private_pem(private_key)},
+        }, 'second')
+        new_token = self.get_token().data['token']
+        for token in (old_token, new_token):
+            self.assertEqual(self.verify_token(token).status_code,
+                             status.HTTP_204_NO_CONTENT)
+
+
+class StatelessVerificationTest(APITestCase):
+    """
+    Checks the `jwks` endpoint and the stateless authentication class that
+    downstream services use to verify tokens locally.
+    """
+    jwks_url = reverse('jwt_knox-jwks')
+
+    def setUp(self):
+        from jwt_knox.keys import clear_loaded_keys
+
+        self.user = User.objects.create_user(username='test_user')
+        self.addCleanup(clear_loaded_keys)
+
+    def use_settings(self, **values):
+        from jwt_knox.settings import api_settings
+
+        for name, value in values.items():
+            patcher = mock.patch.object(api_settings, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def make_token(self):
+        from jwt_knox.utils import create_auth_token, jwt_join_header_and_token
+
+        return jwt_join_header_and_token(create_auth_token(self.user, None))
+
+    def authenticate(self, token):
+        from rest_framework.test import APIRequestFactory
+
+        from jwt_knox.auth import StatelessJSONWebTokenAuthentication
+
+        request = APIRequestFactory().get('/', HTTP_AUTHORIZATION=token)
+        return StatelessJSONWebTokenAuthentication().authenticate(request)
+
+    def test_hmac_secrets_are_not_published(self):
+        response = self.client.get(self.jwks_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {'keys': []})
+
+    @skipUnless(has_crypto, 'cryptography is not installed')
+    def test_jwks_verifies_tokens(self):
+        import jwt
+
+        old_key = generate_private_key('RS256')
+        new_key = generate_private_key('ES256')
+        self.use_settings(JWT_KEYRING={
+            'old': {'algorithm': 'RS256', 'key': private_pem(old_key)},
+            'new': {'algorithm': 'ES256', 'key': private_pem(new_key)},
+            'hmac': 'a secret that must never be published',
+        }, JWT_ACTIVE_KID='new')
+        token = self.make_token().split()[1]
+
+        response = self.client.get(self.jwks_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('max-age=', response['Cache-Control'])
+        jwks = jwt.PyJWKSet.from_dict(response.json())
+        self.assertEqual(sorted(key.key_id for key in jwks.keys),
+                         ['new', 'old'])
+        payload = jwt.decode(token, jwks['new'].key, algorithms=['ES256'])
+        self.assertEqual(payload['username'], self.user.username)
+
+    @skipUnless(has_crypto, 'cryptography is not installed')
+    def test_jwks_etag(self):
+        key = generate_private_key('RS256')
+        self.use_settings(JWT_ALGORITHM='RS256',
+                          JWT_PRIVATE_KEY=private_pem(key))
+        etag = self.client.get(self.jwks_url)['ETag']
+        response = self.client.get(self.jwks_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.use_settings(JWT_PRIVATE_KEY=private_pem(
+            generate_private_key('RS256')))
+        response = self.client.get(self.jwks_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_stateless_authentication(self):
+        token = self.make_token()
+        with self.assertNumQueries(0):
+            user, (payload, auth_token) = self.authenticate(token)
+        self.assertTrue(user.is_authenticated)
+        self.assertEqual(user.get_username(), self.user.username)
+        self.assertIsNone(auth_token)
+
+    def test_stateless_authentication_revocation_check(self):
+        from rest_framework.exceptions import AuthenticationFailed
+
+        token = self.make_token()
+        is_revoked = mock.Mock(return_value=True)
+        self.use_settings(JWT_REVOCATION_CHECK_HANDLER=is_revoked)
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(token)
+        self.assertEqual(is_revoked.call_args.args[0]['username'],
+                         self.user.username)
+
+    async def test_async_revocation_check_handler(self):
+        """
+        A coroutine function revocation check is awaited
+        :return:
+        """
+        from asgiref.sync import sync_to_async
+        from rest_framework.exceptions import AuthenticationFailed
+        from rest_framework.test import APIRequestFactory
+
+        from jwt_knox.auth import StatelessJSONWebTokenAuthentication
+
+        revoked = []
+
+        async def is_revoked(payload):
+            return payload['jti'] in revoked
+
+        token = await sync_to_async(self.make_token)()
+        self.use_settings(JWT_REVOCATION_CHECK_HANDLER=is_revoked)
+        request = APIRequestFactory().get('/', HTTP_AUTHORIZATION=token)
+        authenticator = StatelessJSONWebTokenAuthentication()
+        user, (payload, _) = await authenticator.aauthenticate(request)
+        self.assertEqual(user.get_username(), self.user.username)
+
+        revoked.append(payload['jti'])
+        with self.assertRaises(AuthenticationFailed):
+            await authenticator.aauthenticate(request)
+
+
+class RevocationListTest(APITestCase):
+    """
+    Checks the revocation list that backs stateless verification.
+    """
+    login_url = reverse('jwt_knox-get-token')
+    logout_current_url = reverse('jwt_knox-logout')
+    logout_other_url = reverse('jwt_knox-logout-other')
+    logout_all_url = reverse('jwt_knox-logout-all')
+
+    def setUp(self):
+        from jwt_knox.revocation import is_token_revoked, revocation_list
+        from jwt_knox.settings import api_settings
+
+        self.user = User.objects.create_user(username='test_user')
+        for name, value in (
+                ('JWT_REVOCATION_LIST', True),
+                ('JWT_REVOCATION_CHECK_HANDLER', is_token_revoked)):
+            patcher = mock.patch.object(api_settings, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        revocation_list.reset()
+        self.addCleanup(revocation_list.reset)
+        self.revocation_list = revocation_list
+
+    def get_token(self):
+        self.client.force_authenticate(user=self.user)
+        token = self.client.post(self.login_url).data['token']
+        self.client.force_authenticate()
+        return token
+
+    def post(self, url, token):
+        self.client.credentials(HTTP_AUTHORIZATION=token)
+        response = self.client.post(url)
+        self.client.credentials()
+        return response
+
+    def is_valid(self, token):
+        from rest_framework.exceptions import AuthenticationFailed
+        from rest_framework.test import APIRequestFactory
+
+        from jwt_knox.auth import StatelessJSONWebTokenAuthentication
+
+        request = APIRequestFactory().get('/', HTTP_AUTHORIZATION=token)
+        try:
+            StatelessJSONWebTokenAuthentication().authenticate(request)
+        except AuthenticationFailed:
+            return False
+        return True
+
+    async def test_async_authentication(self):
+        """
+        `aauthenticate` runs the revocation list check, which may query the
+        database, in a thread
+        :return:
+        """
+        from asgiref.sync import sync_to_async
+        from rest_framework.exceptions import AuthenticationFailed
+        from rest_framework.test import APIRequestFactory
+
+        from jwt_knox.auth import StatelessJSONWebTokenAuthentication
+
+        revoked = await sync_to_async(self.get_token)()
+        valid = await sync_to_async(self.get_token)()
+        await sync_to_async(self.post)(self.logout_current_url, revoked)
+        self.revocation_list.reset()
+
+        authenticator = StatelessJSONWebTokenAuthentication()
+        factory = APIRequestFactory()
+        with self.assertRaises(AuthenticationFailed):
+            await authenticator.aauthenticate(
+                factory.get('/', HTTP_AUTHORIZATION=revoked))
+        user, _ = await authenticator.aauthenticate(
+            factory.get('/', HTTP_AUTHORIZATION=valid))
+        self.assertEqual(user.get_username(), self.user.username)
+
+    def test_unrevoked_tokens_skip_the_database(self):
+        token = self.get_token()
+        self.revocation_list.rebuild()
+        with self.assertNumQueries(0):
+            self.assertTrue(self.is_valid(token))
+
+    def test_logout(self):
+        token1, token2 = self.get_token(), self.get_token()
+        self.post(self.logout_current_url, token1)
+        self.assertFalse(self.is_valid(token1))
+        self.assertTrue(self.is_valid(token2))
+
+    def test_logout_other(self):
+        token1, token2, token3 = [self.get_token() for i in range(3)]
+        self.post(self.logout_other_url, token1)
+        self.assertTrue(self.is_valid(token1))
+        self.assertFalse(self.is_valid(token2))
+        self.assertFalse(self.is_valid(token3))
+
+    def test_logout_all_watermark(self):
+        from jwt_knox.models import RevocationWatermark
+
+        token1, token2 = self.get_token(), self.get_token()
+        self.post(self.logout_all_url, token1)
+        self.assertTrue(
+            RevocationWatermark.objects.filter(user=self.user).exists())
+        self.assertFalse(self.is_valid(token1))
+        self.assertFalse(self.is_valid(token2))
+        # Issued right after, usually within the same second
+        self.assertTrue(self.is_valid(self.get_token()))
+
+    def test_rebuilt_from_store(self):
+        """
+        A fresh process rebuilds the filter from the store on first use
+        :return:
+        """
+        token1, token2 = self.get_token(), self.get_token()
+        self.post(self.logout_current_url, token1)
+        self.post(self.logout_all_url, token2)
+        self.revocation_list.reset()
+        self.assertFalse(self.is_valid(token1))
+        self.assertFalse(self.is_valid(token2))
+
+    def test_refresh_picks_up_other_processes(self):
+        from django.utils import timezone
+
+        from jwt_knox.models import RevokedToken
+        from jwt_knox.settings import api_settings
+
+        token = self.get_token()
+        self.assertTrue(self.is_valid(token))
+        # Another process logs the token out
+        auth_token = self.user.auth_token_set.get()
+        RevokedToken.objects.create(digest=auth_token.digest,
+                                    expiry=auth_token.expiry)
+        auth_token.delete()
+        self.assertTrue(self.is_valid(token))
+        with mock.patch.object(api_settings,
+                               'JWT_REVOCATION_REFRESH_INTERVAL', 0):
+            self.assertFalse(self.is_valid(token))
+        self.assertLessEqual(self.revocation_list.synced_at, timezone.now())
+
+    def test_malformed_jti_rejected(self):
+        """
+        A signed token whose `jti` is not a knox token is rejected instead
+        of failing the digest
+        :return:
+        """
+        from jwt_knox.utils import (jwt_encode_handler,
+                                    jwt_join_header_and_token)
+
+        def make_token(jti):
+            return jwt_join_header_and_token(jwt_encode_handler(
+                {'username': self.user.username, 'jti': jti}))
+
+        self.revocation_list.rebuild()
+        for jti in (42, ['not', 'a', 'token']):
+            self.assertFalse(self.is_valid(make_token(jti)))
+        # Only knox 4 hashes the hexadecimal decoding of tokens, but neither
+        # fails the request
+        self.is_valid(make_token('not hexadecimal'))
+
+    def test_false_positive_falls_back_to_knox_table(self):
+        """
+        A token the bloom filter wrongly reports is checked against the
+        knox table, and stays valid
+        :return:
+        """
+        from jwt_knox.revocation import BloomFilter
+
+        token = self.get_token()
+        self.revocation_list.rebuild()
+        with mock.patch.object(BloomFilter, '__contains__',
+                               return_value=True):
+            with self.assertNumQueries(2):
+                self.assertTrue(self.is_valid(token))
+        self.assertEqual(self.revocation_list.stats(), {
+            'checks': 1, 'bloom_positives': 1, 'false_positives': 1})
+
+    def test_bloom_filter(self):
+        from jwt_knox.revocation import BloomFilter
+
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add('token:%d' % i)
+        self.assertTrue(all('token:%d' % i in bloom for i in range(1000)))
+        false_positives = sum('other:%d' % i in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_purge(self):
+        from jwt_knox.models import RevokedToken
+        from jwt_knox.utils import purge_expired_tokens
+
+        self.post(self.logout_current_url, self.get_token())
+        RevokedToken.objects.create(
+            digest='expired', expiry=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(purge_expired_tokens(), 1)
+        self.assertEqual(RevokedToken.objects.count(), 1)
+
+
+class LogoutWatermarkTest(APIAuthTest):
+    """
+    Runs the whole authentication suite with `logout_other` and
+    `logout_all` writing a watermark instead of deleting the tokens.
+    """
+
+    def setUp(self):
+        from jwt_knox.settings import api_settings
+
+        super(LogoutWatermarkTest, self).setUp()
+        patcher = mock.patch.object(api_settings, 'JWT_LOGOUT_WATERMARK',
+                                    True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_logout_all_keeps_rows_until_purged(self):
+        from knox.models import AuthToken
+
+        from jwt_knox.utils import purge_expired_tokens
+
+        tokens = [response.data['token'] for response in self.get_n_tokens(3)]
+        self.with_token(tokens[0]).logout_all()
+        self.assertEqual(AuthToken.objects.count(), 3)
+        for token in tokens:
+            self.assertEqual(self.verify_token(token).status_code,
+                             status.HTTP_401_UNAUTHORIZED)
+
+        new_token = self.get_token().data['token']
+        self.assertEqual(self.verify_token(new_token).status_code,
+                         status.HTTP_204_NO_CONTENT)
+        self.assertEqual(purge_expired_tokens(), 3)
+        self.assertEqual(AuthToken.objects.count(), 1)
+
+    def test_logout_other_keeps_current_token(self):
+        from jwt_knox.utils import purge_expired_tokens
+
+        token1, token2, token3 = [
+            response.data['token'] for response in self.get_n_tokens(3)]
+        response = self.with_token(token2).logout_other()
+        self.assertEqual(response.data, {'deleted_sessions': 2})
+        self.assertEqual(self.verify_token(token2).status_code,
+                         status.HTTP_204_NO_CONTENT)
+        for token in (token1, token3):
+            self.assertEqual(self.verify_token(token).status_code,
+                             status.HTTP_401_UNAUTHORIZED)
+        response = self.with_token(token2).logout_other()
+        self.assertEqual(response.data, {'deleted_sessions': 0})
+        self.assertEqual(purge_expired_tokens(), 2)
+        self.assertEqual(self.verify_token(token2).status_code,
+                         status.HTTP_204_NO_CONTENT)
+
+    def test_verify_batch_honours_watermark(self):
+        token1, token2 = [
+            response.data['token'] for response in self.get_n_tokens(2)]
+        self.with_token(token1).logout_other()
+        response = self.with_token(token1).client.post(
+            self.verify_batch_url, {'tokens': [token1, token2]},
+            format='json')
+        self.assertEqual([result['valid'] for result in response.data['results']],
+                         [True, False])
+
+    def test_watermark_joined_in_select_related_mode(self):
+        from rest_framework.test import APIRequestFactory
+
+        from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+        from jwt_knox.settings import api_settings
+
+        token1, token2 = [
+            response.data['token'] for response in self.get_n_tokens(2)]
+        self.with_token(token1).logout_other()
+        authenticator = JSONWebTokenKnoxAuthentication()
+        with mock.patch.object(api_settings, 'JWT_SELECT_RELATED_USER', True):
+            with self.assertNumQueries(1):
+                authenticator.authenticate(APIRequestFactory().get(
+                    '/', HTTP_AUTHORIZATION=token1))
+
+    async def test_async_watermark(self):
+        from asgiref.sync import sync_to_async
+        from rest_framework.exceptions import AuthenticationFailed
+        from rest_framework.test import APIRequestFactory
+
+        from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+        from jwt_knox.settings import api_settings
+
+        token = (await sync_to_async(self.get_token)()).data['token']
+        await sync_to_async(self.with_token(token).logout_all)()
+        request = APIRequestFactory().get('/', HTTP_AUTHORIZATION=token)
+        for select_related in (False, True):
+            with mock.patch.object(api_settings, 'JWT_SELECT_RELATED_USER',
+                                   select_related):
+                with self.assertRaises(AuthenticationFailed):
+                    await JSONWebTokenKnoxAuthentication().aauthenticate(
+                        request)
+
+    async def test_async_watermark_same_second_with_token_cache(self):
+        """
+        A cached token issued in the same second as the watermark is
+        compared by its creation time without querying from async code
+        :return:
+        """
+        from datetime import datetime
+
+        from asgiref.sync import sync_to_async
+        from django.core.cache import caches
+        from rest_framework.exceptions import AuthenticationFailed
+        from rest_framework.test import APIRequestFactory
+
+        from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+        from jwt_knox.models import RevocationWatermark
+        from jwt_knox.settings import api_settings
+        from jwt_knox.utils import jwt_decode_handler
+
+        patcher = mock.patch.object(api_settings, 'JWT_KNOX_CACHE',
+                                    'jwt_knox_locmem')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        await sync_to_async(caches['jwt_knox_locmem'].clear)()
+
+        token = (await sync_to_async(self.get_token)()).data['token']
+        await sync_to_async(self.verify_token)(token)
+        await sync_to_async(self.with_token(token).logout_all)()
+        issued_at = jwt_decode_handler(token.split()[1])['iat']
+        await sync_to_async(RevocationWatermark.objects.filter(
+            user=self.user).update)(revoked_before=datetime.fromtimestamp(
+                issued_at) + timedelta(microseconds=999999))
+
+        request = APIRequestFactory().get('/', HTTP_AUTHORIZATION=token)
+        with self.assertRaises(AuthenticationFailed):
+            await JSONWebTokenKnoxAuthentication().aauthenticate(request)
+
+
+class LastUsedTrackingTest(APIAuthTest):
+    """
+    Runs the whole authentication suite with last used tracking enabled,
+    plus checks that the touches are throttled and coalesced.
+    """
+
+    def setUp(self):
+        from jwt_knox.activity import activity_tracker
+        from jwt_knox.settings import api_settings
+
+        super(LastUsedTrackingTest, self).setUp()
+        patcher = mock.patch.object(api_settings, 'JWT_TRACK_LAST_USED', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        activity_tracker.reset()
+        self.addCleanup(activity_tracker.reset)
+        self.activity_tracker = activity_tracker
+
+    def test_touches_are_coalesced(self):
+        from knox.models import AuthToken
+
+        from jwt_knox.models import TokenActivity
+
+        token = self.get_token().data['token']
+        digest = AuthToken.objects.get().digest
+        for i in range(0, 10):
+            self.verify_token(token)
+
+        self.assertEqual(self.activity_tracker.stats(), {
+            'touches': 10, 'coalesced': 9, 'writes': 1, 'flushes': 1})
+        self.assertTrue(TokenActivity.objects.filter(digest=digest).exists())
+
+    def test_touches_are_flushed_in_bulk(self):
+        from knox.models import AuthToken
+
+        from jwt_knox.models import TokenActivity
+        from jwt_knox.settings import api_settings
+
+        tokens = [response.data['token'] for response in self.get_n_tokens(3)]
+        with mock.patch.object(api_settings, 'JWT_LAST_USED_FLUSH_INTERVAL',
+                               3600):
+            self.activity_tracker.flushed_at = time.monotonic()
+            for token in tokens:
+                self.verify_token(token)
+            self.assertFalse(TokenActivity.objects.exists())
+
+            # Django < 4.1 looks up the existing rows before inserting
+            with self.assertNumQueries(1 if django.VERSION >= (4, 1) else 2):
+                self.activity_tracker.flush()
+        self.assertEqual(
+            set(TokenActivity.objects.values_list('digest', flat=True)),
+            set(AuthToken.objects.values_list('digest', flat=True)))
+        self.assertEqual(self.activity_tracker.stats()['flushes'], 1)
+
+    def test_token_written_again_after_interval(self):
+        from jwt_knox.models import TokenActivity
+        from jwt_knox.settings import api_settings
+
+        token = self.get_token().data['token']
+        self.verify_token(token)
+        last_used = TokenActivity.objects.get().last_used
+        with mock.patch.object(api_settings, 'JWT_LAST_USED_INTERVAL', 0):
+            with mock.patch.object(api_settings,
+                                   'JWT_LAST_USED_FLUSH_INTERVAL', 0):
+                self.verify_token(token)
+        self.assertGreater(TokenActivity.objects.get().last_used, last_used)
+        self.assertEqual(self.activity_tracker.stats()['writes'], 2)
+
+    def test_purge_drops_activity_of_deleted_tokens(self):
+        from jwt_knox.models import TokenActivity
+        from jwt_knox.utils import purge_expired_tokens
+
+        token = self.get_token().data['token']
+        self.verify_token(token)
+        self.logout_current(token)
+        self.assertEqual(purge_expired_tokens(), 1)
+        self.assertFalse(TokenActivity.objects.exists())
+
+    async def test_aauthenticate_touches_token(self):
+        from asgiref.sync import sync_to_async
+        from rest_framework.test import APIRequestFactory
+
+        from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+        from jwt_knox.models import TokenActivity
+
+        token = (await sync_to_async(self.get_token)()).data['token']
+        await JSONWebTokenKnoxAuthentication().aauthenticate(
+            APIRequestFactory().get('/', HTTP_AUTHORIZATION=token))
+        self.assertEqual(
+            await sync_to_async(TokenActivity.objects.count)(), 1)
+
+
+class MetricsTest(APIAuthTest):
+    """
+    Runs the whole authentication suite recording metrics into the
+    Prometheus sink, plus checks of what gets recorded and exported.
+    """
+
+    def setUp(self):
+        from jwt_knox.metrics import PrometheusSink, metrics
+
+        super(MetricsTest, self).setUp()
+        self.use_sink(PrometheusSink)
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        self.metrics = metrics
+
+    def use_sink(self, sink_class):
+        from jwt_knox.settings import api_settings
+
+        patcher = mock.patch.object(api_settings, 'JWT_METRICS_SINK',
+                                    sink_class)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_counters(self):
+        token1, token2 = [
+            response.data['token'] for response in self.get_n_tokens(2)]
+        self.verify_token(token1)
+        self.verify_token('Bearer not.a.token')
+        self.logout_current(token2)
+        self.verify_token(token2)
+        self.user.is_active = False
+        self.user.save()
+        self.verify_token(token1)
+
+        counters = self.metrics.sink.counters
+        self.assertEqual(counters[('tokens_issued_total', ())], 2)
+        self.assertEqual(counters[('logouts_total', (('scope', 'current'), ))],
+                         1)
+        # verify and logout
+        self.assertEqual(counters[('authentications_total', ())], 2)
+        for reason in ('decode_error', 'unknown_token', 'inactive_user'):
+            self.assertEqual(
+                counters[('auth_failures_total', (('reason', reason), ))], 1)
+
+    def test_expired_token_reason(self):
+        from jwt_knox.utils import (jwt_encode_handler,
+                                    jwt_join_header_and_token,
+                                    jwt_payload_handler)
+
+        payload = jwt_payload_handler(self.user, 'x' * 64, None)
+        payload['exp'] = payload['iat'] - 60
+        self.verify_token(jwt_join_header_and_token(
+            jwt_encode_handler(payload)))
+        self.assertEqual(self.metrics.sink.counters[
+            ('auth_failures_total', (('reason', 'expired'), ))], 1)
+
+    def test_prometheus_view(self):
+        from django.test import RequestFactory
+
+        from jwt_knox.metrics import prometheus_metrics_view
+
+        token = self.get_token().data['token']
+        self.verify_token(token)
+        response = prometheus_metrics_view(RequestFactory().get('/metrics'))
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        text = response.content.decode('utf-8')
+        self.assertIn('# TYPE jwt_knox_decode_seconds histogram', text)
+        self.assertIn('jwt_knox_authentications_total 1', text)
+        self.assertIn('jwt_knox_decode_seconds_count 1', text)
+        self.assertIn('jwt_knox_tokens_scanned_bucket{le="1"} 1', text)
+        self.assertIn('jwt_knox_user_lookup_seconds_bucket{le="+Inf"} 1',
+                      text)
+
+    def test_prometheus_view_disabled(self):
+        from django.http import Http404
+        from django.test import RequestFactory
+
+        from jwt_knox.metrics import prometheus_metrics_view
+
+        self.use_sink(None)
+        with self.assertRaises(Http404):
+            prometheus_metrics_view(RequestFactory().get('/metrics'))
+
+    def test_statsd_sink(self):
+        import socket
+
+        from jwt_knox.metrics import StatsdSink
+        from jwt_knox.settings import api_settings
+
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        self.use_sink(StatsdSink)
+        with mock.patch.object(api_settings, 'JWT_METRICS_STATSD_PORT',
+                               server.getsockname()[1]):
+            self.metrics.reset()
+            self.verify_token('Bearer not.a.token')
+            self.metrics.observe('token_lookup_seconds', 0.002)
+
+        packets = [server.recv(1024).decode('utf-8') for _ in range(3)]
+        self.assertEqual(packets[0], 'jwt_knox.decode_seconds:' +
+                         packets[0].split(':')[1])
+        self.assertTrue(packets[0].endswith('|ms'))
+        self.assertEqual(packets[1],
+                         'jwt_knox.auth_failures_total.decode_error:1|c')
+        self.assertEqual(packets[2], 'jwt_knox.token_lookup_seconds:2|ms')
+
+    def test_disabled_records_nothing(self):
+        from jwt_knox.metrics import NullSink
+
+        self.use_sink(None)
+        self.assertFalse(self.metrics.enabled)
+        self.verify_token(self.get_token().data['token'])
+        self.assertIsInstance(self.metrics.sink, NullSink)
+
+
+class LazySettingsTest(APITestCase):
+    """
+    Settings are read on first use and reloaded when Django's settings
+    change.
+    """
+
+    def test_import_without_configured_settings(self):
+        import os
+        import subprocess
+        import sys
+
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        result = subprocess.run(
+            [sys.executable, '-c', 'import jwt_knox.settings'],
+            env={'PYTHONPATH': root}, capture_output=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+    def test_reloaded_on_setting_changed(self):
+        from django.test import override_settings
+
+        from jwt_knox.settings import api_settings
+
+        self.assertEqual(api_settings.auth_header_prefix, b'bearer')
+        with override_settings(JWT_AUTH={'JWT_AUTH_HEADER_PREFIX': 'JWT'}):
+            self.assertEqual(api_settings.JWT_AUTH_HEADER_PREFIX, 'JWT')
+            self.assertEqual(api_settings.auth_header_prefix, b'jwt')
+        self.assertEqual(api_settings.JWT_AUTH_HEADER_PREFIX, 'Bearer')
+
+        with override_settings(SECRET_KEY='another secret'):
+            self.assertEqual(api_settings.JWT_SECRET_KEY, 'another secret')
+
+    def test_login_classes_default_to_rest_framework(self):
+        from django.test import override_settings
+        from rest_framework.authentication import (BasicAuthentication,
+                                                   SessionAuthentication)
+
+        from jwt_knox.settings import api_settings
+
+        self.assertIn(BasicAuthentication,
+                      api_settings.JWT_LOGIN_AUTHENTICATION_CLASSES)
+        with override_settings(REST_FRAMEWORK={}):
+            self.assertEqual(api_settings.JWT_LOGIN_AUTHENTICATION_CLASSES,
+                             [SessionAuthentication, BasicAuthentication])
+
+    def test_derived_values_follow_settings(self):
+        from jwt_knox.settings import api_settings
+
+        options = api_settings.decode_options
+        self.assertIs(api_settings.decode_options, options)
+        with mock.patch.object(api_settings, 'JWT_LEEWAY', 30):
+            self.assertEqual(api_settings.decode_options['leeway'], 30)
+        self.assertEqual(api_settings.decode_options['leeway'], 0)
+
+    def test_prefix_from_settings_accepted(self):
+        from django.test import override_settings
+
+        from jwt_knox.utils import create_auth_token
+
+        user = User.objects.create_user(username='test_user')
+        with override_settings(JWT_AUTH={'JWT_AUTH_HEADER_PREFIX': 'JWT'}):
+            self.client.credentials(HTTP_AUTHORIZATION='JWT {0}'.format(
+                create_auth_token(user, None)))
+            response = self.client.post(reverse('jwt_knox-verify'))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+
+class AuthorizationHeaderTest(APITestCase):
+    """
+    `parse_authorization_header` against the split-based parsing it
+    replaced, which defines the expected behaviour.
+    """
+
+    def reference_parse(self, header, prefix):
+        from rest_framework.exceptions import AuthenticationFailed
+
+        auth = header.split()
+        if not auth or auth[0].lower() != prefix:
+            return None
+        if len(auth) == 1:
+            raise AuthenticationFailed(
+                'Invalid Authorization header. No credentials provided.')
+        elif len(auth) > 2:
+            raise AuthenticationFailed(
+                'Invalid Authorization header. Credentials string '
+                'should contain no spaces.')
+        return auth[1]
+
+    def outcome(self, parse, header, prefix):
+        from rest_framework.exceptions import AuthenticationFailed
+
+        try:
+            return ('credentials', parse(header, prefix))
+        except AuthenticationFailed as exc:
+            return ('error', str(exc.detail))
+
+    def test_fuzz_against_split(self):
+        import random
+
+        from jwt_knox.auth import parse_authorization_header
+
+        pieces = [b'bearer', b'Bearer', b'BEARER', b'bEaReR', b'jwt', b'JWT',
+                  b'Basic', b'b', b'r', b'x', b'.', b'-', b'abc.def.ghi',
+                  b' ', b'  ', b'\t', b'\n', b'\r', b'\x0b', b'\x0c',
+                  b'\xa0', b'\x85', b'\x00', b'\xc3\xa9']
+        rng = random.Random(1234)
+        for _ in range(20000):
+            header = b''.join(rng.choice(pieces)
+                              for _ in range(rng.randint(0, 6)))
+            for prefix in (b'bearer', b'jwt', b''):
+                self.assertEqual(
+                    self.outcome(parse_authorization_header, header, prefix),
+                    self.outcome(self.reference_parse, header, prefix),
+                    (header, prefix))
+
+    def test_known_headers(self):
+        from rest_framework.exceptions import AuthenticationFailed
+
+        from jwt_knox.auth import parse_authorization_header
+
+        self.assertEqual(
+            parse_authorization_header(b'Bearer abc.def.ghi', b'bearer'),
+            b'abc.def.ghi')
+        self.assertEqual(
+            parse_authorization_header(b' \tbearer  abc \r\n', b'bearer'),
+            b'abc')
+        for header in (b'', b'   ', b'Basic abc', b'Bearerabc', b'Bear abc'):
+            self.assertIsNone(parse_authorization_header(header, b'bearer'))
+        for header in (b'Bearer', b'Bearer   ', b'Bearer a b'):
+            with self.assertRaises(AuthenticationFailed):
+                parse_authorization_header(header, b'bearer')
+
+    def test_oversized_credentials_rejected(self):
+        from rest_framework.exceptions import AuthenticationFailed
+
+        from jwt_knox.auth import parse_authorization_header
+
+        header = b'Bearer ' + b'a' * 100
+        self.assertEqual(
+            len(parse_authorization_header(header, b'bearer', 100)), 100)
+        with self.assertRaises(AuthenticationFailed):
+            parse_authorization_header(header + b'a', b'bearer', 100)
+        # Other schemes are left alone whatever their size
+        self.assertIsNone(parse_authorization_header(
+            b'Basic ' + b'a' * 1000, b'bearer', 100))
+
+    def test_oversized_header_rejected_by_authentication(self):
+        response = self.client.post(
+            reverse('jwt_knox-verify'),
+            HTTP_AUTHORIZATION='Bearer ' + 'a' * 10000)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class AuthenticatorReuseTest(APITestCase):
+    """
+    `PerViewAuthenticatorMixin` resolves the authenticators of each action
+    once and shares the reusable instances between requests.
+    """
+
+    def get_request_authenticators(self, action, method='post'):
+        from rest_framework.test import APIRequestFactory
+
+        from jwt_knox.viewsets import JWTKnoxAPIViewSet
+
+        view = JWTKnoxAPIViewSet()
+        view.action_map = {method: action}
+        view.args, view.kwargs = (), {}
+        request = getattr(APIRequestFactory(), method)('/')
+        view.request = view.initialize_request(request)
+        return view.request.authenticators
+
+    def test_reusable_instances_shared(self):
+        from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+
+        first = self.get_request_authenticators('verify')
+        second = self.get_request_authenticators('verify')
+        self.assertEqual(len(first), 1)
+        self.assertIsInstance(first[0], JSONWebTokenKnoxAuthentication)
+        self.assertIs(first[0], second[0])
+
+    def test_subclasses_opt_in(self):
+        """
+        Subclasses of a reusable authenticator are only shared if they set
+        `reusable` themselves
+        :return:
+        """
+        from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+        from jwt_knox.viewsets import JWTKnoxAPIViewSet
+
+        class StatefulAuthentication(JSONWebTokenKnoxAuthentication):
+            pass
+
+        class ReusableAuthentication(JSONWebTokenKnoxAuthentication):
+            reusable = True
+
+        class ViewSet(JWTKnoxAPIViewSet):
+            pass
+
+        classes = (StatefulAuthentication, ReusableAuthentication)
+        view = ViewSet()
+        first = view.resolve_authenticators('test', classes)
+        second = view.resolve_authenticators('test', classes)
+        self.assertIsNot(first[0], second[0])
+        self.assertIs(first[1], second[1])
+
+    def test_other_authenticators_created_per_request(self):
+        first = self.get_request_authenticators('get_token')
+        second = self.get_request_authenticators('get_token')
+        self.assertEqual([type(auth) for auth in first],
+                         [type(auth) for auth in second])
+        for auth, other in zip(first, second):
+            self.assertIsNot(auth, other)
+
+    def test_resolved_once_per_request(self):
+        from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+
+        self.get_request_authenticators('verify')
+        with mock.patch.object(JSONWebTokenKnoxAuthentication, '__init__',
+                               return_value=None) as init:
+            self.get_request_authenticators('verify')
+        init.assert_not_called()
+        self.assertEqual(self.get_request_authenticators('jwks', 'get'), [])
+
+    def test_follows_settings(self):
+        from django.test import override_settings
+        from rest_framework.authentication import SessionAuthentication
+
+        self.get_request_authenticators('get_token')
+        with override_settings(JWT_AUTH={
+                'JWT_LOGIN_AUTHENTICATION_CLASSES': [
+                    'rest_framework.authentication.SessionAuthentication']}):
+            authenticators = self.get_request_authenticators('get_token')
+        self.assertEqual([type(auth) for auth in authenticators],
+                         [SessionAuthentication])
+
+
+class CompactPayloadTest(APIAuthTest):
+    """
+    Runs the whole authentication suite issuing compact payloads.
+    """
+
+    def setUp(self):
+        from jwt_knox.settings import api_settings
+        from jwt_knox.utils import jwt_compact_payload_handler
+
+        super(CompactPayloadTest, self).setUp()
+        patcher = mock.patch.object(api_settings, 'JWT_PAYLOAD_HANDLER',
+                                    jwt_compact_payload_handler)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def decode(self, header):
+        from jwt_knox.utils import jwt_decode_handler
+
+        return jwt_decode_handler(header.split()[1])
+
+    def test_compact_claims(self):
+        """
+        The username is written once and the knox token is shortened
+        :return:
+        """
+        from knox.crypto import hash_token
+        from knox.models import AuthToken
+
+        from jwt_knox.utils import (jwt_get_token_from_payload_handler,
+                                    jwt_get_username_from_payload_handler)
+
+        payload = self.decode(self.get_token().data['token'])
+        self.assertEqual(set(payload), {'sub', 'iat', 'jti'})
+        self.assertEqual(payload['sub'], self.username)
+        self.assertEqual(len(payload['jti']), 43)
+
+        self.assertEqual(jwt_get_username_from_payload_handler(payload),
+                         self.username)
+        token = jwt_get_token_from_payload_handler(payload)
+        self.assertTrue(AuthToken.objects.filter(
+            digest=hash_token(token), user=self.user).exists())
+
+    def test_default_payloads_still_accepted(self):
+        """
+        Tokens issued before switching to the compact profile keep working
+        :return:
+        """
+        from jwt_knox.settings import api_settings
+        from jwt_knox.utils import jwt_payload_handler
+
+        with mock.patch.object(api_settings, 'JWT_PAYLOAD_HANDLER',
+                               jwt_payload_handler):
+            token = self.get_token().data['token']
+        self.assertIn('username', self.decode(token))
+        response = self.verify_token(token)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_invalid_compact_token_id(self):
+        """
+        A `jti` that does not decode to a knox token does not authorize
+        :return:
+        """
+        from jwt_knox.utils import (jwt_encode_handler,
+                                    jwt_get_token_from_payload_handler,
+                                    jwt_join_header_and_token)
+
+        payload = {'sub': self.username, 'jti': 'not base64!'}
+        self.assertIsNone(jwt_get_token_from_payload_handler(payload))
+        token = jwt_join_header_and_token(jwt_encode_handler(payload))
+        response = self.verify_token(token)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class MaxTokensPerUserTest(APIAuthTest):
+    """
+    Runs the whole authentication suite with a cap on the sessions each
+    user can have open.
+    """
+
+    def setUp(self):
+        from jwt_knox.settings import api_settings
+
+        super(MaxTokensPerUserTest, self).setUp()
+        patcher = mock.patch.object(api_settings, 'JWT_MAX_TOKENS_PER_USER',
+                                    10)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_oldest_sessions_evicted(self):
+        """
+        Issuing a token beyond the limit closes the oldest session
+        :return:
+        """
+        from knox.models import AuthToken
+
+        from jwt_knox.settings import api_settings
+
+        with mock.patch.object(api_settings, 'JWT_MAX_TOKENS_PER_USER', 2):
+            tokens = [response.data['token']
+                      for response in self.get_n_tokens(3)]
+        self.assertEqual(AuthToken.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(self.verify_token(tokens[0]).status_code,
+                         status.HTTP_401_UNAUTHORIZED)
+        for token in tokens[1:]:
+            self.assertEqual(self.verify_token(token).status_code,
+                             status.HTTP_204_NO_CONTENT)
+
+    def test_reject_policy(self):
+        """
+        With the `reject` policy, logins beyond the limit get a 429
+        :return:
+        """
+        from knox.models import AuthToken
+
+        from jwt_knox.settings import api_settings
+
+        tokens = [response.data['token'] for response in self.get_n_tokens(2)]
+        with mock.patch.object(api_settings, 'JWT_MAX_TOKENS_PER_USER', 2), \
+                mock.patch.object(api_settings, 'JWT_MAX_TOKENS_POLICY',
+                                  'reject'):
+            response = self.get_token()
+        self.assertEqual(response.status_code,
+                         status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response.data['detail'].code, 'too_many_sessions')
+        self.assertEqual(AuthToken.objects.filter(user=self.user).count(), 2)
+        for token in tokens:
+            self.assertEqual(self.verify_token(token).status_code,
+                             status.HTTP_204_NO_CONTENT)
+
+    def test_expired_sessions_not_counted(self):
+        """
+        Expired sessions are left to the purge and do not count
+        :return:
+        """
+        from knox.models import AuthToken
+
+        from jwt_knox.settings import api_settings
+
+        AuthToken.objects.create(user=self.user, expiry=timedelta(minutes=-1))
+        token = self.get_token().data['token']
+        with mock.patch.object(api_settings, 'JWT_MAX_TOKENS_PER_USER', 2):
+            self.get_token()
+        self.assertEqual(AuthToken.objects.filter(user=self.user).count(), 3)
+        self.assertEqual(self.verify_token(token).status_code,
+                         status.HTTP_204_NO_CONTENT)
+
+
+class IdempotentLoginTest(APIAuthTest):
+    """
+    Runs the whole authentication suite with idempotent logins enabled,
+    plus checks that duplicate logins are coalesced.
+    """
+
+    def setUp(self):
+        from django.core.cache import caches
+
+        from jwt_knox.idempotency import login_coalescer
+        from jwt_knox.settings import api_settings
+
+        super(IdempotentLoginTest, self).setUp()
+        patcher = mock.patch.object(api_settings, 'JWT_IDEMPOTENCY_CACHE',
+                                    'jwt_knox_locmem')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        caches['jwt_knox_locmem'].clear()
+        login_coalescer.reset_stats()
+        self.login_coalescer = login_coalescer
+
+    def count_password_checks(self, delay=0):
+        """
+        Counts the password hash checks, optionally slowed down by `delay`
+        seconds each.
+        :return:
+        """
+        import threading
+
+        from django.contrib.auth import base_user
+
+        check_password = base_user.check_password
+        lock = threading.Lock()
+        calls = []
+
+        def counting_check_password(*args, **kwargs):
+            with lock:
+                calls.append(None)
+            time.sleep(delay)
+            return check_password(*args, **kwargs)
+
+        patcher = mock.patch.object(base_user, 'check_password',
+                                    counting_check_password)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return calls
+
+    def login(self, client, key='retry-1', password=None, username=None):
+        from base64 import b64encode
+
+        credentials = b64encode('{0}:{1}'.format(
+            username or self.username,
+            password or self.password).encode('utf-8'))
+        return client.post(
+            self.login_url,
+            HTTP_AUTHORIZATION='Basic ' + credentials.decode('utf-8'),
+            HTTP_IDEMPOTENCY_KEY=key)
+
+    def get_knox_token(self, response):
+        import jwt
+
+        from jwt_knox.settings import api_settings
+
+        payload = jwt.decode(response.data['token'].split()[1],
+                             options={'verify_signature': False})
+        return api_settings.JWT_PAYLOAD_GET_TOKEN_HANDLER(payload)
+
+    def test_duplicates_get_the_same_token(self):
+        """
+        A duplicate login gets the issued knox token without checking the
+        password nor inserting a knox token
+        :return:
+        """
+        from knox.models import AuthToken
+
+        checks = self.count_password_checks()
+        first = self.login(self.client)
+        second = self.login(self.client)
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.get_knox_token(first),
+                         self.get_knox_token(second))
+        self.assertEqual(self.verify_token(second.data['token']).status_code,
+                         status.HTTP_204_NO_CONTENT)
+        self.assertEqual(len(checks), 1)
+        self.assertEqual(AuthToken.objects.count(), 1)
+        self.assertEqual(self.login_coalescer.stats(), {'coalesced': 1})
+
+        self.client.credentials()
+        other = self.login(self.client, key='retry-2')
+        self.assertNotEqual(self.get_knox_token(other),
+                            self.get_knox_token(first))
+        self.assertEqual(AuthToken.objects.count(), 2)
+
+    def test_other_credentials_not_coalesced(self):
+        """
+        The token is only handed back for the same credentials
+        :return:
+        """
+        User.objects.create_user(username='other_user',
+                                 password=self.password)
+        first = self.login(self.client)
+        response = self.login(self.client, password='wrong')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        other = self.login(self.client, username='other_user')
+        self.assertEqual(other.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(self.get_knox_token(other),
+                            self.get_knox_token(first))
+        self.assertEqual(self.login_coalescer.stats(), {'coalesced': 0})
+
+    def test_cache_holds_no_token(self):
+        """
+        The cache entry cannot be turned into a token without the
+        credentials
+        :return:
+        """
+        from django.core.cache import caches
+
+        response = self.login(self.client)
+        (key, entry), = caches['jwt_knox_locmem']._cache.items()
+        self.assertNotIn(self.get_knox_token(response), str(entry))
+        self.assertNotIn(self.get_knox_token(response), key)
+
+    def test_other_login_classes_not_coalesced(self):
+        """
+        Logins that other classes than `BasicAuthentication` may decide
+        first are not coalesced
+        :return:
+        """
+        from rest_framework.authentication import (BasicAuthentication,
+                                                   SessionAuthentication)
+
+        from jwt_knox.settings import api_settings
+
+        checks = self.count_password_checks()
+        with mock.patch.object(
+                api_settings, 'JWT_LOGIN_AUTHENTICATION_CLASSES',
+                (SessionAuthentication, BasicAuthentication)):
+            for _ in range(2):
+                self.assertEqual(self.login(self.client).status_code,
+                                 status.HTTP_200_OK)
+        self.assertEqual(len(checks), 2)
+
+    def test_logged_out_token_not_replayed(self):
+        """
+        A duplicate of a login whose token was logged out logs in again
+        :return:
+        """
+        from knox.models import AuthToken
+
+        checks = self.count_password_checks()
+        first = self.login(self.client)
+        self.assertEqual(self.logout_current(first.data['token']).status_code,
+                         status.HTTP_204_NO_CONTENT)
+        self.client.credentials()
+        second = self.login(self.client)
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(self.get_knox_token(second),
+                            self.get_knox_token(first))
+        self.assertEqual(AuthToken.objects.count(), 1)
+        self.assertEqual(len(checks), 2)
+        self.assertEqual(self.login_coalescer.stats(), {'coalesced': 0})
+
+    def test_watermarked_token_not_replayed(self):
+        """
+        A token revoked by the logout watermark is not handed back
+        :return:
+        """
+        from jwt_knox.settings import api_settings
+
+        with mock.patch.object(api_settings, 'JWT_LOGOUT_WATERMARK', True):
+            first = self.login(self.client)
+            self.with_token(first.data['token']).logout_all()
+            self.client.credentials()
+            second = self.login(self.client)
+            self.assertEqual(second.status_code, status.HTTP_200_OK)
+            self.assertNotEqual(self.get_knox_token(second),
+                                self.get_knox_token(first))
+            self.assertEqual(
+                self.verify_token(second.data['token']).status_code,
+                status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.login_coalescer.stats(), {'coalesced': 0})
+
+    def test_failed_issue_released(self):
+        """
+        A login failing to issue its token does not leave its duplicates
+        waiting
+        :return:
+        """
+        from jwt_knox.settings import api_settings
+        from jwt_knox.utils import create_auth_token
+
+        create_auth_token(self.user, None)
+        with mock.patch.object(api_settings, 'JWT_IDEMPOTENCY_WAIT', 60), \
+                mock.patch.object(api_settings, 'JWT_MAX_TOKENS_PER_USER', 1), \
+                mock.patch.object(api_settings, 'JWT_MAX_TOKENS_POLICY',
+                                  'reject'):
+            for _ in range(2):
+                response = self.login(self.client)
+                self.assertEqual(response.status_code,
+                                 status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(self.login_coalescer._in_flight, {})
+
+    def test_inactive_user_not_coalesced(self):
+        """
+        A user deactivated after the first login is rejected
+        :return:
+        """
+        self.login(self.client)
+        self.user.is_active = False
+        self.user.save()
+        response = self.login(self.client)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_login_storm(self):
+        """
+        Concurrent duplicate logins check the password and insert a knox
+        token once
+        :return:
+        """
+        import threading
+
+        from django.db import connections
+        from knox.models import AuthToken
+        from rest_framework.test import APIClient
+
+        clients = 20
+        # The test database only lives in this connection
+        connection = connections['default']
+        connection.inc_thread_sharing()
+        self.addCleanup(connection.dec_thread_sharing)
+        checks = self.count_password_checks(delay=0.05)
+        writes = []
+
+        def count_writes(execute, sql, params, many, context):
+            if sql.split(None, 1)[0].upper() in ('INSERT', 'UPDATE',
+                                                 'DELETE'):
+                writes.append(sql)
+            return execute(sql, params, many, context)
+
+        start = threading.Barrier(clients)
+        responses = [None] * clients
+
+        def login(index):
+            connections['default'] = connection
+            start.wait()
+            responses[index] = self.login(APIClient())
+
+        threads = [threading.Thread(target=login, args=(index, ))
+                   for index in range(clients)]
+        with connection.execute_wrapper(count_writes):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual([response.status_code for response in responses],
+                         [status.HTTP_200_OK] * clients)
+        self.assertEqual(len({self.get_knox_token(response)
+                              for response in responses}), 1)
+        self.assertEqual(len(checks), 1)
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(AuthToken.objects.count(), 1)
+        self.assertEqual(self.login_coalescer.stats(),
+                         {'coalesced': clients - 1})
+
+
+class ReadReplicaTest(APITestCase):
+    """
+    Authentication reads from `JWT_READ_DATABASE`, here a second SQLite
+    database that is "replicated" by copying rows into it.
+    """
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        from jwt_knox.settings import api_settings
+        from jwt_knox.utils import create_auth_token, jwt_join_header_and_token
+
+        patcher = mock.patch.object(api_settings, 'JWT_READ_DATABASE',
+                                    'replica')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create_user(username='test_user')
+        self.token = jwt_join_header_and_token(
+            create_auth_token(self.user, None))
+
+    def replicate(self):
+        from knox.models import AuthToken
+
+        for model in (User, AuthToken):
+            model.objects.using('replica').bulk_create(
+                model.objects.all(), ignore_conflicts=True)
+
+    def authenticate(self):
+        from rest_framework.test import APIRequestFactory
+
+        from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+
+        request = APIRequestFactory().get('/', HTTP_AUTHORIZATION=self.token)
+        return JSONWebTokenKnoxAuthentication().authenticate(request)
+
+    def test_reads_from_replica(self):
+        """
+        Once replicated, the user and token are only read from the replica
+        :return:
+        """
+        from jwt_knox.settings import api_settings
+
+        self.replicate()
+        with self.assertNumQueries(0, using='default'), \
+                self.assertNumQueries(2, using='replica'):
+            user, (_, auth_token) = self.authenticate()
+        self.assertEqual(user, self.user)
+        self.assertEqual(auth_token.user_id, self.user.pk)
+
+        with mock.patch.object(api_settings, 'JWT_SELECT_RELATED_USER',
+                               True):
+            with self.assertNumQueries(0, using='default'), \
+                    self.assertNumQueries(1, using='replica'):
+                user, _ = self.authenticate()
+        self.assertEqual(user, self.user)
+
+    def test_falls_back_to_primary(self):
+        """
+        Tokens not replicated yet are found on the primary
+        :return:
+        """
+        from jwt_knox.settings import api_settings
+
+        with self.assertNumQueries(2, using='default'), \
+                self.assertNumQueries(2, using='replica'):
+            user, _ = self.authenticate()
+        self.assertEqual(user, self.user)
+
+        with mock.patch.object(api_settings, 'JWT_SELECT_RELATED_USER',
+                               True):
+            with self.assertNumQueries(1, using='default'), \
+                    self.assertNumQueries(1, using='replica'):
+                user, _ = self.authenticate()
+        self.assertEqual(user, self.user)
+
+    def test_writes_go_to_primary(self):
+        """
+        Logging out deletes the token on the primary, even though it was
+        read from the replica
+        :return:
+        """
+        from knox.models import AuthToken
+
+        self.replicate()
+        self.client.credentials(HTTP_AUTHORIZATION=self.token)
+        response = self.client.post(reverse('jwt_knox-logout'))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(AuthToken.objects.using('default').exists())
+        self.assertTrue(AuthToken.objects.using('replica').exists())
+
+    async def test_async_falls_back_to_primary(self):
+        """
+        The async path reads from the replica with the same fallback
+        :return:
+        """
+        from asgiref.sync import sync_to_async
+        from rest_framework.test import APIRequestFactory
+
+        from jwt_knox.auth import JSONWebTokenKnoxAuthentication
+
+        request = APIRequestFactory().get('/', HTTP_AUTHORIZATION=self.token)
+        authenticator = JSONWebTokenKnoxAuthentication()
+        user, (_, auth_token) = await authenticator.aauthenticate(request)
+        self.assertEqual(user.pk, self.user.pk)
+        self.assertEqual(auth_token._state.db, 'default')
+
+        await sync_to_async(self.replicate)()
+        user, _ = await JSONWebTokenKnoxAuthentication().aauthenticate(
+            request)
+        self.assertEqual(user.pk, self.user.pk)
+        self.assertEqual(user._state.db, 'default')